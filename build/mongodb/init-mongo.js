@@ -53,3 +53,4 @@ db.chunks.createIndex({ "created_at": 1 });
 db.results.createIndex({ "chunk_id": 1 });
 db.results.createIndex({ "created_at": 1 });
 db.results.createIndex({ "anomalies.score": 1 });
+db.results.createIndex({ "anomalies.anomaly_id": 1 });
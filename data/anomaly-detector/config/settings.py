@@ -0,0 +1,17 @@
+"""
+Carga de la configuración del servicio (config/config.yml)
+"""
+import os
+from functools import lru_cache
+from typing import Any, Dict
+
+import yaml
+
+DEFAULT_CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.yml")
+
+@lru_cache(maxsize=1)
+def load_settings() -> Dict[str, Any]:
+    """Lee config.yml una sola vez (CONFIG_PATH permite usar otro archivo)"""
+    path = os.getenv("CONFIG_PATH", DEFAULT_CONFIG_PATH)
+    with open(path, 'r', encoding='utf-8') as f:
+        return yaml.safe_load(f) or {}
@@ -84,6 +84,16 @@ db.results.createIndex(
 );
 print("✅ Índice 'idx_results_created_at' creado");
 
+// Índice para buscar una anomalía por su id (explicaciones a demanda)
+db.results.createIndex(
+    { "anomalies.anomaly_id": 1 },
+    { 
+        name: "idx_anomaly_id",
+        background: true 
+    }
+);
+print("✅ Índice 'idx_anomaly_id' creado");
+
 // Índice de texto para búsquedas en anomalías
 db.results.createIndex(
     { "anomalies.log_entry": "text", "anomalies.explanation": "text" },
@@ -4,16 +4,30 @@ import re
 import math
 import logging
 import asyncio
+import time
+from itertools import islice
 from datetime import datetime
-from typing import List, Dict, Any, Optional
-import pandas as pd
+from typing import List, Dict, Any, Optional, Set, Tuple
 import numpy as np
 from fastapi import FastAPI, HTTPException, UploadFile, File
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
 from sklearn.ensemble import IsolationForest
-import requests
+
+from services.model_registry import model_registry, ModelRegistry
+from services.template_miner import TemplateMiner, template_groups
+from services.pattern_matcher import pattern_matcher
+from services.log_parser import log_parser
+from services.line_dedup import LineGroups, collapse_lines, MAX_LINE_NUMBERS
+from services.top_k import TopK, top_k_store
+from services.ollama_client import ollama_client, OllamaError, CircuitOpenError
+from services.explanation_cache import explanation_cache
+from services.llm_controller import llm_controller
+from services.sampled_detection import SampledDetector, detect_sampled, iter_file_lines
+from services.parallel_executor import parallel_executor, run_blocking
+from config.settings import load_settings
 
 # Configurar logging
 logging.basicConfig(
@@ -40,8 +54,9 @@ app.add_middleware(
 logger = logging.getLogger("anomaly_detector")
 
 # Configuración
-OLLAMA_SERVICE_URL = os.getenv("OLLAMA_SERVICE_URL", "http://ollama-service:11434")
 MODEL_NAME = os.getenv("MODEL_NAME", "qwen2.5:3b")
+# Versión del prompt de clasificación (cambiarla invalida las explicaciones en caché)
+ALERT_PROMPT_VERSION = "alert-v1"
 
 # Directorios base
 APP_DIR = "/app"
@@ -78,6 +93,9 @@ class AnomalyResult(BaseModel):
     anomaly_score: float
     is_anomaly: bool
     explanation: str
+    fields: Optional[Dict[str, Any]] = None
+    count: int = 1  # Veces que aparece la línea (tras enmascarar valores variables)
+    positions: Optional[List[int]] = None  # Índices de esas líneas (como mucho MAX_LINE_NUMBERS)
 
 class ChunkInfo(BaseModel):
     filename: str
@@ -86,6 +104,7 @@ class ChunkInfo(BaseModel):
 class DetectionResponse(BaseModel):
     total_logs: int
     anomalies_detected: int
+    unique_anomalies: Optional[int] = None
     anomalies: List[AnomalyResult]
     report_file: str
     chunk_info: Optional[ChunkInfo] = None
@@ -120,9 +139,8 @@ def extract_features(log_text: str) -> List[float]:
     else:
         features.append(0)
     
-    # Presencia de palabras clave sospechosas
-    suspicious_keywords = ['error', 'failed', 'unauthorized', 'exception', 'timeout', 'denied', 'critical']
-    keyword_count = sum(1 for keyword in suspicious_keywords if keyword.lower() in log_text.lower())
+    # Presencia de palabras clave sospechosas (patterns.feature_keywords de config.yml)
+    keyword_count = pattern_matcher.count(pattern_matcher.match(log_text), 'feature_keywords')
     features.append(keyword_count)
     
     # Número de caracteres especiales
@@ -142,43 +160,145 @@ def extract_features(log_text: str) -> List[float]:
     
     return features
 
-def detect_anomalies(log_entries: List[str]) -> tuple:
-    """Detecta anomalías usando Isolation Forest"""
+def mine_templates(log_entries: List[str], miner: Optional[TemplateMiner] = None) -> List[int]:
+    """Asigna un ID de plantilla (Drain) a cada log del lote (el enmascarado se reparte entre procesos)"""
+    miner = miner if miner is not None else TemplateMiner()
+    return miner.add_lines(log_entries, parallel_executor.mask_lines(log_entries))
+
+def analyze_logs(log_entries: List[str], model_key: Optional[str] = None) -> tuple:
+    """Agrupación de repetidos, minado de plantillas y detección (bloqueante: se ejecuta fuera del event loop)
+    
+    Todo se calcula una vez por línea única (tras enmascarar); template_ids,
+    etiquetas y scores son por línea única y groups relaciona cada una con sus logs.
+    
+    Returns:
+        (minero, groups, líneas únicas, template_ids, etiquetas, scores)
+    """
+    miner = TemplateMiner()
+    masked_lines = parallel_executor.mask_lines(log_entries)
+    groups = collapse_lines(log_entries, masked_lines)
+    unique_entries = groups.select(log_entries)
+    logger.info(f"{len(log_entries)} logs agrupados en {len(unique_entries)} líneas únicas")
+    template_ids = miner.add_lines(unique_entries, groups.select(masked_lines), groups.counts)
+    anomaly_labels, anomaly_scores = detect_anomalies(unique_entries, model_key, template_ids, groups.counts)
+    return miner, groups, unique_entries, template_ids, anomaly_labels, anomaly_scores
+
+def remove_spool(path: str):
+    """Borra el archivo temporal de /detect-large (puede haberlo borrado ya otra ruta)"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def template_summary(miner: TemplateMiner, counts: Optional[Dict[int, int]] = None) -> List[Dict[str, Any]]:
+    """Plantillas con su número de logs, de más a menos frecuente (para el reporte)
+    
+    counts reemplaza los conteos del minero (p. ej. los de la fase 1 de /detect-large).
+    """
+    sizes = {c.cluster_id: c.size for c in miner.clusters.values()} if counts is None else counts
+    clusters = sorted((c for c in miner.clusters.values() if c.cluster_id in sizes),
+                      key=lambda c: sizes[c.cluster_id], reverse=True)
+    return [{"template_id": c.cluster_id, "template": c.template, "count": sizes[c.cluster_id]} for c in clusters]
+
+def template_features(log_entries: List[str], template_ids: Optional[List[int]] = None,
+                      weights: Optional[np.ndarray] = None) -> tuple:
+    """Matriz de características con una fila por plantilla (más su rareza) e índice inverso por log
+    
+    weights indica cuántas veces aparece cada log (líneas repetidas agrupadas) y
+    se usa para la rareza. Con menos de 2 plantillas se devuelve una fila por log.
+    """
+    if template_ids is None:
+        template_ids = mine_templates(log_entries)
+    unique_ids, first_index, inverse, counts = template_groups(template_ids)
+    total = len(log_entries)
+    if weights is not None:
+        counts = np.bincount(inverse, weights=weights)
+        total = float(np.sum(weights))
+    if len(unique_ids) >= 2:
+        rows = first_index
+        rarity = np.log(total / counts)
+    else:
+        rows = np.arange(len(log_entries))
+        inverse = rows
+        rarity = np.zeros(len(log_entries))
+    
+    features_matrix = parallel_executor.extract_features([log_entries[i] for i in rows])
+    return np.column_stack([features_matrix, rarity]).astype(np.float32), inverse
+
+def detect_anomalies(log_entries: List[str], model_key: Optional[str] = None,
+                     template_ids: Optional[List[int]] = None, weights: Optional[np.ndarray] = None) -> tuple:
+    """Detecta anomalías usando Isolation Forest
+    
+    Se puntúa una vez por plantilla (su primer log), con la rareza de la
+    plantilla como característica adicional, y el resultado se asigna a todos
+    los logs de esa plantilla. Con menos de 2 plantillas se puntúa cada log.
+    weights son las repeticiones de cada log cuando llegan ya agrupados.
+    
+    Si se indica model_key y ya hay un modelo registrado para esa fuente, solo se
+    puntúa con él; si no, se entrena uno nuevo y se guarda en el registro.
+    """
     logger.info("=== Iniciando Detección de Anomalías ===")
     logger.info(f"Procesando {len(log_entries)} logs")
     
-    if len(log_entries) < 2:
-        logger.warning("Insuficientes logs para análisis (mínimo 2 requeridos)")
+    if not log_entries:
+        logger.warning("No hay logs para analizar")
         return [], []
     
-    # Extraer características
+    sample_size = load_settings()["anomaly_detection"]["sample_size"]
+    if len(log_entries) > sample_size:
+        # Entrada muy grande: ajuste sobre una muestra y puntuación por bloques
+        logger.info(f"Modo muestreo: ajuste sobre {sample_size} logs de {len(log_entries)}")
+        anomaly_labels, anomaly_scores = detect_sampled(lambda: log_entries, model_key,
+                                                        template_ids=template_ids, weights=weights)
+        logger.info(f"- Anomalías detectadas: {int(np.sum(anomaly_labels == -1))}")
+        logger.info("=== Fin de Detección de Anomalías ===")
+        return anomaly_labels, anomaly_scores
+    
+    # Extraer características (vectorizado por lotes, una fila por plantilla)
     logger.info("Extrayendo características de los logs...")
-    features_matrix = []
-    for i, log_entry in enumerate(log_entries, 1):
-        features = extract_features(log_entry)
-        features_matrix.append(features)
-        
-        # Mostrar progreso cada 1000 logs
-        if i % 1000 == 0:
-            logger.info(f"Procesados {i}/{len(log_entries)} logs")
-    
-    # Convertir a DataFrame
-    df = pd.DataFrame(features_matrix)
-    
-    # Entrenar Isolation Forest
-    logger.info("Entrenando modelo Isolation Forest...")
-    logger.info("Configuración del modelo:")
-    logger.info("- Contaminación esperada: 10%")
-    logger.info("- Número de estimadores: 100")
-    
-    isolation_forest = IsolationForest(
-        contamination=0.1,  # 10% de anomalías esperadas
-        random_state=42,
-        n_estimators=100
-    )
+    extraction_start = time.time()
+    features_matrix, inverse = template_features(log_entries, template_ids, weights)
+    logger.info(f"Características extraídas en {time.time() - extraction_start:.2f}s "
+                f"({features_matrix.shape[0]} filas para {len(log_entries)} logs)")
     
-    anomaly_labels = isolation_forest.fit_predict(df)
-    anomaly_scores = isolation_forest.decision_function(df)
+    if model_key and model_registry.has_model(model_key, features_matrix.shape[1]):
+        # Camino rápido: el modelo de esta fuente ya está entrenado
+        if len(features_matrix) >= parallel_executor.min_lines:
+            # Muchas filas (pocas repeticiones de plantilla): puntuar por fragmentos en el pool
+            _, version = model_registry.load_compiled(model_key)
+            anomaly_scores = parallel_executor.score_registered(model_key, version, features_matrix)
+            anomaly_labels = np.where(anomaly_scores < 0, -1, 1)
+        else:
+            anomaly_labels, anomaly_scores, version = model_registry.score(model_key, features_matrix)
+        logger.info(f"Puntuando con modelo registrado {model_key} v{version} (sin reentrenar)")
+    else:
+        if features_matrix.shape[0] < 2:
+            logger.warning("Insuficientes logs para análisis (mínimo 2 requeridos)")
+            return [], []
+        
+        # Entrenar Isolation Forest
+        logger.info("Entrenando modelo Isolation Forest...")
+        logger.info("Configuración del modelo:")
+        logger.info("- Contaminación esperada: 10%")
+        logger.info("- Número de estimadores: 100")
+        
+        if model_key:
+            version = model_registry.fit(model_key, features_matrix)
+            anomaly_labels, anomaly_scores, _ = model_registry.score(model_key, features_matrix, version)
+        else:
+            isolation_forest = IsolationForest(
+                contamination=0.1,  # 10% de anomalías esperadas
+                random_state=42,
+                n_estimators=100,
+                n_jobs=parallel_executor.n_jobs
+            )
+            
+            anomaly_labels = isolation_forest.fit_predict(features_matrix)
+            anomaly_scores = isolation_forest.decision_function(features_matrix)
+    
+    # Asignar el resultado de cada plantilla a todos sus logs
+    anomaly_labels = np.asarray(anomaly_labels)[inverse]
+    anomaly_scores = np.asarray(anomaly_scores)[inverse]
     
     # Análisis de resultados
     n_anomalies = sum(1 for label in anomaly_labels if label == -1)
@@ -194,26 +314,42 @@ def detect_anomalies(log_entries: List[str]) -> tuple:
     
     return anomaly_labels, anomaly_scores
 
-async def get_llm_explanation(log_entry: str) -> str:
-    """Obtiene explicación del LLM para un log anómalo"""
+LOG_FIELD_LABELS = {
+    "timestamp": "Timestamp",
+    "level": "Nivel",
+    "ip": "IP",
+    "user": "Usuario",
+    "method": "Método",
+    "path": "Ruta",
+    "status": "Código",
+    "bytes": "Bytes"
+}
+
+async def get_llm_explanation(log_entry: str, fields: Optional[Dict[str, Any]] = None) -> str:
+    """Obtiene explicación del LLM para un log anómalo
+    
+    fields son los campos ya parseados del log (si no se indican se parsea la línea).
+    """
     try:
         logger.info("=== Análisis de Log Sospechoso ===")
         logger.debug(f"Log a analizar: {log_entry}")
         
-        # Extraer información básica del log
-        components = log_entry.split()
-        log_info = {
-            "Servidor": components[0] if len(components) > 0 else 'N/A',
-            "IP": components[1] if len(components) > 1 else 'N/A',
-            "Método": components[6].strip('\"') if len(components) > 6 else 'N/A',
-            "Ruta": components[7] if len(components) > 7 else 'N/A',
-            "Código": components[9] if len(components) > 9 else 'N/A'
-        }
+        # Logs que solo difieren en IPs, números, timestamps o IDs reutilizan la explicación
+        cached = await explanation_cache.get(log_entry, MODEL_NAME, ALERT_PROMPT_VERSION)
+        if cached is not None:
+            logger.info("Explicación obtenida de la caché")
+            return cached
+        
+        # Extraer información básica del log (parser estructurado)
+        if fields is None:
+            fields = log_parser.parse_line(log_entry)
+        log_info = {label: fields.get(field) for field, label in LOG_FIELD_LABELS.items() if fields.get(field) is not None}
         
         logger.info("Componentes del log:")
         for key, value in log_info.items():
             logger.info(f"- {key}: {value}")
         
+        fields_text = "\n        ".join(f"{key}: {value}" for key, value in log_info.items())
         prompt = f"""Analiza este log y clasifica la anomalía.
         REGLAS ESTRICTAS:
         1. Usa SOLO estos tipos de alerta: [ACCESO_INVÁLIDO], [ERROR_AUTENTICACIÓN], [COMPORTAMIENTO_INUSUAL], [RUTA_SOSPECHOSA], [MÉTODO_INCORRECTO]
@@ -221,67 +357,55 @@ async def get_llm_explanation(log_entry: str) -> str:
         3. Sigue EXACTAMENTE este formato: [TIPO_ALERTA] - [EXPLICACIÓN CORTA]
         
         Log: {log_entry}
+        {fields_text}
         """
         
         logger.debug("Prompt enviado al LLM:")
         logger.debug(prompt)
         
-        payload = {
-            "model": MODEL_NAME,
-            "prompt": prompt,
-            "stream": False,
-            "options": {
-                "temperature": 0.3  # Reducimos temperatura para respuestas más concisas
-            }
-        }
+        # Cliente asíncrono compartido: la espera del modelo no bloquea el event loop
+        try:
+            explanation = await ollama_client.generate(
+                prompt, MODEL_NAME,
+                options={"temperature": 0.3},  # Reducimos temperatura para respuestas más concisas
+                timeout=30
+            )
+        except CircuitOpenError as e:
+            # Sin esperar el timeout: el LLM está caído o saturado
+            return f"LLM no disponible temporalmente (se reintenta en {e.retry_in:.0f}s)"
+        except OllamaError as e:
+            error_msg = f"Error al conectar con LLM: {e.status_code}"
+            print(f"\nError: {error_msg}")
+            return error_msg
+        if explanation:
+            await explanation_cache.set(log_entry, MODEL_NAME, ALERT_PROMPT_VERSION, explanation)
+        explanation = explanation or "No se pudo generar explicación"
         
-        response = requests.post(
-            f"{OLLAMA_SERVICE_URL}/generate",
-            json=payload,
-            timeout=30
-        )
+        logger.info("Respuesta del LLM:")
+        logger.info(explanation)
         
-        if response.status_code == 200:
-            result = response.json()
-            explanation = result.get("response", "No se pudo generar explicación")
+        # Analizar la respuesta
+        if '[' in explanation and ']' in explanation:
+            alert_type = explanation.split(']')[0].strip('[')
+            logger.info(f"Tipo de alerta identificada: {alert_type}")
             
-            logger.info("Respuesta del LLM:")
-            logger.info(explanation)
+            # Evaluar severidad basada en palabras clave (patterns.severity de config.yml)
+            severity_hits = pattern_matcher.match(explanation)
+            severity = pattern_matcher.first_group(severity_hits, 'severity') or 'DESCONOCIDO'
             
-            # Analizar la respuesta
-            if '[' in explanation and ']' in explanation:
-                alert_type = explanation.split(']')[0].strip('[')
-                logger.info(f"Tipo de alerta identificada: {alert_type}")
-                
-                # Evaluar severidad basada en palabras clave
-                severity_keywords = {
-                    'CRÍTICO': ['unauthorized', 'attack', 'breach', 'exploit', 'injection'],
-                    'ALTO': ['error', 'failed', 'invalid', 'denied', 'timeout'],
-                    'MEDIO': ['warning', 'retry', 'degraded', 'slow'],
-                    'BAJO': ['notice', 'info', 'debug']
-                }
-                
-                severity = 'DESCONOCIDO'
-                for level, keywords in severity_keywords.items():
-                    if any(keyword in explanation.lower() for keyword in keywords):
-                        severity = level
-                        break
-                
-                logger.info(f"Nivel de severidad estimado: {severity}")
-                
-                # Log detallado para debugging
-                logger.debug("Detalles del análisis:", extra={
-                    'alert_type': alert_type,
-                    'severity': severity,
-                    'keywords_found': [k for k in sum(severity_keywords.values(), []) if k in explanation.lower()]
-                })
+            logger.info(f"Nivel de severidad estimado: {severity}")
             
-            logger.info("=== Fin del Análisis ===")
-            return explanation
-        else:
-            error_msg = f"Error al conectar con LLM: {response.status_code}"
-            print(f"\nError: {error_msg}")
-            return error_msg
+            # Log detallado para debugging
+            logger.debug("Detalles del análisis:", extra={
+                'alert_type': alert_type,
+                'severity': severity,
+                'keywords_found': sorted(set().union(*(
+                    patterns for group, patterns in severity_hits.items() if group.startswith('severity.')
+                )))
+            })
+        
+        logger.info("=== Fin del Análisis ===")
+        return explanation
             
     except Exception as e:
         return f"Error al obtener explicación del LLM: {str(e)}"
@@ -372,42 +496,118 @@ async def list_reports():
     logger.info(f"Total de reportes encontrados: {len(reports)}")
     return reports
 
+def best_template_scores(anomaly_indices: List[int], anomaly_scores, template_ids: List[int]) -> Dict[int, float]:
+    """Score más bajo de cada plantilla anómala, de la más a la menos anómala"""
+    best: Dict[int, float] = {}
+    for i in anomaly_indices:
+        if template_ids[i] not in best or anomaly_scores[i] < best[template_ids[i]]:
+            best[template_ids[i]] = float(anomaly_scores[i])
+    return dict(sorted(best.items(), key=lambda item: item[1]))
+
+async def select_explained_templates(anomaly_indices: List[int], anomaly_scores, template_ids: List[int],
+                                     miner: TemplateMiner, job_id: Optional[str] = None) -> Set[int]:
+    """Plantillas que se explican con el LLM: las top_k más anómalas
+    
+    Con job_id (chunks de /detect de un mismo archivo) el top-K y el presupuesto
+    de top_k explicaciones son los del job en Redis (TopKStore), compartidos
+    entre peticiones. Los IDs de plantilla cambian en cada petición, así que el
+    miembro en Redis es el texto de la plantilla.
+    """
+    top_k = load_settings()["anomaly_detection"].get("top_k", 100)
+    candidates = list(best_template_scores(anomaly_indices, anomaly_scores, template_ids).items())[:top_k]
+    if job_id is None or not candidates:
+        return {template_id for template_id, _ in candidates}
+    
+    members = {}
+    for template_id, score in candidates:
+        members.setdefault(miner.template(template_id), (template_id, score))
+    admitted = await top_k_store.add(job_id, {member: score for member, (_, score) in members.items()}, top_k)
+    chosen = [member for member in members if admitted is None or member in admitted]
+    allowed = await top_k_store.reserve(job_id, chosen, top_k)
+    # Sin Redis cada petición usa su propio top-K
+    return {members[member][0] for member in (chosen if allowed is None else allowed)}
+
+async def explain_concurrently(items: Dict[Any, Tuple[str, Dict[str, Any]]]) -> Dict[Any, str]:
+    """Explicación de cada (log, campos) en lotes simultáneos del tamaño que fija el controlador adaptativo"""
+    explanations = {}
+    keys = list(items)
+    while keys:
+        batch, keys = keys[:max(1, llm_controller.concurrency)], keys[max(1, llm_controller.concurrency):]
+        results = await asyncio.gather(*(get_llm_explanation(*items[key]) for key in batch))
+        explanations.update(zip(batch, results))
+    return explanations
+
 async def process_anomalies_batch(log_entries: List[str], anomaly_indices: List[int], 
                                anomaly_scores: List[float], batch_start: int, 
-                               batch_size: int, file_id: str) -> Dict:
-    """Procesa un lote de anomalías y retorna los resultados"""
+                               batch_size: int, file_id: str,
+                               template_ids: Optional[List[int]] = None,
+                               template_explanations: Optional[Dict[int, str]] = None,
+                               templates: Optional[List[Dict[str, Any]]] = None,
+                               groups: Optional[LineGroups] = None,
+                               explain_keys: Optional[Set] = None) -> Dict:
+    """Procesa un lote de anomalías y retorna los resultados
+    
+    Con template_ids, el LLM se consulta una sola vez por plantilla y las
+    explicaciones se reutilizan (template_explanations) entre lotes. Con groups,
+    log_entries son líneas únicas y cada resultado lleva su conteo y posiciones.
+    Con explain_keys solo esas plantillas (el top-K) consultan al LLM; el resto
+    usa la explicación de su plantilla si existe.
+    """
     batch_end = min(batch_start + batch_size, len(anomaly_indices))
     batch_indices = anomaly_indices[batch_start:batch_end]
+    if template_explanations is None:
+        template_explanations = {}
+    
+    def explanation_key(idx: int):
+        return template_ids[idx] if template_ids is not None else ("log", idx)
+    
+    # Campos estructurados (formato detectado una vez por archivo)
+    parsed = log_parser.parse([log_entries[idx] for idx in batch_indices], source=file_id)
+    batch_fields = [parsed.row(i) for i in range(len(batch_indices))]
     
-    # Crear tareas para el lote actual
-    batch_tasks = []
-    for idx in batch_indices:
-        batch_tasks.append(get_llm_explanation(log_entries[idx]))
+    # Crear tareas para el lote actual (una por plantilla aún sin explicar, solo dentro del top)
+    pending = {}
+    for idx, fields in zip(batch_indices, batch_fields):
+        key = explanation_key(idx)
+        if explain_keys is not None and key not in explain_keys:
+            continue
+        if key not in template_explanations and key not in pending:
+            pending[key] = get_llm_explanation(log_entries[idx], fields)
     
     # Procesar explicaciones en paralelo
-    batch_explanations = await asyncio.gather(*batch_tasks)
+    pending_explanations = await asyncio.gather(*pending.values())
+    template_explanations.update(zip(pending.keys(), pending_explanations))
+    batch_explanations = [template_explanations.get(explanation_key(idx), "") for idx in batch_indices]
     
     # Crear resultados del lote
     batch_anomalies = []
-    for idx, explanation in zip(batch_indices, batch_explanations):
+    for idx, explanation, fields in zip(batch_indices, batch_explanations, batch_fields):
         anomaly_result = AnomalyResult(
             log_entry=log_entries[idx],
             anomaly_score=float(anomaly_scores[idx]),
             is_anomaly=True,
-            explanation=explanation
+            explanation=explanation,
+            fields=fields
         )
+        if groups is not None:
+            anomaly_result.count = int(groups.counts[idx])
+            anomaly_result.positions = groups.positions(idx, MAX_LINE_NUMBERS)
         batch_anomalies.append(anomaly_result)
     
     # Crear respuesta parcial
     progress = min(100, (batch_end / len(anomaly_indices)) * 100)
     response_data = {
-        "total_logs": len(log_entries),
-        "anomalies_detected": len(anomaly_indices),
+        "total_logs": groups.total if groups is not None else len(log_entries),
+        "anomalies_detected": int(groups.counts[anomaly_indices].sum()) if groups is not None else len(anomaly_indices),
+        "unique_anomalies": len(anomaly_indices),
         "anomalies": [anomaly.dict() for anomaly in batch_anomalies],
         "processed_percentage": progress,
         "is_complete": batch_end >= len(anomaly_indices),
         "timestamp": datetime.now().isoformat()
     }
+    if templates is not None and batch_start == 0:
+        # Conteo por plantilla, solo en el primer lote
+        response_data["templates"] = templates
     
     # Guardar reporte parcial
     report_file = save_report(response_data, file_id)
@@ -458,11 +658,16 @@ async def detect_anomalies_endpoint(file: UploadFile = File(...)):
         if not log_entries:
             raise HTTPException(status_code=400, detail="El archivo no contiene logs válidos")
         
-        # Detectar anomalías
-        anomaly_labels, anomaly_scores = detect_anomalies(log_entries)
+        # Detectar anomalías (todos los chunks del archivo comparten modelo)
+        model_key = ModelRegistry.key_for_filename(file_id)
+        log_parser.format_for(log_entries, file_id)  # Formato del archivo, detectado una vez
+        miner, groups, unique_entries, template_ids, anomaly_labels, anomaly_scores = await run_blocking(
+            analyze_logs, log_entries, model_key
+        )
         
-        # Identificar índices de anomalías
-        anomaly_indices = [i for i, label in enumerate(anomaly_labels) if label == -1]
+        # Identificar índices de anomalías (por línea única), de la más a la menos anómala
+        anomaly_indices = sorted((i for i, label in enumerate(anomaly_labels) if label == -1),
+                                 key=lambda i: anomaly_scores[i])
         
         if not anomaly_indices:
             return DetectionResponse(
@@ -473,14 +678,22 @@ async def detect_anomalies_endpoint(file: UploadFile = File(...)):
                 chunk_info={"filename": filename, "file_id": file_id}
             )
         
-        # Configuración de procesamiento por lotes
-        BATCH_SIZE = 5  # Procesar 5 anomalías a la vez
+        template_explanations: Dict[int, str] = {}
+        templates = template_summary(miner)
+        # Top-K y presupuesto de explicaciones del archivo completo, no de este chunk
+        explain_keys = await select_explained_templates(anomaly_indices, anomaly_scores, template_ids, miner,
+                                                        job_id=file_id)
         
         async def generate_results():
-            for batch_start in range(0, len(anomaly_indices), BATCH_SIZE):
+            batch_start = 0
+            while batch_start < len(anomaly_indices):
+                # Una llamada al LLM por anomalía: el lote sigue la concurrencia del controlador adaptativo
+                batch_size = llm_controller.concurrency
                 batch_results = await process_anomalies_batch(
-                    log_entries, anomaly_indices, anomaly_scores,
-                    batch_start, BATCH_SIZE, file_id
+                    unique_entries, anomaly_indices, anomaly_scores,
+                    batch_start, batch_size, file_id,
+                    template_ids, template_explanations, templates, groups,
+                    explain_keys=explain_keys
                 )
                 
                 # Agregar información del chunk
@@ -492,6 +705,8 @@ async def detect_anomalies_endpoint(file: UploadFile = File(...)):
                 # Enviar resultados parciales
                 yield json.dumps(batch_results) + "\n"
                 
+                batch_start += batch_size
+                
                 # Pequeña pausa para permitir que nginx procese
                 await asyncio.sleep(0.1)
         
@@ -504,9 +719,11 @@ async def detect_anomalies_endpoint(file: UploadFile = File(...)):
         raise HTTPException(status_code=500, detail=f"Error procesando logs: {str(e)}")
 
 @app.post("/detect-text", response_model=DetectionResponse)
-async def detect_anomalies_from_text(logs: List[LogEntry]):
+async def detect_anomalies_from_text(logs: List[LogEntry], source: Optional[str] = None):
     """
     Detecta anomalías en una lista de logs enviados como JSON
+    
+    Si se indica `source`, se reutiliza el modelo registrado para esa fuente.
     """
     try:
         if not logs:
@@ -516,26 +733,46 @@ async def detect_anomalies_from_text(logs: List[LogEntry]):
         log_entries = [log.content for log in logs]
         
         # Detectar anomalías
-        anomaly_labels, anomaly_scores = detect_anomalies(log_entries)
+        model_key = ModelRegistry.key_for_filename(source) if source else None
+        miner, groups, unique_entries, template_ids, anomaly_labels, anomaly_scores = await run_blocking(
+            analyze_logs, log_entries, model_key
+        )
         
-        # Procesar resultados
+        # Procesar resultados (uno por línea única, de la más a la menos anómala); el LLM se
+        # consulta una vez por plantilla y solo para las top_k más anómalas de la petición
         anomalies = []
-        for i, (log_entry, label, score) in enumerate(zip(log_entries, anomaly_labels, anomaly_scores)):
-            if label == -1:  # Anomalía detectada
-                explanation = await get_llm_explanation(log_entry)
-                anomaly_result = AnomalyResult(
-                    log_entry=log_entry,
-                    anomaly_score=float(score),
-                    is_anomaly=True,
-                    explanation=explanation
-                )
-                anomalies.append(anomaly_result)
+        anomaly_indices = sorted((i for i, label in enumerate(anomaly_labels) if label == -1),
+                                 key=lambda i: anomaly_scores[i])
+        explain_keys = await select_explained_templates(anomaly_indices, anomaly_scores, template_ids, miner)
+        # Formato detectado con el inicio de la entrada completa, no solo con las anomalías
+        log_format = log_parser.format_for(log_entries, source)
+        parsed = log_parser.parse([unique_entries[i] for i in anomaly_indices], log_format=log_format)
+        pending = {}
+        for position, i in enumerate(anomaly_indices):
+            if template_ids[i] in explain_keys and template_ids[i] not in pending:
+                pending[template_ids[i]] = (unique_entries[i], parsed.row(position))
+        template_explanations = await explain_concurrently(pending)
+        for position, i in enumerate(anomaly_indices):
+            log_entry, score, fields = unique_entries[i], anomaly_scores[i], parsed.row(position)
+            explanation = template_explanations.get(template_ids[i], "")
+            anomaly_result = AnomalyResult(
+                log_entry=log_entry,
+                anomaly_score=float(score),
+                is_anomaly=True,
+                explanation=explanation,
+                fields=fields,
+                count=int(groups.counts[i]),
+                positions=groups.positions(i, MAX_LINE_NUMBERS)
+            )
+            anomalies.append(anomaly_result)
         
         # Crear respuesta
         response_data = {
             "total_logs": len(log_entries),
-            "anomalies_detected": len(anomalies),
+            "anomalies_detected": sum(anomaly.count for anomaly in anomalies),
+            "unique_anomalies": len(anomalies),
             "anomalies": [anomaly.dict() for anomaly in anomalies],
+            "templates": template_summary(miner),
             "timestamp": datetime.now().isoformat()
         }
         
@@ -548,6 +785,189 @@ async def detect_anomalies_from_text(logs: List[LogEntry]):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error procesando logs: {str(e)}")
 
+@app.post("/detect-large")
+async def detect_anomalies_large(file: UploadFile = File(...), explain: bool = True,
+                                 sample_size: Optional[int] = None, block_size: Optional[int] = None):
+    """
+    Detecta anomalías en archivos muy grandes en dos fases
+    
+    El archivo se copia a disco por partes; la primera pasada toma una muestra
+    de reservorio y ajusta el modelo, la segunda puntúa por bloques y envía
+    cada bloque (NDJSON) al terminarlo. La memoria depende del tamaño de bloque.
+    Con `explain`, el LLM se consulta una vez por plantilla anómala.
+    """
+    filename = file.filename or "upload.log"
+    file_id = filename.split('_chunk')[0] if '_chunk' in filename else filename
+    os.makedirs(CHUNKS_DIR, exist_ok=True)
+    spool_path = os.path.join(CHUNKS_DIR, f"large_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}_{os.path.basename(filename)}")
+    
+    try:
+        with open(spool_path, 'wb') as f:
+            while True:
+                data = await file.read(8 * 1024 * 1024)
+                if not data:
+                    break
+                f.write(data)
+        
+        detector = SampledDetector(sample_size=sample_size, block_size=block_size)
+        source = lambda: iter_file_lines(spool_path)
+        model_key = ModelRegistry.key_for_filename(file_id)
+        await run_blocking(detector.fit, source, model_key)
+    except ValueError as e:
+        remove_spool(spool_path)
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        remove_spool(spool_path)
+        raise HTTPException(status_code=500, detail=f"Error procesando logs: {str(e)}")
+    
+    async def generate_results():
+        # Leer el archivo también bloquea: fuera del event loop como el resto de los pasos
+        await run_blocking(lambda: log_parser.format_for(list(islice(source(), log_parser.sample_size)), file_id))
+        blocks = detector.score_blocks(source)
+        template_explanations: Dict[int, str] = {}
+        # Top-K de plantillas entre bloques y presupuesto de top_k explicaciones para todo el archivo
+        top_k = load_settings()["anomaly_detection"].get("top_k", 100)
+        top = TopK(top_k)
+        total_anomalies = 0
+        try:
+            while True:
+                # Cada bloque se puntúa fuera del event loop
+                item = await run_blocking(next, blocks, None)
+                if item is None:
+                    break
+                block_start, block, labels, scores, template_ids = item
+                
+                anomalies = []
+                anomaly_offsets = np.flatnonzero(labels == -1).tolist()
+                parsed = log_parser.parse([block[offset] for offset in anomaly_offsets], source=file_id)
+                if explain:
+                    # Log más anómalo de cada plantilla del bloque (posición en anomaly_offsets)
+                    strongest: Dict[int, int] = {}
+                    for position, offset in enumerate(anomaly_offsets):
+                        current = strongest.get(template_ids[offset])
+                        if current is None or scores[offset] < scores[anomaly_offsets[current]]:
+                            strongest[template_ids[offset]] = position
+                    pending = {}
+                    by_score = sorted(strongest.items(), key=lambda item: scores[anomaly_offsets[item[1]]])
+                    for template_id, position in by_score:
+                        # Solo las que entran al top-K visto hasta ahora y mientras quede presupuesto
+                        if (top.push(template_id, float(scores[anomaly_offsets[position]]))
+                                and template_id not in template_explanations
+                                and len(template_explanations) + len(pending) < top_k):
+                            pending[template_id] = (block[anomaly_offsets[position]], parsed.row(position))
+                    template_explanations.update(await explain_concurrently(pending))
+                for position, offset in enumerate(anomaly_offsets):
+                    template_id = template_ids[offset]
+                    fields = parsed.row(position)
+                    anomalies.append({
+                        **AnomalyResult(
+                            log_entry=block[offset],
+                            anomaly_score=float(scores[offset]),
+                            is_anomaly=True,
+                            explanation=template_explanations.get(template_id, ""),
+                            fields=fields
+                        ).dict(),
+                        "line_number": block_start + offset + 1,
+                        "template_id": template_id
+                    })
+                total_anomalies += len(anomalies)
+                processed = block_start + len(block)
+                
+                yield json.dumps({
+                    "total_logs": detector.total_lines,
+                    "block_start": block_start,
+                    "block_size": len(block),
+                    "anomalies_detected": len(anomalies),
+                    "anomalies": anomalies,
+                    "processed_percentage": min(100, processed / max(detector.total_lines, 1) * 100),
+                    "is_complete": False,
+                    "timestamp": datetime.now().isoformat()
+                }) + "\n"
+            
+            # Resumen final (sin anomalías, ya enviadas por bloque)
+            summary = {
+                "total_logs": detector.total_lines,
+                "anomalies_detected": total_anomalies,
+                "sample_size": detector.sample_size,
+                "model_key": detector.model_key,
+                "model_version": detector.model_version,
+                "templates": template_summary(detector.miner, detector.template_counts),
+                "processed_percentage": 100,
+                "is_complete": True,
+                "timestamp": datetime.now().isoformat()
+            }
+            summary["report_file"] = save_report(summary, file_id)
+            yield json.dumps(summary) + "\n"
+        finally:
+            remove_spool(spool_path)
+    
+    # La tarea de fondo borra el archivo aunque el cliente se desconecte antes de leer la respuesta
+    return StreamingResponse(generate_results(), media_type="application/x-ndjson",
+                             background=BackgroundTask(remove_spool, spool_path))
+
+# === REGISTRO DE MODELOS ===
+
+@app.post("/models/{model_key}/fit")
+async def fit_model(model_key: str, logs: List[LogEntry]):
+    """Entrena una nueva versión del modelo para una fuente de logs"""
+    log_entries = [log.content for log in logs if log.content.strip()]
+    if len(log_entries) < 2:
+        raise HTTPException(status_code=400, detail="Se requieren al menos 2 logs para entrenar")
+    
+    try:
+        features_matrix, _ = template_features(log_entries)
+        version = model_registry.fit(model_key, features_matrix)
+        return {"model_key": model_key, "version": version, "n_samples": len(log_entries)}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error entrenando modelo {model_key}: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/models/{model_key}/load")
+async def load_model(model_key: str, version: Optional[int] = None):
+    """Carga un modelo en memoria (última versión por defecto)"""
+    try:
+        _, loaded_version = model_registry.load(model_key, version)
+        return {"model_key": model_key, "version": loaded_version}
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.post("/models/{model_key}/score")
+async def score_with_model(model_key: str, logs: List[LogEntry], version: Optional[int] = None):
+    """Puntúa logs con un modelo registrado, sin reentrenar"""
+    log_entries = [log.content for log in logs]
+    if not log_entries:
+        raise HTTPException(status_code=400, detail="No se proporcionaron logs")
+    
+    try:
+        features_matrix, inverse = template_features(log_entries)
+        anomaly_labels, anomaly_scores, used_version = model_registry.score(model_key, features_matrix, version)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    anomaly_labels, anomaly_scores = anomaly_labels[inverse], anomaly_scores[inverse]
+    
+    return {
+        "model_key": model_key,
+        "version": used_version,
+        "results": [
+            {"log_entry": entry, "anomaly_score": float(score), "is_anomaly": bool(label == -1)}
+            for entry, label, score in zip(log_entries, anomaly_labels, anomaly_scores)
+        ]
+    }
+
+@app.get("/models/{model_key}/versions")
+async def list_model_versions(model_key: str):
+    """Lista las versiones registradas de un modelo"""
+    try:
+        return model_registry.versions(model_key)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 # === IMPORTS ADICIONALES PARA V2 ===
 import uuid
 import sys
@@ -567,6 +987,11 @@ try:
     from services.chunk_service import chunk_service
     from services.worker_service import worker_service
     from services.monitoring_service import monitoring_service
+    from services.explanation_service import explanation_service
+    from services.explanation_scheduler import explanation_scheduler
+    from services.reexplain_queue import reexplain_queue
+    from services.circuit_breaker import llm_breaker
+    from services.anomaly_clusters import anomaly_clusterer
     V2_AVAILABLE = True
     logger.info("✅ Módulos V2 cargados correctamente")
 except ImportError as e:
@@ -586,6 +1011,8 @@ except ImportError as e:
 @app.on_event("startup")
 async def startup_event():
     """Inicializar conexiones a bases de datos"""
+    # Salud de las réplicas de Ollama y precarga de modelos (también para los endpoints V1)
+    ollama_client.start_maintenance()
     if V2_AVAILABLE:
         try:
             await db_manager.connect_all()
@@ -604,9 +1031,12 @@ async def startup_event():
 @app.on_event("shutdown")
 async def shutdown_event():
     """Cerrar conexiones a bases de datos"""
+    await ollama_client.close()
     if V2_AVAILABLE and db_manager:
-        # Detener servicio de monitoreo
+        # Detener servicio de monitoreo y consumidores de explicaciones
         monitoring_service.stop_monitoring()
+        await explanation_scheduler.stop()
+        await reexplain_queue.stop()
         
         if db_manager.mongodb_client:
             db_manager.mongodb_client.close()
@@ -619,8 +1049,12 @@ async def shutdown_event():
 
 if V2_AVAILABLE:  # Solo registrar endpoints V2 si los módulos están disponibles
     @app.post("/v2/process", response_model=ProcessResponseV2)
-    async def process_file_v2(file: UploadFile = File(...)):
-        """Procesar archivo usando arquitectura multi-DB (un archivo a la vez)"""
+    async def process_file_v2(file: UploadFile = File(...), explain: bool = True):
+        """Procesar archivo usando arquitectura multi-DB (un archivo a la vez)
+        
+        Con explain=false el job solo detecta y guarda las anomalías (sin LLM);
+        cada explicación se genera al pedirla en /v2/anomalies/{id}/explanation.
+        """
         try:
             # Verificar si ya hay un archivo procesándose
             if worker_service.current_processing_job:
@@ -639,7 +1073,7 @@ if V2_AVAILABLE:  # Solo registrar endpoints V2 si los módulos están disponibl
             
             # Iniciar procesamiento asíncrono
             logger.info(f"🚀 Iniciando procesamiento asíncrono para {file_id}")
-            task = asyncio.create_task(worker_service.process_file_async(file_id))
+            task = asyncio.create_task(worker_service.process_file_async(file_id, explain=explain))
             logger.info(f"📋 Tarea de procesamiento creada: {task}")
             
             # Actualizar estado a processing
@@ -654,8 +1088,9 @@ if V2_AVAILABLE:  # Solo registrar endpoints V2 si los módulos están disponibl
             return ProcessResponseV2(
                 job_id=file_id,
                 status=ProcessingStatus.PROCESSING,
-                message="Procesamiento iniciado",
-                total_chunks=len(file_content.split('\n')) // 1000  # Estimación
+                message="Procesamiento iniciado" if explain else "Procesamiento iniciado (solo detección)",
+                total_chunks=len(file_content.split('\n')) // 1000,  # Estimación
+                explain=explain
             )
             
         except Exception as e:
@@ -706,7 +1141,11 @@ if V2_AVAILABLE:  # Solo registrar endpoints V2 si los módulos están disponibl
 
     @app.get("/v2/results/{job_id}/stream")
     async def stream_results_v2(job_id: str):
-        """Stream de resultados en tiempo real usando Redis Pub/Sub"""
+        """Stream de resultados en tiempo real usando Redis Pub/Sub
+        
+        Incluye las explicaciones token a token (explanation_delta), la final de
+        cada plantilla (explanation_completed) y el cierre (explanations_ready).
+        """
         async def generate():
             try:
                 # Suscribirse al canal de Redis para este job
@@ -716,7 +1155,7 @@ if V2_AVAILABLE:  # Solo registrar endpoints V2 si los módulos están disponibl
                 logger.info(f"Iniciando stream para job {job_id}")
                 
                 # Enviar evento inicial
-                yield f"data: {{'type': 'stream_started', 'job_id': '{job_id}'}}\n\n"
+                yield f"data: {json.dumps({'type': 'stream_started', 'job_id': job_id})}\n\n"
                 
                 # Escuchar eventos del stream
                 async for message in pubsub.listen():
@@ -742,7 +1181,21 @@ if V2_AVAILABLE:  # Solo registrar endpoints V2 si los módulos están disponibl
                 logger.error(f"Error en stream: {e}")
                 yield f"data: {{'type': 'error', 'message': '{str(e)}'}}\n\n"
         
-        return StreamingResponse(generate(), media_type="text/plain")
+        # Sin caché ni buffer en el proxy: cada token llega al cliente en cuanto se publica
+        return StreamingResponse(generate(), media_type="text/plain",
+                                 headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    @app.get("/v2/anomalies/{anomaly_id}/explanation")
+    async def get_anomaly_explanation_v2(anomaly_id: str):
+        """Explicación de una anomalía; si aún no tiene, se genera con el LLM y queda guardada"""
+        try:
+            result = await worker_service.explain_anomaly(anomaly_id)
+        except Exception as e:
+            logger.error(f"Error explicando anomalía {anomaly_id}: {e}")
+            raise HTTPException(status_code=500, detail=str(e))
+        if result is None:
+            raise HTTPException(status_code=404, detail="Anomalía no encontrada")
+        return result
 
     @app.post("/v2/cancel/{job_id}")
     async def cancel_job_v2(job_id: str):
@@ -755,6 +1208,9 @@ if V2_AVAILABLE:  # Solo registrar endpoints V2 si los módulos están disponibl
                     WHERE id = $3
                 """, ProcessingStatus.CANCELLED, datetime.utcnow(), job_id)
             
+            # Las explicaciones aún en cola del job ya no se generan
+            explanation_scheduler.cancel(job_id)
+            
             return {"message": "Procesamiento cancelado", "job_id": job_id}
             
         except Exception as e:
@@ -870,6 +1326,17 @@ if V2_AVAILABLE:  # Solo registrar endpoints V2 si los módulos están disponibl
                 "history": history,
                 "alerts": alerts,
                 "summary": summary,
+                "llm": {
+                    **llm_controller.stats(),
+                    "in_flight": ollama_client.in_flight,
+                    "endpoints": ollama_client.endpoint_stats(),
+                    "batch_parsing": explanation_service.batch_stats(),
+                    "routing": explanation_service.model_router.stats(),
+                    "scheduler": explanation_scheduler.stats(),
+                    "circuit_breaker": llm_breaker.stats(),
+                    "clustering": anomaly_clusterer.stats(),
+                    "reexplain": {**reexplain_queue.stats(), "pending": await reexplain_queue.size()}
+                },
                 "timestamp": datetime.utcnow().isoformat()
             }
         except Exception as e:
@@ -2,6 +2,7 @@ from pydantic import BaseModel, Field
 from typing import List, Optional, Dict, Any
 from datetime import datetime
 from enum import Enum
+import uuid
 
 class ProcessingStatus(str, Enum):
     PENDING = "pending"
@@ -38,14 +39,23 @@ class ProcessingStats(BaseModel):
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
 class AnomalyResultV2(BaseModel):
+    anomaly_id: str = Field(default_factory=lambda: uuid.uuid4().hex)
     log_entry: str
     score: float  # Cambiado de anomaly_score a score
     is_anomaly: bool
     explanation: str
     chunk_id: str
+    template_id: Optional[int] = None
+    template: Optional[str] = None
+    fields: Optional[Dict[str, Any]] = None  # timestamp, level, ip, user, method, path, status, bytes
+    count: int = 1  # Apariciones de la línea en el chunk (tras enmascarar valores variables)
+    positions: Optional[List[int]] = None  # Líneas del chunk donde aparece (como mucho 100)
+    cluster_id: Optional[int] = None  # Plantilla representante de su grupo de anomalías parecidas
+    cluster_similarity: Optional[float] = None  # Similitud coseno con el representante (1.0 si lo es)
 
 class ChunkResult(BaseModel):
     chunk_id: str
+    job_id: Optional[str] = None
     anomalies: List[AnomalyResultV2]
     processing_time: float
     created_at: datetime = Field(default_factory=datetime.utcnow)
@@ -56,6 +66,7 @@ class ProcessResponseV2(BaseModel):
     message: str
     total_chunks: int
     estimated_time: Optional[int] = None
+    explain: bool = True  # False: solo detección, explicaciones a demanda
 
 class StatusResponseV2(BaseModel):
     job_id: str
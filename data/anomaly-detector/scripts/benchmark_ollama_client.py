@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Benchmark: respuesta del event loop con explicaciones del LLM en curso
+
+Compara la llamada bloqueante anterior (requests.post dentro de una corrutina)
+con el cliente asíncrono compartido (services/ollama_client.py), usando un
+Ollama falso local que tarda --delay segundos por generación. Mientras las
+explicaciones están en curso, una tarea mide cada 10 ms el retraso del loop
+(lo mismo que sufren /health, los streams SSE y el monitoreo).
+
+Uso:
+    python scripts/benchmark_ollama_client.py
+    python scripts/benchmark_ollama_client.py --calls 50 --delay 0.2 --concurrency 4
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+import numpy as np
+import requests
+
+# Agregar el directorio del servicio al path para importaciones
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+if parent_dir not in sys.path:
+    sys.path.insert(0, parent_dir)
+
+from services.ollama_client import OllamaClient
+from fake_ollama import FakeOllamaSettings, start_in_thread
+
+TICK = 0.01
+
+def start_fake_ollama(delay: float) -> str:
+    """Levanta el Ollama falso (scripts/fake_ollama.py) en otro hilo y devuelve su URL"""
+    url, _ = start_in_thread(FakeOllamaSettings(latency=f"fixed:{delay}", response_format="text"))
+    return url
+
+async def blocking_explanation(url: str, prompt: str) -> str:
+    """Implementación anterior: requests.post bloquea el loop durante toda la generación"""
+    response = requests.post(f"{url}/api/generate", json={"model": "test", "prompt": prompt, "stream": False}, timeout=30)
+    return response.json()["response"]
+
+async def measure(calls: int, make_call) -> dict:
+    """Lanza calls explicaciones con gather y mide el retraso del loop mientras terminan"""
+    lags = []
+    done = asyncio.Event()
+
+    async def ticker():
+        while not done.is_set():
+            expected = time.perf_counter() + TICK
+            await asyncio.sleep(TICK)
+            lags.append(max(0.0, time.perf_counter() - expected))
+
+    ticker_task = asyncio.create_task(ticker())
+    await asyncio.sleep(TICK)
+    start = time.perf_counter()
+    await asyncio.gather(*(make_call(f"log {i}") for i in range(calls)))
+    elapsed = time.perf_counter() - start
+    done.set()
+    await ticker_task
+
+    lags = np.array(lags or [0.0]) * 1000
+    return {"total": elapsed, "ticks": len(lags), "p50": np.percentile(lags, 50),
+            "p99": np.percentile(lags, 99), "max": lags.max()}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=50, help="Explicaciones en curso a la vez")
+    parser.add_argument("--delay", type=float, default=0.2, help="Segundos por generación del Ollama falso")
+    parser.add_argument("--concurrency", type=int, default=4, help="max_concurrency del cliente asíncrono")
+    args = parser.parse_args()
+
+    url = start_fake_ollama(args.delay)
+    client = OllamaClient(base_url=url, max_concurrency=args.concurrency, max_connections=args.concurrency)
+
+    async def run_all():
+        results = {
+            "requests.post (anterior)": await measure(args.calls, lambda p: blocking_explanation(url, p)),
+            f"OllamaClient (concurrencia {args.concurrency})": await measure(
+                args.calls, lambda p: client.generate(p, "test")
+            ),
+        }
+        await client.close()
+        return results
+
+    print(f"{args.calls} explicaciones, {args.delay:.2f}s por generación, tick de {TICK * 1000:.0f} ms")
+    print(f"{'Cliente':<30} {'Total (s)':>10} {'Ticks':>7} {'Lag p50 (ms)':>13} {'Lag p99 (ms)':>13} {'Lag máx (ms)':>13}")
+    for name, r in asyncio.run(run_all()).items():
+        print(f"{name:<30} {r['total']:>10.2f} {r['ticks']:>7} {r['p50']:>13.1f} {r['p99']:>13.1f} {r['max']:>13.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Benchmark: CompiledForest vs IsolationForest.decision_function
+
+Uso:
+    python scripts/benchmark_tree_scorer.py
+    python scripts/benchmark_tree_scorer.py --sizes 1000,100000 --noise 0.5
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+from sklearn.ensemble import IsolationForest
+
+# Agregar el directorio del servicio al path para importaciones
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+if parent_dir not in sys.path:
+    sys.path.insert(0, parent_dir)
+
+from services.feature_extractor import extract_features_batch
+from services.tree_scorer import CompiledForest
+
+DEFAULT_LOGS = os.path.join(current_dir, "test_data", "logs_normal_1mb.txt")
+
+def timed(func, repeat: int = 3) -> float:
+    """Mejor tiempo (segundos) de varias ejecuciones"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def score_in_batches(scorer, X: np.ndarray, batch_size: int):
+    """Puntúa la matriz en lotes pequeños, como los workers"""
+    for start in range(0, X.shape[0], batch_size):
+        scorer(X[start:start + batch_size])
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del scorer compilado de Isolation Forest")
+    parser.add_argument("--logs", default=DEFAULT_LOGS, help="Archivo de logs base")
+    parser.add_argument("--sizes", default="1000,100000,10000000", help="Filas a puntuar, separadas por coma")
+    parser.add_argument("--noise", type=float, default=0.0,
+                        help="Ruido gaussiano añadido a las características (0 = filas repetidas como en logs reales)")
+    parser.add_argument("--batch-sizes", default="50,100", help="Tamaños de lote pequeños a medir")
+    parser.add_argument("--batch-rows", type=int, default=20000, help="Filas totales para la medición por lotes")
+    args = parser.parse_args()
+
+    with open(args.logs, "r", encoding="utf-8") as f:
+        lines = [line.strip() for line in f if line.strip()]
+
+    base = extract_features_batch(lines)
+    model = IsolationForest(contamination=0.1, random_state=42, n_estimators=100).fit(base)
+    compiled = CompiledForest.from_isolation_forest(model)
+    rng = np.random.default_rng(42)
+
+    print(f"Modelo: {compiled.n_trees} árboles, profundidad {compiled.max_depth}, {len(lines)} logs base")
+    print(f"{'filas':>10} {'sklearn (s)':>12} {'compilado (s)':>14} {'speedup':>8} {'max |diff|':>11}")
+
+    for size in (int(s) for s in args.sizes.split(",")):
+        X = base[rng.integers(0, len(base), size)]
+        if args.noise:
+            X = X + rng.normal(0, args.noise, X.shape).astype(np.float32)
+
+        repeat = 3 if size <= 100000 else 1
+        sklearn_time = timed(lambda: model.decision_function(X), repeat)
+        compiled_time = timed(lambda: compiled.decision_function(X), repeat)
+        max_diff = np.abs(model.decision_function(X) - compiled.decision_function(X)).max() if size <= 100000 else float("nan")
+
+        print(f"{size:>10} {sklearn_time:>12.3f} {compiled_time:>14.3f} {sklearn_time / compiled_time:>7.1f}x {max_diff:>11.2e}")
+
+    print(f"\nLotes pequeños ({args.batch_rows} filas en total):")
+    print(f"{'lote':>10} {'sklearn (s)':>12} {'compilado (s)':>14} {'speedup':>8}")
+    X = base[rng.integers(0, len(base), args.batch_rows)]
+    for batch_size in (int(s) for s in args.batch_sizes.split(",")):
+        sklearn_time = timed(lambda: score_in_batches(model.decision_function, X, batch_size), 1)
+        compiled_time = timed(lambda: score_in_batches(compiled.decision_function, X, batch_size), 1)
+        print(f"{batch_size:>10} {sklearn_time:>12.3f} {compiled_time:>14.3f} {sklearn_time / compiled_time:>7.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+"""
+Ollama falso para benchmarks reproducibles del camino de explicaciones
+
+Implementa /api/generate (con y sin streaming NDJSON), /api/embeddings y
+/api/embed con latencias, tokens por segundo y tasas de error configurables,
+sin modelo ni GPU. Las respuestas son fijas: JSON por ID ([A1], [A2], ...)
+cuando el pedido trae format: json, "ANOMALÍA N: ..." o texto de alerta; los
+embeddings son vectores deterministas por palabras (textos parecidos dan
+vectores parecidos). Con --seed los tiempos y errores se repiten entre
+corridas.
+
+El servicio lo usa con OLLAMA_SERVICE_URL (o llm.service_url de config.yml);
+ExplanationService y main.py llaman a Ollama a través del cliente compartido
+(services/ollama_client.py), que toma esa URL.
+
+Uso:
+    python scripts/fake_ollama.py --port 11435 --latency lognormal:0.8,0.4 --tokens-per-second 40
+    python scripts/fake_ollama.py --port 11435 --error-rate 0.1 --hang-rate 0.05 --seed 7
+    OLLAMA_SERVICE_URL=http://127.0.0.1:11435 uvicorn main:app
+
+Latencias (tiempo hasta el primer token, en segundos):
+    fixed:0.5 | uniform:0.2,1.0 | normal:0.5,0.1 | lognormal:mu,sigma | exponential:0.5
+
+GET /fake/stats devuelve los pedidos atendidos; POST /fake/reset reinicia
+contadores y semilla.
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import re
+import threading
+import time
+import zlib
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+ITEM_ID_RE = re.compile(r'\[(A\d+)\]')
+ANOMALY_NUMBER_RE = re.compile(r'ANOMAL[IÍ]A\s+(\d+)', re.IGNORECASE)
+TOKEN_RE = re.compile(r'\S+\s*|\s+')
+WORD_RE = re.compile(r'[a-záéíóúñü]+')
+
+ALERT_RESPONSE = "[COMPORTAMIENTO_INUSUAL] - Actividad anómala detectada en el log"
+EXPLANATION = ("El log {item} muestra un comportamiento fuera de lo normal en el servicio. "
+               "Puede indicar una falla o un acceso no esperado. Conviene revisarlo antes de que afecte a los usuarios.")
+
+
+@dataclass
+class FakeOllamaSettings:
+    """Comportamiento del servidor falso"""
+    latency: str = "fixed:0"          # Tiempo hasta el primer token
+    tokens_per_second: float = 0.0    # Ritmo de generación (0: instantáneo)
+    error_rate: float = 0.0           # Probabilidad de responder error_status
+    error_status: int = 503
+    hang_rate: float = 0.0            # Probabilidad de tardar hang_seconds (modelo cargando)
+    hang_seconds: float = 60.0
+    response_format: str = "auto"     # auto | json | anomalia | text
+    embedding_dim: int = 64
+    model: str = "qwen2.5:3b"
+    seed: Optional[int] = None
+
+
+def parse_latency(spec: str) -> Callable[[random.Random], float]:
+    """Distribución de latencia a partir de "tipo:parámetros" (segundos, nunca negativa)"""
+    kind, _, raw = spec.partition(":")
+    params = [float(value) for value in raw.split(",") if value.strip()] if raw else []
+    samplers = {
+        "fixed": lambda rng: params[0] if params else 0.0,
+        "uniform": lambda rng: rng.uniform(params[0], params[1]),
+        "normal": lambda rng: rng.gauss(params[0], params[1]),
+        "lognormal": lambda rng: rng.lognormvariate(params[0], params[1]),
+        "exponential": lambda rng: rng.expovariate(1.0 / params[0]) if params[0] > 0 else 0.0,
+    }
+    if kind not in samplers:
+        raise ValueError(f"Distribución de latencia desconocida: {spec}")
+    sampler = samplers[kind]
+    sampler(random.Random(0))  # Valida la cantidad de parámetros al configurar
+    return lambda rng: max(0.0, sampler(rng))
+
+
+class FakeOllama:
+    """Estado del servidor falso: generador aleatorio con semilla y contadores"""
+
+    def __init__(self, settings: FakeOllamaSettings):
+        self.settings = settings
+        self.latency = parse_latency(settings.latency)
+        self.reset()
+
+    def reset(self):
+        self.rng = random.Random(self.settings.seed)
+        self.stats = {"generate": 0, "stream": 0, "embeddings": 0, "errors": 0, "hangs": 0,
+                      "prompt_tokens": 0, "response_tokens": 0, "items": 0}
+
+    def _fault(self) -> Tuple[float, bool]:
+        """Espera antes de responder y si el pedido termina en error"""
+        delay = self.latency(self.rng)
+        if self.rng.random() < self.settings.hang_rate:
+            self.stats["hangs"] += 1
+            delay += self.settings.hang_seconds
+        failed = self.rng.random() < self.settings.error_rate
+        if failed:
+            self.stats["errors"] += 1
+        return delay, failed
+
+    def _error(self) -> JSONResponse:
+        return JSONResponse({"error": "fake ollama: servidor sobrecargado"}, status_code=self.settings.error_status)
+
+    def answer(self, payload: Dict[str, Any]) -> str:
+        """Respuesta fija según el formato pedido y las anomalías del prompt"""
+        prompt = payload.get("prompt", "")
+        ids = list(dict.fromkeys(ITEM_ID_RE.findall(prompt)))
+        mode = self.settings.response_format
+        if mode == "auto":
+            mode = "json" if payload.get("format") == "json" else ("anomalia" if ids or ANOMALY_NUMBER_RE.search(prompt)
+                                                                   else "text")
+        if mode == "json":
+            items = ids or ["A1"]
+            self.stats["items"] += len(items)
+            return json.dumps({"explanations": [{"id": item, "explanation": EXPLANATION.format(item=item)}
+                                                for item in items]}, ensure_ascii=False)
+        if mode == "anomalia":
+            count = len(ids) or max([int(n) for n in ANOMALY_NUMBER_RE.findall(prompt)] or [1])
+            self.stats["items"] += count
+            return "\n\n".join(f"ANOMALÍA {n}: {EXPLANATION.format(item=n)}" for n in range(1, count + 1))
+        self.stats["items"] += 1
+        return ALERT_RESPONSE
+
+    def embed(self, text: str) -> List[float]:
+        """Vector determinista: palabras a posiciones por hash, normalizado (mismas palabras, mismo vector)"""
+        vector = [0.0] * self.settings.embedding_dim
+        for word in WORD_RE.findall(text.lower()):
+            digest = zlib.crc32(word.encode("utf-8"))
+            vector[digest % self.settings.embedding_dim] += 1.0 if digest & 0x80000000 else -1.0
+        norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+        return [value / norm for value in vector]
+
+    def _done(self, payload: Dict[str, Any], prompt_tokens: int, response_tokens: int, started: float) -> Dict:
+        return {
+            "model": payload.get("model", self.settings.model),
+            "created_at": datetime.utcnow().isoformat() + "Z",
+            "response": "",
+            "done": True,
+            "done_reason": "stop",
+            "prompt_eval_count": prompt_tokens,
+            "eval_count": response_tokens,
+            "total_duration": int((time.perf_counter() - started) * 1e9)
+        }
+
+    def app(self) -> FastAPI:
+        app = FastAPI(title="Fake Ollama")
+
+        @app.post("/api/generate")
+        async def generate(request: Request):
+            payload = await request.json()
+            started = time.perf_counter()
+            stream = payload.get("stream", True)  # Como Ollama: streaming salvo que se pida lo contrario
+            self.stats["stream" if stream else "generate"] += 1
+            delay, failed = self._fault()
+            if failed:
+                await asyncio.sleep(delay)
+                return self._error()
+
+            text = self.answer(payload)
+            tokens = TOKEN_RE.findall(text)
+            prompt_tokens = len(TOKEN_RE.findall(payload.get("prompt", "")))
+            self.stats["prompt_tokens"] += prompt_tokens
+            self.stats["response_tokens"] += len(tokens)
+            per_token = 1.0 / self.settings.tokens_per_second if self.settings.tokens_per_second > 0 else 0.0
+
+            if not stream:
+                await asyncio.sleep(delay + per_token * len(tokens))
+                return {**self._done(payload, prompt_tokens, len(tokens), started), "response": text}
+
+            async def body():
+                await asyncio.sleep(delay)
+                for token in tokens:
+                    if per_token:
+                        await asyncio.sleep(per_token)
+                    yield json.dumps({"model": payload.get("model", self.settings.model), "response": token,
+                                      "done": False}, ensure_ascii=False) + "\n"
+                yield json.dumps(self._done(payload, prompt_tokens, len(tokens), started)) + "\n"
+
+            return StreamingResponse(body(), media_type="application/x-ndjson")
+
+        @app.post("/api/embeddings")
+        async def embeddings(request: Request):
+            payload = await request.json()
+            self.stats["embeddings"] += 1
+            delay, failed = self._fault()
+            await asyncio.sleep(delay)
+            if failed:
+                return self._error()
+            return {"embedding": self.embed(payload.get("prompt", ""))}
+
+        @app.post("/api/embed")
+        async def embed(request: Request):
+            payload = await request.json()
+            inputs = payload.get("input", "")
+            inputs = [inputs] if isinstance(inputs, str) else list(inputs)
+            self.stats["embeddings"] += len(inputs)
+            delay, failed = self._fault()
+            await asyncio.sleep(delay)
+            if failed:
+                return self._error()
+            return {"model": payload.get("model", self.settings.model),
+                    "embeddings": [self.embed(text) for text in inputs]}
+
+        @app.get("/api/tags")
+        async def tags():
+            return {"models": [{"name": self.settings.model, "model": self.settings.model}]}
+
+        @app.get("/fake/stats")
+        async def stats():
+            return {"settings": asdict(self.settings), "stats": dict(self.stats)}
+
+        @app.post("/fake/reset")
+        async def reset():
+            self.reset()
+            return {"ok": True}
+
+        return app
+
+
+def start_in_thread(settings: Optional[FakeOllamaSettings] = None, host: str = "127.0.0.1",
+                    port: int = 0) -> Tuple[str, uvicorn.Server]:
+    """Levanta el servidor falso en otro hilo y devuelve su URL y el servidor (server.should_exit = True lo detiene)"""
+    server = uvicorn.Server(uvicorn.Config(FakeOllama(settings or FakeOllamaSettings()).app(), host=host, port=port,
+                                           log_level="warning", loop="asyncio"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    bound_port = server.servers[0].sockets[0].getsockname()[1]
+    return f"http://{host}:{bound_port}", server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--latency", default="fixed:0", help="Distribución del tiempo hasta el primer token")
+    parser.add_argument("--tokens-per-second", type=float, default=0.0, help="Ritmo de generación (0: instantáneo)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Probabilidad de error por pedido")
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--hang-rate", type=float, default=0.0, help="Probabilidad de tardar --hang-seconds")
+    parser.add_argument("--hang-seconds", type=float, default=60.0)
+    parser.add_argument("--response-format", choices=["auto", "json", "anomalia", "text"], default="auto")
+    parser.add_argument("--embedding-dim", type=int, default=64)
+    parser.add_argument("--model", default="qwen2.5:3b")
+    parser.add_argument("--seed", type=int, default=None, help="Semilla de latencias y errores")
+    args = parser.parse_args()
+
+    settings = FakeOllamaSettings(
+        latency=args.latency, tokens_per_second=args.tokens_per_second, error_rate=args.error_rate,
+        error_status=args.error_status, hang_rate=args.hang_rate, hang_seconds=args.hang_seconds,
+        response_format=args.response_format, embedding_dim=args.embedding_dim, model=args.model, seed=args.seed
+    )
+    print(f"Ollama falso en http://{args.host}:{args.port} ({settings})")
+    uvicorn.run(FakeOllama(settings).app(), host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+"""
+Agrupación de anomalías por similitud de embeddings para explicar un representante por grupo
+"""
+import io
+import re
+import json
+import zlib
+import logging
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from config.settings import load_settings
+
+logger = logging.getLogger(__name__)
+
+# Marcadores de valores enmascarados (<NUM>, <IP>, <*>, ...): no aportan significado
+PLACEHOLDER_RE = re.compile(r'<[A-Z*]+>')
+WORD_RE = re.compile(r'[a-záéíóúñü][a-z0-9áéíóúñü]+')
+
+
+def hashing_embeddings(texts: Sequence[str], dimensions: int) -> np.ndarray:
+    """Embeddings locales por hashing de palabras y pares de palabras (filas con norma 1)
+
+    Dos líneas con las mismas palabras en el mismo orden dan el mismo vector;
+    las que comparten buena parte de ellas (la misma traza con otro ID, el
+    mismo escáner en otra ruta) quedan cerca en similitud coseno.
+    """
+    vectors = np.zeros((len(texts), dimensions), dtype=np.float32)
+    for row, text in enumerate(texts):
+        words = WORD_RE.findall(PLACEHOLDER_RE.sub(" ", text).lower())
+        features = [(word, 1.0) for word in words] + [(f"{a} {b}", 0.5) for a, b in zip(words, words[1:])]
+        for feature, weight in features:
+            digest = zlib.crc32(feature.encode("utf-8"))
+            vectors[row, digest % dimensions] += weight if digest & 0x80000000 else -weight
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1.0)
+
+
+class ClusterIndex:
+    """
+    Índice incremental de grupos de un job (agrupamiento por líder).
+
+    Guarda el embedding del representante de cada grupo. Una plantilla nueva
+    se compara por coseno con todos (un producto matriz-vector en NumPy): si
+    el más parecido supera el umbral entra a ese grupo con esa similitud; si
+    no, funda un grupo nuevo del que es representante. Las asignaciones no
+    cambian después, así una explicación ya copiada sigue siendo válida.
+    """
+
+    def __init__(self, threshold: float = 0.85, max_clusters: int = 5000, dimensions: Optional[int] = None):
+        self.threshold = threshold
+        self.max_clusters = max_clusters
+        self.dimensions = dimensions
+        self.vectors = np.zeros((0, dimensions or 0), dtype=np.float32)
+        self.representatives: List[int] = []                     # Plantilla representante por fila
+        self.assignments: Dict[int, Tuple[int, float]] = {}      # plantilla -> (representante, similitud)
+
+    def __len__(self) -> int:
+        return len(self.representatives)
+
+    def assign(self, template_ids: Sequence[int], vectors: np.ndarray) -> List[Tuple[int, float]]:
+        """Representante y similitud de cada plantilla, en orden (las ya vistas conservan su grupo)"""
+        if self.dimensions is None and len(template_ids):
+            self.dimensions = vectors.shape[1]
+            self.vectors = np.zeros((0, self.dimensions), dtype=np.float32)
+        result = []
+        for template_id, vector in zip(template_ids, vectors):
+            known = self.assignments.get(template_id)
+            if known is not None:
+                result.append(known)
+                continue
+            assignment = (template_id, 1.0)
+            if len(self.representatives):
+                similarities = self.vectors @ vector
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    assignment = (self.representatives[best], round(float(similarities[best]), 4))
+            if assignment[0] == template_id and len(self.representatives) < self.max_clusters:
+                self.vectors = np.vstack([self.vectors, vector[np.newaxis, :].astype(np.float32)])
+                self.representatives.append(template_id)
+            self.assignments[template_id] = assignment
+            result.append(assignment)
+        return result
+
+    def to_bytes(self) -> bytes:
+        buffer = io.BytesIO()
+        np.save(buffer, self.vectors, allow_pickle=False)
+        meta = json.dumps({
+            "threshold": self.threshold,
+            "max_clusters": self.max_clusters,
+            "dimensions": self.dimensions,
+            "representatives": self.representatives,
+            "assignments": [[t, r, s] for t, (r, s) in self.assignments.items()]
+        }).encode("utf-8")
+        return len(meta).to_bytes(4, "big") + meta + buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "ClusterIndex":
+        size = int.from_bytes(data[:4], "big")
+        meta = json.loads(data[4:4 + size])
+        index = cls(meta["threshold"], meta["max_clusters"], meta["dimensions"])
+        index.vectors = np.load(io.BytesIO(data[4 + size:]), allow_pickle=False)
+        index.representatives = meta["representatives"]
+        index.assignments = {t: (r, s) for t, r, s in meta["assignments"]}
+        return index
+
+
+class AnomalyClusterer:
+    """Calcula embeddings (hashing local u Ollama) y asigna grupos en el índice del job"""
+
+    def __init__(self):
+        config = load_settings().get("anomaly_clustering", {})
+        self.enabled = config.get("enabled", True)
+        self.embedder = config.get("embedder", "hashing")
+        self.embedding_model = config.get("embedding_model", "nomic-embed-text")
+        self.dimensions = config.get("dimensions", 256)
+        self.threshold = config.get("similarity_threshold", 0.85)
+        self.max_clusters = config.get("max_clusters", 5000)
+        self._counters = {"assigned": 0, "clustered": 0, "embedding_errors": 0}
+
+    def new_index(self) -> ClusterIndex:
+        return ClusterIndex(self.threshold, self.max_clusters)
+
+    async def embed(self, texts: List[str]) -> Optional[np.ndarray]:
+        """Embeddings con norma 1; None si Ollama no respondió (el chunk queda sin agrupar)"""
+        if self.embedder != "ollama":
+            return hashing_embeddings(texts, self.dimensions)
+        from services.ollama_client import ollama_client
+
+        try:
+            result = await ollama_client.request("/api/embed", {"model": self.embedding_model, "input": texts},
+                                                 items=len(texts))
+            vectors = np.asarray(result["embeddings"], dtype=np.float32)
+        except Exception as e:
+            logger.error(f"Error obteniendo embeddings de Ollama: {e}")
+            self._counters["embedding_errors"] += 1
+            return None
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms > 0, norms, 1.0)
+
+    async def assign(self, index: ClusterIndex, templates: Dict[int, str]) -> Dict[int, Tuple[int, float]]:
+        """Grupo (representante, similitud) de cada plantilla; templates va de la más a la menos anómala"""
+        new = [template_id for template_id in templates if template_id not in index.assignments]
+        vectors = await self.embed([templates[template_id] for template_id in new]) if new else None
+        if new and vectors is None:
+            return {template_id: index.assignments.get(template_id, (template_id, 1.0)) for template_id in templates}
+        if new:
+            index.assign(new, vectors)
+            self._counters["assigned"] += len(new)
+            self._counters["clustered"] += sum(index.assignments[t][0] != t for t in new)
+        return {template_id: index.assignments[template_id] for template_id in templates}
+
+    def stats(self) -> Dict:
+        return {"enabled": self.enabled, "embedder": self.embedder, "threshold": self.threshold, **self._counters}
+
+
+class AnomalyClusterStore:
+    """Persiste el índice de grupos de cada job en Redis entre chunks"""
+
+    def __init__(self, ttl: int = 86400):
+        self.ttl = ttl
+
+    @staticmethod
+    def _key(job_id: str) -> str:
+        return f"clusters:job:{job_id}"
+
+    async def load(self, job_id: str) -> ClusterIndex:
+        """Obtiene el índice del job o crea uno nuevo"""
+        from config.database import db_manager
+
+        try:
+            data = await db_manager.redis_client.get(self._key(job_id))
+            if data:
+                return ClusterIndex.from_bytes(data)
+        except Exception as e:
+            logger.error(f"Error cargando grupos del job {job_id}: {e}")
+        return anomaly_clusterer.new_index()
+
+    async def save(self, job_id: str, index: ClusterIndex):
+        """Guarda el índice de grupos del job"""
+        from config.database import db_manager
+
+        try:
+            await db_manager.redis_client.set(self._key(job_id), index.to_bytes(), ex=self.ttl)
+        except Exception as e:
+            logger.error(f"Error guardando grupos del job {job_id}: {e}")
+
+    async def delete(self, job_id: str):
+        """Elimina el índice de grupos del job"""
+        from config.database import db_manager
+
+        try:
+            await db_manager.redis_client.delete(self._key(job_id))
+        except Exception as e:
+            logger.error(f"Error eliminando grupos del job {job_id}: {e}")
+
+# Instancias globales
+anomaly_clusterer = AnomalyClusterer()
+anomaly_cluster_store = AnomalyClusterStore()
@@ -0,0 +1,193 @@
+"""
+Circuit breaker para dependencias lentas o caídas (el LLM): ventana de errores y latencia p95 con prueba semiabierta
+"""
+import time
+import logging
+import threading
+from collections import deque
+from datetime import datetime
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from config.settings import load_settings
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Recibe (estado anterior, estado nuevo, motivo, estadísticas de la ventana)
+TransitionListener = Callable[[str, str, str, Dict], None]
+
+
+class CircuitBreaker:
+    """
+    Corta las llamadas a una dependencia mientras falla o responde demasiado lento.
+
+    Cerrado: todas las llamadas pasan y cada una informa su latencia y si
+    terminó bien. Si en la ventana hay al menos min_calls llamadas y la tasa
+    de errores o la latencia p95 supera su umbral, el circuito se abre.
+    Abierto: las llamadas se rechazan al instante durante open_seconds.
+    Semiabierto: pasan como mucho half_open_probes llamadas de prueba; si
+    todas terminan bien el circuito se cierra (con la ventana vacía), si una
+    falla vuelve a abrirse.
+    """
+
+    def __init__(self, name: str, window_seconds: Optional[float] = None, min_calls: Optional[int] = None,
+                 error_rate: Optional[float] = None, latency_p95: Optional[float] = None,
+                 open_seconds: Optional[float] = None, half_open_probes: Optional[int] = None,
+                 enabled: Optional[bool] = None, clock: Callable[[], float] = time.monotonic):
+        config = load_settings().get("llm", {}).get("circuit_breaker", {})
+
+        def option(value, key, default):
+            return value if value is not None else config.get(key, default)
+
+        self.name = name
+        self.enabled = option(enabled, "enabled", True)
+        self.window_seconds = float(option(window_seconds, "window_seconds", 60.0))
+        self.min_calls = int(option(min_calls, "min_calls", 5))
+        self.error_rate = float(option(error_rate, "error_rate", 0.5))
+        self.latency_p95 = float(option(latency_p95, "latency_p95", 12.0))
+        self.open_seconds = float(option(open_seconds, "open_seconds", 30.0))
+        self.half_open_probes = int(option(half_open_probes, "half_open_probes", 1))
+        self.clock = clock
+
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probes = 0
+        self._probe_successes = 0
+        self._samples: Deque[Tuple[float, float, bool]] = deque()  # (fin, latencia, ok)
+        self._transitions: Deque[Dict] = deque(maxlen=50)
+        self._listeners: List[TransitionListener] = []
+        self._counters = {"rejected": 0, "opened": 0, "closed": 0}
+
+    def add_listener(self, listener: TransitionListener):
+        """Registra una función que se llama en cada cambio de estado"""
+        self._listeners.append(listener)
+
+    @property
+    def state(self) -> str:
+        """Estado actual; un circuito abierto pasa a semiabierto cuando vence open_seconds"""
+        with self._lock:
+            return self._current_state(self.clock())
+
+    def _current_state(self, now: float) -> str:
+        if self._state == OPEN and now - self._opened_at >= self.open_seconds:
+            self._transition(HALF_OPEN, f"{self.open_seconds:.0f}s abierto, se prueba la dependencia")
+        return self._state
+
+    def allow(self) -> bool:
+        """Indica si una llamada puede hacerse ahora (en semiabierto reserva una llamada de prueba)"""
+        if not self.enabled:
+            return True
+        with self._lock:
+            state = self._current_state(self.clock())
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and self._probes < self.half_open_probes:
+                self._probes += 1
+                return True
+            self._counters["rejected"] += 1
+            return False
+
+    def release(self):
+        """Libera la reserva de una llamada permitida que se abandonó sin resultado"""
+        with self._lock:
+            if self._state == HALF_OPEN and self._probes > 0:
+                self._probes -= 1
+
+    def record(self, latency: float, ok: bool):
+        """Resultado de una llamada permitida por allow()"""
+        if not self.enabled:
+            return
+        now = self.clock()
+        with self._lock:
+            state = self._current_state(now)
+            if state == HALF_OPEN:
+                if not ok or latency > self.latency_p95:
+                    self._open(now, "falló la llamada de prueba" if not ok
+                               else f"llamada de prueba lenta ({latency:.1f}s)")
+                    return
+                self._probe_successes += 1
+                if self._probe_successes >= self.half_open_probes:
+                    self._samples.clear()
+                    self._transition(CLOSED, "las llamadas de prueba respondieron bien")
+                return
+            if state == OPEN:
+                return  # Llamada que empezó antes de abrirse el circuito
+
+            self._samples.append((now, latency, ok))
+            self._trim(now)
+            if len(self._samples) < self.min_calls:
+                return
+            window = self._window()
+            if window["error_rate"] >= self.error_rate:
+                self._open(now, f"tasa de errores {window['error_rate']:.0%} (umbral {self.error_rate:.0%})")
+            elif window["latency_p95"] >= self.latency_p95:
+                self._open(now, f"latencia p95 {window['latency_p95']:.1f}s (umbral {self.latency_p95:.1f}s)")
+
+    def _trim(self, now: float):
+        while self._samples and now - self._samples[0][0] > self.window_seconds:
+            self._samples.popleft()
+
+    def _window(self) -> Dict:
+        if not self._samples:
+            return {"calls": 0, "error_rate": 0.0, "latency_p95": None}
+        latencies = np.array([latency for _, latency, _ in self._samples])
+        failures = sum(not ok for _, _, ok in self._samples)
+        return {
+            "calls": len(self._samples),
+            "error_rate": round(failures / len(self._samples), 4),
+            "latency_p95": round(float(np.percentile(latencies, 95)), 3)
+        }
+
+    def _open(self, now: float, reason: str):
+        self._opened_at = now
+        self._transition(OPEN, reason)
+
+    def _transition(self, state: str, reason: str):
+        previous, self._state = self._state, state
+        self._probes = 0
+        self._probe_successes = 0
+        if state == OPEN:
+            self._counters["opened"] += 1
+        elif state == CLOSED:
+            self._counters["closed"] += 1
+        window = self._window()
+        self._transitions.append({
+            "timestamp": datetime.utcnow().isoformat(),
+            "from": previous,
+            "to": state,
+            "reason": reason,
+            **window
+        })
+        logger.warning(f"Circuito {self.name}: {previous} -> {state} ({reason})")
+        for listener in self._listeners:
+            try:
+                listener(previous, state, reason, window)
+            except Exception as e:
+                logger.error(f"Error notificando cambio del circuito {self.name}: {e}")
+
+    def stats(self) -> Dict:
+        """Estado, ventana y últimas transiciones, para el dashboard de monitoreo"""
+        with self._lock:
+            now = self.clock()
+            state = self._current_state(now)
+            self._trim(now)
+            return {
+                "name": self.name,
+                "enabled": self.enabled,
+                "state": state,
+                "retry_in": round(max(self.open_seconds - (now - self._opened_at), 0.0), 1) if state == OPEN else 0.0,
+                "thresholds": {"error_rate": self.error_rate, "latency_p95": self.latency_p95,
+                               "min_calls": self.min_calls},
+                "window": {"seconds": self.window_seconds, **self._window()},
+                "totals": dict(self._counters),
+                "transitions": list(self._transitions)
+            }
+
+# Instancia global del circuito del LLM
+llm_breaker = CircuitBreaker("llm")
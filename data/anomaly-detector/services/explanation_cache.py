@@ -0,0 +1,159 @@
+"""
+Caché de explicaciones del LLM por plantilla de log (LRU en memoria + Redis con TTL)
+"""
+import re
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence
+
+from config.settings import load_settings
+from services.template_miner import mask_lines
+
+logger = logging.getLogger(__name__)
+
+_SPACES_RE = re.compile(r'\s+')
+
+
+def normalize_line(line: str) -> str:
+    """Línea con IPs, números, timestamps e IDs enmascarados (misma máscara que el minero de plantillas)"""
+    return _SPACES_RE.sub(" ", mask_lines([line])[0]).strip()
+
+
+class ExplanationCache:
+    """
+    Explicaciones ya generadas, indexadas por línea normalizada + modelo + versión del prompt.
+
+    Dos logs que solo difieren en IPs, números, timestamps o IDs comparten
+    explicación, así el LLM se consulta una vez por forma de log. La capa en
+    memoria es un LRU acotado por proceso; la de Redis se comparte entre
+    réplicas y workers y expira tras ttl segundos. Cambiar el prompt exige
+    cambiar su versión para no servir explicaciones del prompt anterior.
+    """
+
+    def __init__(self, max_entries: Optional[int] = None, ttl: Optional[int] = None):
+        config = load_settings().get("explanation_cache", {})
+        self.max_entries = max_entries if max_entries is not None else config.get("max_entries", 10000)
+        self.ttl = ttl if ttl is not None else config.get("ttl_seconds", 604800)
+        self._memory: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {"memory_hits": 0, "redis_hits": 0, "misses": 0, "stores": 0, "redis_errors": 0}
+
+    @staticmethod
+    def key(log_entry: str, model: str, prompt_version: str) -> str:
+        """Clave de Redis para la explicación de la línea con ese modelo y prompt"""
+        digest = hashlib.sha1(normalize_line(log_entry).encode("utf-8")).hexdigest()
+        return f"explanation:{model}:{prompt_version}:{digest}"
+
+    @staticmethod
+    def _redis():
+        try:
+            from config.database import db_manager
+        except Exception:
+            return None
+        return db_manager.redis_client
+
+    def _count(self, counter: str, amount: int = 1):
+        with self._lock:
+            self._counters[counter] += amount
+
+    def _remember(self, key: str, explanation: str):
+        with self._lock:
+            self._memory[key] = explanation
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def _recall(self, key: str) -> Optional[str]:
+        with self._lock:
+            explanation = self._memory.get(key)
+            if explanation is not None:
+                self._memory.move_to_end(key)
+            return explanation
+
+    async def get(self, log_entry: str, model: str, prompt_version: str) -> Optional[str]:
+        """Explicación guardada para la línea (None si no hay)"""
+        return (await self.get_many([log_entry], model, prompt_version))[0]
+
+    async def get_many(self, log_entries: Sequence[str], model: str, prompt_version: str) -> List[Optional[str]]:
+        """Explicaciones guardadas para cada línea (None en las que no hay); un solo MGET a Redis"""
+        keys = [self.key(entry, model, prompt_version) for entry in log_entries]
+        results: List[Optional[str]] = [self._recall(key) for key in keys]
+        memory_hits = sum(result is not None for result in results)
+        if memory_hits:
+            self._count("memory_hits", memory_hits)
+
+        pending = [i for i, result in enumerate(results) if result is None]
+        redis_client = self._redis()
+        if pending and redis_client is not None:
+            try:
+                values = await redis_client.mget([keys[i] for i in pending])
+            except Exception as e:
+                logger.error(f"Error leyendo caché de explicaciones: {e}")
+                self._count("redis_errors")
+                values = [None] * len(pending)
+            for i, value in zip(pending, values):
+                if value is not None:
+                    explanation = value.decode("utf-8") if isinstance(value, bytes) else value
+                    results[i] = explanation
+                    self._remember(keys[i], explanation)
+                    self._count("redis_hits")
+
+        misses = sum(result is None for result in results)
+        if misses:
+            self._count("misses", misses)
+        return results
+
+    async def set(self, log_entry: str, model: str, prompt_version: str, explanation: str):
+        """Guarda la explicación de una línea"""
+        await self.set_many([log_entry], model, prompt_version, [explanation])
+
+    async def set_many(self, log_entries: Sequence[str], model: str, prompt_version: str,
+                       explanations: Sequence[str]):
+        """Guarda explicaciones en ambas capas (las vacías se ignoran)"""
+        items: Dict[str, str] = {}
+        for entry, explanation in zip(log_entries, explanations):
+            if explanation:
+                items[self.key(entry, model, prompt_version)] = explanation
+        if not items:
+            return
+        for key, explanation in items.items():
+            self._remember(key, explanation)
+        self._count("stores", len(items))
+
+        redis_client = self._redis()
+        if redis_client is None:
+            return
+        try:
+            pipe = redis_client.pipeline()
+            for key, explanation in items.items():
+                pipe.set(key, explanation, ex=self.ttl)
+            await pipe.execute()
+        except Exception as e:
+            logger.error(f"Error guardando caché de explicaciones: {e}")
+            self._count("redis_errors")
+
+    def clear_memory(self):
+        """Vacía la capa en memoria (Redis se conserva)"""
+        with self._lock:
+            self._memory.clear()
+
+    def stats(self) -> Dict:
+        """Aciertos y fallos por capa, para los endpoints de monitoreo"""
+        with self._lock:
+            counters = dict(self._counters)
+            size = len(self._memory)
+        hits = counters["memory_hits"] + counters["redis_hits"]
+        lookups = hits + counters["misses"]
+        return {
+            **counters,
+            "hits": hits,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            "memory_entries": size,
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl
+        }
+
+# Instancia global de la caché
+explanation_cache = ExplanationCache()
@@ -0,0 +1,288 @@
+"""
+Planificador global de explicaciones: cola por severidad compartida entre chunks y jobs
+"""
+import heapq
+import asyncio
+import logging
+from collections import deque
+from dataclasses import dataclass, field
+from itertools import count
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from config.settings import load_settings
+from services.llm_controller import llm_controller
+from services.top_k import top_k_store
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ExplanationRequest:
+    """Una plantilla por explicar: su anomalía más fuerte y las anomalías guardadas que la comparten
+
+    members son otras plantillas del mismo grupo de anomalías parecidas, que
+    reciben la misma explicación.
+    """
+    job_id: str
+    template_id: int
+    log_entry: str
+    score: float
+    anomaly_ids: List[str] = field(default_factory=list)
+    members: List[int] = field(default_factory=list)
+
+    def template_ids(self) -> List[int]:
+        """Plantillas que reciben la explicación"""
+        return [self.template_id] + [member for member in self.members if member != self.template_id]
+
+
+# Recibe (job_id, lote) y devuelve las explicaciones por plantilla (ya guardadas y publicadas)
+ExplanationHandler = Callable[[str, List[ExplanationRequest]], Awaitable[Dict[int, str]]]
+
+
+class ExplanationScheduler:
+    """
+    Cola de prioridad de explicaciones alimentada por el worker a medida que
+    termina cada chunk y vaciada por un grupo fijo de consumidores.
+
+    Dentro de un job se explica primero la plantilla con el score más bajo,
+    esté donde esté en el archivo; los consumidores rotan entre los jobs con
+    trabajo pendiente para que uno grande no acapare el LLM.
+
+    La admisión de cada job es su top-K en Redis (TopKStore, compartido entre
+    workers): las plantillas que salen del top antes de explicarse se
+    descartan de la cola. Además cada job explica como mucho top_k plantillas
+    en total (explicadas más en curso): agotado ese presupuesto no se admiten
+    más, aunque sean más anómalas, y el gasto de LLM no crece con el archivo.
+    Si Redis no responde se admite todo y solo limita el presupuesto.
+    """
+
+    def __init__(self, consumers: Optional[int] = None, top_k: Optional[int] = None):
+        settings = load_settings()
+        self.consumers = consumers or settings.get("llm", {}).get("scheduler_consumers", llm_controller.max_concurrency)
+        self.top_k = top_k or settings.get("anomaly_detection", {}).get("top_k", 100)
+
+        self._heaps: Dict[str, List[Tuple[float, int, int]]] = {}
+        self._requests: Dict[str, Dict[int, ExplanationRequest]] = {}
+        self._spent: Dict[str, int] = {}  # Plantillas explicadas o en curso por job (presupuesto top_k)
+        self._explained: Dict[str, Dict[int, str]] = {}
+        self._in_flight: Dict[str, int] = {}
+        self._rotation: Deque[str] = deque()
+        self._seq = count()
+        self._handler: Optional[ExplanationHandler] = None
+        self._tasks: List[asyncio.Task] = []
+        self._condition: Optional[asyncio.Condition] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._counters = {"submitted": 0, "explained": 0, "dropped": 0, "batches": 0}
+
+    def start(self, handler: ExplanationHandler):
+        """Arranca los consumidores en el event loop actual (idempotente)"""
+        loop = asyncio.get_running_loop()
+        self._handler = handler
+        if self._loop is loop and self._tasks:
+            return
+        # Otro event loop (tests, reinicio del worker): se descarta el estado anterior
+        self._reset()
+        self._loop = loop
+        self._condition = asyncio.Condition()
+        self._tasks = [asyncio.create_task(self._consume()) for _ in range(self.consumers)]
+        logger.info(f"Planificador de explicaciones iniciado con {self.consumers} consumidores")
+
+    def _reset(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        self._heaps.clear()
+        self._requests.clear()
+        self._spent.clear()
+        self._explained.clear()
+        self._in_flight.clear()
+        self._rotation.clear()
+
+    async def stop(self):
+        """Detiene los consumidores (lo pendiente se descarta)"""
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._reset()
+        self._loop = None
+
+    def explained(self, job_id: str) -> Dict[int, str]:
+        """Explicaciones ya generadas para plantillas del job"""
+        return dict(self._explained.get(job_id, {}))
+
+    async def submit(self, job_id: str, requests: List[ExplanationRequest]) -> Dict[int, str]:
+        """Encola plantillas del job
+
+        Returns:
+            Explicaciones que ya existían para alguna de ellas (el llamador las
+            propaga a las anomalías recién guardadas; no se vuelven a encolar)
+        """
+        if self._condition is None:
+            raise RuntimeError("El planificador de explicaciones no está iniciado")
+        explained = self._explained.get(job_id, {})
+        candidates = {}
+        for request in requests:
+            if request.template_id not in explained:
+                key = str(request.template_id)
+                candidates[key] = min(request.score, candidates.get(key, request.score))
+        admitted = None
+        if candidates and self._spent.get(job_id, 0) < self.top_k:
+            admitted = await top_k_store.add(job_id, candidates, self.top_k)
+        
+        already = {}
+        async with self._condition:
+            explained = self._explained.setdefault(job_id, {})
+            queued = self._requests.setdefault(job_id, {})
+            heap = self._heaps.setdefault(job_id, [])
+            self._in_flight.setdefault(job_id, 0)
+            budget_left = self._spent.setdefault(job_id, 0) < self.top_k
+            for request in requests:
+                if request.template_id in explained:
+                    already[request.template_id] = explained[request.template_id]
+                    continue
+                current = queued.get(request.template_id)
+                if current is not None:
+                    # Plantilla ya en cola: suma sus anomalías y conserva la muestra más fuerte
+                    current.anomaly_ids.extend(request.anomaly_ids)
+                    current.members.extend(m for m in request.members if m not in current.members)
+                    if request.score >= current.score:
+                        continue
+                    current.log_entry, current.score = request.log_entry, request.score
+                elif budget_left and (admitted is None or str(request.template_id) in admitted):
+                    queued[request.template_id] = request
+                    self._counters["submitted"] += 1
+                else:
+                    self._counters["dropped"] += 1
+                    continue
+                heapq.heappush(heap, (request.score, next(self._seq), request.template_id))
+            if heap and job_id not in self._rotation:
+                self._rotation.append(job_id)
+            self._condition.notify_all()
+        return already
+
+    def _has_work(self) -> bool:
+        return bool(self._rotation)
+
+    def _take(self, size: int) -> Tuple[str, List[ExplanationRequest]]:
+        """Siguiente job en la rotación y hasta size de sus plantillas más anómalas
+
+        Las plantillas tomadas se descuentan del presupuesto del job; agotado,
+        lo que queda en cola se descarta.
+        """
+        job_id = self._rotation.popleft()
+        heap, queued = self._heaps[job_id], self._requests[job_id]
+        size = min(size, self.top_k - self._spent[job_id])
+        batch = []
+        while heap and len(batch) < size:
+            score, _, template_id = heapq.heappop(heap)
+            request = queued.get(template_id)
+            if request is None or request.score != score:
+                continue  # Entrada obsoleta (la plantilla mejoró su score o ya salió)
+            del queued[template_id]
+            batch.append(request)
+        self._spent[job_id] += len(batch)
+        if self._spent[job_id] >= self.top_k and queued:
+            self._counters["dropped"] += len(queued)
+            queued.clear()
+            heap.clear()
+        if heap:
+            self._rotation.append(job_id)
+        return job_id, batch
+
+    async def _consume(self):
+        while True:
+            async with self._condition:
+                await self._condition.wait_for(self._has_work)
+                job_id, batch = self._take(llm_controller.batch_size)
+                if not batch:
+                    self._condition.notify_all()
+                    continue
+                self._in_flight[job_id] += len(batch)
+            
+            # Las que salieron del top-K del job antes de explicarse se descartan y liberan su presupuesto
+            in_top = await top_k_store.contains(job_id, [str(request.template_id) for request in batch])
+            if in_top is not None and len(in_top) < len(batch):
+                evicted = [request for request in batch if str(request.template_id) not in in_top]
+                batch = [request for request in batch if str(request.template_id) in in_top]
+                async with self._condition:
+                    if job_id in self._in_flight:
+                        self._in_flight[job_id] -= len(evicted)
+                        self._spent[job_id] -= len(evicted)
+                    self._counters["dropped"] += len(evicted)
+                    self._condition.notify_all()
+                if not batch:
+                    continue
+
+            explanations = {}
+            try:
+                # Incluye las plantillas miembro de cada grupo
+                explanations = await self._handler(job_id, batch)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error explicando lote del job {job_id}: {e}")
+
+            async with self._condition:
+                if job_id in self._in_flight:
+                    self._in_flight[job_id] -= len(batch)
+                    self._explained[job_id].update(explanations)
+                self._counters["explained"] += len(explanations)
+                self._counters["batches"] += 1
+                self._condition.notify_all()
+
+    async def join(self, job_id: str) -> Dict[int, str]:
+        """Espera a que no queden plantillas del job en cola ni en curso y libera su estado
+
+        Returns:
+            Todas las explicaciones generadas para el job
+        """
+        if self._condition is None:
+            return {}
+        async with self._condition:
+            await self._condition.wait_for(
+                lambda: not self._requests.get(job_id) and not self._in_flight.get(job_id)
+            )
+            explanations = self._forget(job_id)
+        await top_k_store.delete(job_id)
+        return explanations
+
+    def cancel(self, job_id: str) -> int:
+        """Descarta lo pendiente del job (lo que está en curso termina); devuelve cuántas plantillas se descartaron"""
+        queued = self._requests.get(job_id, {})
+        dropped = len(queued)
+        queued.clear()
+        self._heaps.get(job_id, []).clear()
+        if job_id in self._rotation:
+            self._rotation.remove(job_id)
+        if self._condition is not None and self._loop is not None and self._loop.is_running():
+            self._loop.create_task(self._notify())
+        return dropped
+
+    async def _notify(self):
+        async with self._condition:
+            self._condition.notify_all()
+
+    def _forget(self, job_id: str) -> Dict[int, str]:
+        self._heaps.pop(job_id, None)
+        self._requests.pop(job_id, None)
+        self._spent.pop(job_id, None)
+        self._in_flight.pop(job_id, None)
+        if job_id in self._rotation:
+            self._rotation.remove(job_id)
+        return self._explained.pop(job_id, {})
+
+    def stats(self) -> Dict:
+        """Cola por job y totales, para el dashboard de monitoreo"""
+        return {
+            "consumers": len(self._tasks),
+            "jobs": {
+                job_id: {"queued": len(self._requests.get(job_id, {})), "in_flight": self._in_flight.get(job_id, 0),
+                         "explained": len(self._explained.get(job_id, {})), "budget_used": self._spent.get(job_id, 0)}
+                for job_id in self._requests
+            },
+            "totals": dict(self._counters)
+        }
+
+# Instancia global del planificador
+explanation_scheduler = ExplanationScheduler()
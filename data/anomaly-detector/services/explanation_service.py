@@ -3,20 +3,46 @@ Servicio para generar explicaciones inteligentes de anomalías usando LLM
 """
 import re
 import logging
-import requests
 import json
-from typing import Dict, List, Tuple
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
 from datetime import datetime
 import asyncio
+import time
+
+from services.pattern_matcher import pattern_matcher
+from services.log_parser import log_parser
+from services.ollama_client import ollama_client, OllamaError
+from services.explanation_cache import explanation_cache, normalize_line
+from services.prompt_packer import prompt_packer
+from services.model_router import ModelRouter, ModelTier
+from config.settings import load_settings
 
 logger = logging.getLogger(__name__)
 
+# Objeto de la respuesta JSON de un lote mientras se genera: {"id": "A1", "explanation": "texto parcial...
+PARTIAL_ITEM_RE = re.compile(r'\{\s*"id"\s*:\s*"([^"\\]+)"\s*,\s*"explanation"\s*:\s*"((?:[^"\\]|\\.)*)')
+PARTIAL_ESCAPE_RE = re.compile(r'\\u[0-9a-fA-F]{0,3}$')
+
+# Callback de streaming: (índice en el lote, fragmento nuevo, texto acumulado)
+PartialCallback = Callable[[int, str, str], Awaitable[None]]
+
 class ExplanationService:
     """Servicio para generar explicaciones inteligentes usando LLM"""
     
+    # Versiones de los prompts (cambiarlas invalida las explicaciones en caché)
+    PROMPT_VERSION = "intelligent-v1"
+    BATCH_PROMPT_VERSION = "batch-json-v1"
+    # Tokens por anomalía en el prompt además de su línea: "\n\n[A12] (Score: -0.123):\n"
+    BATCH_ITEM_OVERHEAD_TOKENS = 16
+    
     def __init__(self):
-        self.ollama_url = "http://ollama-service:11434/api/generate"
         self.model_name = "qwen2.5:3b"
+        # Modelo (o explicación por reglas) según la severidad de cada anomalía
+        self.model_router = ModelRouter(self.model_name)
+        # Pedidos de seguimiento para las anomalías que faltan en la respuesta de un lote
+        self.batch_retries = load_settings().get("llm", {}).get("batch_retries", 1)
+        self._batch_stats = {"calls": 0, "requested": 0, "parsed": 0, "retries": 0, "llm_seconds": 0.0,
+                             "deduplicated": 0, "truncated": 0}
     
     async def get_llm_explanation(self, log_entry: str, score: float) -> str:
         """Obtiene una explicación inteligente del LLM para un log anómalo"""
@@ -24,6 +50,11 @@ class ExplanationService:
             logger.info(f"=== Análisis de Log Sospechoso ===")
             logger.debug(f"Log a analizar: {log_entry}")
             
+            cached = await explanation_cache.get(log_entry, self.model_name, self.PROMPT_VERSION)
+            if cached is not None:
+                logger.info("Explicación obtenida de la caché")
+                return cached
+            
             # Crear prompt inteligente para el LLM
             prompt = self._create_intelligent_prompt(log_entry, score)
             
@@ -35,6 +66,7 @@ class ExplanationService:
             
             if response:
                 logger.info(f"Explicación generada por LLM: {response}")
+                await explanation_cache.set(log_entry, self.model_name, self.PROMPT_VERSION, response)
                 return response
             else:
                 return self._generate_fallback_explanation(log_entry, score)
@@ -46,10 +78,12 @@ class ExplanationService:
     def _create_intelligent_prompt(self, log_entry: str, score: float) -> str:
         """Crea un prompt inteligente para el LLM"""
         
-        # Extraer información básica del log
-        timestamp = self._extract_timestamp(log_entry)
-        level = self._extract_log_level(log_entry)
+        # Extraer información básica del log (una sola pasada del parser)
+        fields = log_parser.parse_line(log_entry)
+        timestamp = fields["timestamp"]
+        level = fields["level"]
         service = self._identify_service(log_entry)
+        request = " ".join(str(fields[f]) for f in ("method", "path", "status") if fields[f] is not None)
         
         prompt = f"""Eres un experto en análisis de logs de sistemas. Analiza este log y explica QUÉ ESTÁ PASANDO de manera simple y clara para una persona sin conocimientos técnicos.
 
@@ -58,6 +92,8 @@ INFORMACIÓN DEL LOG:
 - Timestamp: {timestamp if timestamp else 'No detectado'}
 - Nivel: {level if level else 'No detectado'}
 - Servicio: {service if service else 'No detectado'}
+- IP: {fields["ip"] if fields["ip"] else 'No detectada'}
+- Petición: {request if request else 'No aplica'}
 - Score de anomalía: {score:.3f}
 
 INSTRUCCIONES:
@@ -84,86 +120,121 @@ ANALIZA ESTE LOG:"""
     
     def _extract_timestamp(self, log_entry: str) -> str:
         """Extrae timestamp del log"""
-        timestamp_patterns = [
-            r'(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})',
-            r'(\w+ \d+ \d+:\d+:\d+)',
-            r'(\d{2}/\w+/\d{4}:\d{2}:\d{2}:\d{2})',
-            r'(\d{4}\.\d{2}\.\d{2})',
-            r'(\d{10,})'  # Unix timestamp
-        ]
-        
-        for pattern in timestamp_patterns:
-            match = re.search(pattern, log_entry)
-            if match:
-                return match.group(1)
-        return None
+        return log_parser.parse_line(log_entry)["timestamp"]
     
     def _extract_log_level(self, log_entry: str) -> str:
         """Extrae nivel de log"""
-        log_levels = ['DEBUG', 'INFO', 'WARN', 'WARNING', 'ERROR', 'FATAL', 'CRITICAL', 'ALERT', 'EMERG']
-        for level in log_levels:
-            if level in log_entry.upper():
-                return level
-        return None
+        return log_parser.parse_line(log_entry)["level"]
     
     def _identify_service(self, log_entry: str) -> str:
         """Identifica el servicio basado en el contenido del log"""
-        content_lower = log_entry.lower()
-        
-        # Servicios comunes
-        if any(service in content_lower for service in ['apache', 'httpd', 'mod_']):
-            return "Apache Web Server"
-        elif any(service in content_lower for service in ['nginx']):
-            return "Nginx Web Server"
-        elif any(service in content_lower for service in ['mysql', 'postgresql', 'mongodb', 'database']):
-            return "Base de Datos"
-        elif any(service in content_lower for service in ['kernel', 'systemd', 'init']):
-            return "Sistema Operativo"
-        elif any(service in content_lower for service in ['ssh', 'telnet', 'ftp']):
-            return "Servicio de Red"
-        elif any(service in content_lower for service in ['mail', 'smtp', 'pop', 'imap']):
-            return "Servidor de Correo"
-        elif any(service in content_lower for service in ['dns', 'bind', 'named']):
-            return "Servidor DNS"
-        else:
-            return "Sistema General"
+        # Servicios comunes (grupos patterns.services de config.yml, en orden)
+        service = pattern_matcher.first_group(pattern_matcher.match(log_entry), 'services')
+        return service or "Sistema General"
+    
+    LLM_OPTIONS = {
+        "temperature": 0.7,
+        "top_p": 0.9,
+        "max_tokens": 200
+    }
     
-    async def _call_llm(self, prompt: str) -> str:
-        """Llama al LLM para obtener explicación"""
+    async def _call_llm(self, prompt: str, items: int = 1) -> str:
+        """Llama al LLM para obtener explicación (items: anomalías que cubre el prompt)"""
         try:
             payload = {
                 "model": self.model_name,
                 "prompt": prompt,
                 "stream": False,
-                "options": {
-                    "temperature": 0.7,
-                    "top_p": 0.9,
-                    "max_tokens": 200
-                }
+                "options": self.LLM_OPTIONS
             }
             
-            response = requests.post(
-                self.ollama_url,
-                json=payload,
-                timeout=15  # Timeout más corto para lotes
+            # Cliente asíncrono compartido (no bloquea el event loop mientras el modelo genera)
+            result = await ollama_client.request(
+                "/api/generate",
+                payload,
+                timeout=15,  # Timeout más corto para lotes
+                items=items
             )
+            explanation = result.get('response', '').strip()
             
-            if response.status_code == 200:
-                result = response.json()
-                explanation = result.get('response', '').strip()
-                
-                # Limpiar la respuesta
-                explanation = self._clean_llm_response(explanation)
-                
-                return explanation if explanation else None
-            else:
-                logger.error(f"Error en LLM: {response.status_code} - {response.text}")
-                return None
+            # Limpiar la respuesta
+            explanation = self._clean_llm_response(explanation)
+            
+            return explanation if explanation else None
                 
+        except OllamaError as e:
+            logger.error(f"Error en LLM: {e.status_code} - {e.detail}")
+            return None
         except Exception as e:
             logger.error(f"Error llamando al LLM: {e}")
             return None
     
+    async def _request_batch(self, prompt: str, ids: List[str],
+                             on_partial: Optional[PartialCallback] = None,
+                             model: Optional[str] = None) -> Optional[str]:
+        """Llama al LLM con salida JSON (format: json) y devuelve el texto crudo
+        
+        Con on_partial la respuesta se consume en streaming y el callback recibe
+        el texto de cada anomalía (índice dentro de ids) a medida que crece.
+        """
+        model = model or self.model_name
+        try:
+            if on_partial is None:
+                result = await ollama_client.request(
+                    "/api/generate",
+                    {
+                        "model": model,
+                        "prompt": prompt,
+                        "stream": False,
+                        "format": "json",
+                        "options": self._batch_options()
+                    },
+                    timeout=15,
+                    items=len(ids)
+                )
+                return result.get("response") or None
+            
+            positions = {item_id: index for index, item_id in enumerate(ids)}
+            text = ""
+            sent: Dict[str, str] = {}
+            async for fragment in ollama_client.stream_generate(
+                prompt, model, options=self._batch_options(), timeout=15, items=len(ids), format="json"
+            ):
+                text += fragment
+                for item_id, partial in self._partial_explanations(text).items():
+                    previous = sent.get(item_id, "")
+                    if item_id not in positions or partial == previous:
+                        continue
+                    sent[item_id] = partial
+                    delta = partial[len(previous):] if partial.startswith(previous) else partial
+                    await on_partial(positions[item_id], delta, partial)
+            return text or None
+            
+        except OllamaError as e:
+            logger.error(f"Error en LLM: {e.status_code} - {e.detail}")
+            return None
+        except Exception as e:
+            logger.error(f"Error llamando al LLM para el lote: {e}")
+            return None
+    
+    def _batch_options(self) -> Dict:
+        """Opciones de los lotes: el contexto del modelo es el que usa el empaquetador para su presupuesto"""
+        return {**self.LLM_OPTIONS, "num_ctx": prompt_packer.context_tokens}
+    
+    def _partial_explanations(self, text: str) -> Dict[str, str]:
+        """Explicación (quizá incompleta) de cada ID en una respuesta JSON aún en curso"""
+        parts = {}
+        for match in PARTIAL_ITEM_RE.finditer(text):
+            # Un escape \\uXXXX a medio llegar se completa con el próximo token
+            raw = PARTIAL_ESCAPE_RE.sub("", match.group(2))
+            try:
+                value = json.loads(f'"{raw}"')
+            except ValueError:
+                continue
+            if value.strip():
+                parts[match.group(1)] = value.strip()
+        return parts
+    
     def _clean_llm_response(self, response: str) -> str:
         """Limpia la respuesta del LLM"""
         if not response:
@@ -192,24 +263,24 @@ ANALIZA ESTE LOG:"""
     def _generate_fallback_explanation(self, log_entry: str, score: float) -> str:
         """Genera una explicación de respaldo si el LLM falla"""
         
-        # Análisis básico para fallback
-        content_lower = log_entry.lower()
+        # Análisis básico para fallback (una sola búsqueda de todos los grupos)
+        hits = pattern_matcher.match(log_entry)
         
-        if 'error' in content_lower or 'failed' in content_lower:
-            if 'timeout' in content_lower:
+        if 'fallback.error' in hits:
+            if 'fallback.timeout' in hits:
                 return "El sistema está experimentando timeouts - algún servicio no responde a tiempo, lo que puede causar fallos en la aplicación"
-            elif 'connection' in content_lower:
+            elif 'fallback.connection' in hits:
                 return "Hay problemas de conectividad - el sistema no puede establecer conexiones con otros servicios, afectando la funcionalidad"
-            elif 'memory' in content_lower or 'oom' in content_lower:
+            elif 'fallback.memory' in hits:
                 return "El sistema se está quedando sin memoria - esto puede causar que las aplicaciones fallen o funcionen muy lento"
-            elif 'disk' in content_lower or 'space' in content_lower:
+            elif 'fallback.disk' in hits:
                 return "El disco está lleno - esto impide que el sistema guarde archivos y puede causar fallos en las aplicaciones"
-            elif 'permission' in content_lower or 'denied' in content_lower:
+            elif 'fallback.permission' in hits:
                 return "Hay problemas de permisos - el sistema no puede acceder a ciertos archivos o recursos, limitando su funcionamiento"
             else:
                 return f"Se detectó un error en el sistema (severidad: {self._get_severity_text(score)}) - esto indica un problema que necesita atención"
         
-        elif 'warning' in content_lower or 'warn' in content_lower:
+        elif 'fallback.warning' in hits:
             return "Se detectó una advertencia - el sistema está funcionando pero hay algo que podría convertirse en un problema"
         
         else:
@@ -226,44 +297,212 @@ ANALIZA ESTE LOG:"""
         else:
             return "bajo"
     
-    async def get_batch_explanations(self, anomaly_batch: List[Tuple[str, float]]) -> List[str]:
-        """Obtiene explicaciones para un lote de anomalías de una vez"""
+    async def get_batch_explanations(self, anomaly_batch: List[Tuple[str, float]],
+                                     on_partial: Optional[PartialCallback] = None,
+                                     with_fallback: bool = True) -> List[Optional[str]]:
+        """Obtiene explicaciones para un lote de anomalías de una vez
+        
+        Con on_partial la respuesta se pide en streaming y el callback recibe el
+        texto de cada anomalía (índice dentro de anomaly_batch) mientras se genera.
+        Con with_fallback=False las anomalías que el LLM no explicó quedan en None
+        (p. ej. con el circuito abierto) para que el llamador las reintente.
+        
+        Cada anomalía va al modelo de su nivel (ver ModelRouter): las de nivel
+        sin modelo reciben la explicación por reglas y el resto se pide por
+        nivel, en paralelo, con el tamaño de lote de cada uno.
+        """
         try:
             if not anomaly_batch:
                 return []
             
-            logger.info(f"Procesando lote de {len(anomaly_batch)} anomalías con LLM")
-            
-            # Crear prompt para el lote completo
-            prompt = self._create_batch_prompt(anomaly_batch)
-            
-            # Llamar al LLM una sola vez para todo el lote
-            response = await self._call_llm(prompt)
+            tiers = self.model_router.route(
+                [line for line, _ in anomaly_batch], [self._get_severity_text(score) for _, score in anomaly_batch]
+            )
+            explanations: List[Optional[str]] = [None] * len(anomaly_batch)
+            by_tier: Dict[str, List[int]] = {}
+            by_rules = 0
+            for i, tier in enumerate(tiers):
+                if tier.model is None:
+                    explanations[i] = self._generate_fallback_explanation(*anomaly_batch[i])
+                    by_rules += 1
+                else:
+                    by_tier.setdefault(tier.name, []).append(i)
+            if by_rules:
+                logger.info(f"{by_rules} anomalías de baja severidad explicadas por reglas (sin LLM)")
             
-            if response:
-                logger.info(f"Respuesta del LLM: {response[:200]}...")
-                
-                # Parsear las explicaciones del lote
-                explanations = self._parse_batch_response(response, len(anomaly_batch))
-                logger.info(f"Explicaciones generadas para lote: {len(explanations)}")
-                
-                # Log de las explicaciones generadas
-                for i, explanation in enumerate(explanations):
-                    logger.info(f"Explicación {i+1}: {explanation[:100]}...")
-                
-                return explanations
-            else:
-                logger.warning("LLM no respondió, usando fallback individual")
-                # Fallback individual si falla el lote
-                return [self._generate_fallback_explanation(line, score) for line, score in anomaly_batch]
+            tier_names = {tier.name: tier for tier in tiers}
+            await asyncio.gather(*(
+                self._explain_tier(tier_names[name], indices, anomaly_batch, explanations, on_partial, with_fallback)
+                for name, indices in by_tier.items()
+            ))
+            return explanations
                 
         except Exception as e:
             logger.error(f"Error procesando lote de anomalías: {e}")
+            if not with_fallback:
+                return [None] * len(anomaly_batch)
             # Fallback individual si hay error
             return [self._generate_fallback_explanation(line, score) for line, score in anomaly_batch]
     
-    def _create_batch_prompt(self, anomaly_batch: List[Tuple[str, float]]) -> str:
-        """Crea un prompt para procesar múltiples anomalías"""
+    async def _explain_tier(self, tier: ModelTier, indices: List[int], anomaly_batch: List[Tuple[str, float]],
+                            explanations: List[Optional[str]], on_partial: Optional[PartialCallback],
+                            with_fallback: bool):
+        """Completa en explanations las anomalías indices con el modelo del nivel (caché y luego LLM)"""
+        tier_batch = [anomaly_batch[i] for i in indices]
+        # Solo las anomalías sin explicación en caché van al LLM
+        cached = await explanation_cache.get_many(
+            [line for line, _ in tier_batch], tier.model, self.BATCH_PROMPT_VERSION
+        )
+        missing = [indices[position] for position, explanation in enumerate(cached) if explanation is None]
+        for i, explanation in zip(indices, cached):
+            explanations[i] = explanation
+        if not missing:
+            logger.info(f"Lote de {len(tier_batch)} anomalías ({tier.name}) resuelto desde la caché")
+            return
+        pending_batch = [anomaly_batch[i] for i in missing]
+        
+        logger.info(f"Procesando lote de {len(pending_batch)} anomalías con {tier.model} ({tier.name}, "
+                    f"{len(tier_batch) - len(pending_batch)} desde la caché)")
+        
+        async def forward_partial(index: int, delta: str, text: str):
+            await on_partial(missing[index], delta, text)
+        forward = forward_partial if on_partial is not None else None
+        
+        start = time.perf_counter()
+        generated = await self._explain_batch(pending_batch, forward, model=tier.model, max_items=tier.batch_size)
+        self.model_router.record(tier, time.perf_counter() - start)
+        logger.info(f"Explicaciones generadas para lote: {len(generated)} de {len(pending_batch)}")
+        
+        # Solo se guardan las del LLM; las que faltan usan la explicación de respaldo
+        await explanation_cache.set_many(
+            [pending_batch[index][0] for index in generated], tier.model, self.BATCH_PROMPT_VERSION,
+            list(generated.values())
+        )
+        for index, (i, (line, score)) in enumerate(zip(missing, pending_batch)):
+            explanations[i] = generated.get(index)
+            if explanations[i] is None and with_fallback:
+                explanations[i] = self._generate_fallback_explanation(line, score)
+    
+    async def explain_on_demand(self, log_entry: str, score: float) -> Optional[str]:
+        """Explicación de una sola anomalía con el prompt de lotes (comparte caché con el worker)
+        
+        Devuelve None si el LLM no dio una explicación válida (el llamador decide el respaldo).
+        """
+        cached = await explanation_cache.get(log_entry, self.model_name, self.BATCH_PROMPT_VERSION)
+        if cached is not None:
+            return cached
+        explanation = (await self._explain_batch([(log_entry, score)])).get(0)
+        if explanation:
+            await explanation_cache.set(log_entry, self.model_name, self.BATCH_PROMPT_VERSION, explanation)
+        return explanation
+    
+    async def _explain_batch(self, anomaly_batch: List[Tuple[str, float]],
+                             on_partial: Optional[PartialCallback] = None, model: Optional[str] = None,
+                             max_items: Optional[int] = None) -> Dict[int, str]:
+        """Explicaciones válidas del LLM por índice del lote
+        
+        Las líneas iguales salvo valores variables (IPs, números, IDs) se
+        explican una sola vez. El resto se reparte en prompts que caben en el
+        contexto del modelo (ver PromptPacker), que se piden en paralelo. Cada
+        anomalía lleva un ID (A1, A2, ...) y la respuesta se empareja por ID;
+        las que faltan o no son válidas se vuelven a pedir (hasta batch_retries
+        veces), sin descartar lo que ya se obtuvo.
+        
+        model y max_items son los del nivel de ruteo (por defecto, el modelo
+        principal y el máximo del empaquetador).
+        """
+        model = model or self.model_name
+        # Una anomalía representa a todas las de su misma forma
+        keys: Dict[int, str] = {}
+        members: Dict[int, List[int]] = {}
+        representatives: Dict[str, int] = {}
+        for index, (line, _) in enumerate(anomaly_batch):
+            key = normalize_line(line)
+            representative = representatives.setdefault(key, index)
+            keys[representative] = key
+            members.setdefault(representative, []).append(index)
+        self._batch_stats["deduplicated"] += len(anomaly_batch) - len(members)
+        
+        results: Dict[int, str] = {}
+        remaining = list(members)
+        fixed_tokens = prompt_packer.estimate_tokens(self._create_batch_prompt([]), model)
+        for attempt in range(self.batch_retries + 1):
+            packs = prompt_packer.pack(
+                [anomaly_batch[index][0] for index in remaining], model, fixed_tokens,
+                self.BATCH_ITEM_OVERHEAD_TOKENS, keys=[keys[index] for index in remaining], max_items=max_items
+            )
+            answered = await asyncio.gather(*(
+                self._explain_pack(anomaly_batch, [remaining[i] for i in pack], members, results, on_partial,
+                                   retry=attempt > 0, model=model)
+                for pack in packs
+            ))
+            # Solo se reintenta lo de prompts que tuvieron respuesta (si el LLM no respondió, reintentar no ayuda)
+            remaining = [index for pack, ok in zip(packs, answered) if ok
+                         for index in (remaining[i] for i in pack) if index not in results]
+            if not remaining:
+                break
+            logger.info(f"Respuestas de lote sin {len(remaining)} anomalías, se vuelven a pedir")
+        
+        return {member: results[index] for index in results for member in members[index]}
+    
+    async def _explain_pack(self, anomaly_batch: List[Tuple[str, float]], indices: List[int],
+                            members: Dict[int, List[int]], results: Dict[int, str],
+                            on_partial: Optional[PartialCallback], retry: bool,
+                            model: Optional[str] = None) -> bool:
+        """Pide al LLM un prompt con las anomalías indices y guarda en results las válidas
+        
+        Returns:
+            False si el LLM no respondió
+        """
+        ids = [f"A{index + 1}" for index in indices]
+        items = []
+        for item_id, index in zip(ids, indices):
+            line, score = anomaly_batch[index]
+            truncated = prompt_packer.truncate(line, model or self.model_name)
+            if truncated != line:
+                self._batch_stats["truncated"] += 1
+            items.append((item_id, truncated, score))
+        prompt = self._create_batch_prompt(items)
+        
+        async def forward_partial(position: int, delta: str, text: str):
+            for member in members[indices[position]]:
+                await on_partial(member, delta, text)
+        forward = forward_partial if on_partial is not None else None
+        
+        start = time.perf_counter()
+        response = await self._request_batch(prompt, ids, forward, model)
+        parsed = self._parse_batch_response(response, ids) if response else {}
+        self._record_batch(len(ids), len(parsed), time.perf_counter() - start, retry=retry)
+        
+        for item_id, index in zip(ids, indices):
+            if item_id in parsed:
+                results[index] = parsed[item_id]
+        return response is not None
+    
+    def _record_batch(self, requested: int, parsed: int, seconds: float, retry: bool):
+        self._batch_stats["calls"] += 1
+        self._batch_stats["requested"] += requested
+        self._batch_stats["parsed"] += parsed
+        self._batch_stats["llm_seconds"] += seconds
+        if retry:
+            self._batch_stats["retries"] += 1
+    
+    def batch_stats(self) -> Dict:
+        """Explicaciones de lote pedidas y válidas, y cuántas se obtienen por segundo de LLM
+        
+        deduplicated: anomalías que compartieron explicación con otra de su misma forma;
+        truncated: líneas recortadas para caber en el contexto del modelo.
+        """
+        stats = dict(self._batch_stats)
+        stats["llm_seconds"] = round(stats["llm_seconds"], 3)
+        stats["parse_rate"] = round(stats["parsed"] / stats["requested"], 4) if stats["requested"] else 0.0
+        stats["parsed_per_llm_second"] = (
+            round(stats["parsed"] / stats["llm_seconds"], 3) if stats["llm_seconds"] else 0.0
+        )
+        return stats
+    
+    def _create_batch_prompt(self, anomaly_batch: List[Tuple[str, str, float]]) -> str:
+        """Crea un prompt para procesar múltiples anomalías (id, línea, score) con respuesta JSON"""
         
         prompt = f"""Eres un experto en análisis de logs. Analiza estas {len(anomaly_batch)} anomalías y explica QUÉ ESTÁ PASANDO en cada una de manera simple y clara.
 
@@ -277,69 +516,54 @@ INSTRUCCIONES:
 7. Explica a una persona sin conocimientos técnicos
 
 FORMATO DE RESPUESTA:
-Para cada anomalía, responde en una línea separada:
-ANOMALÍA 1: [explicación]
-ANOMALÍA 2: [explicación]
-ANOMALÍA 3: [explicación]
-...
+Responde SOLO con un objeto JSON, con una entrada por anomalía y el mismo id que se indica entre corchetes:
+{{"explanations": [{{"id": "A1", "explanation": "..."}}, {{"id": "A2", "explanation": "..."}}]}}
 
 ANOMALÍAS A ANALIZAR:"""
         
-        for i, (line, score) in enumerate(anomaly_batch, 1):
-            prompt += f"\n\nANOMALÍA {i} (Score: {score:.3f}):\n{line}"
+        for item_id, line, score in anomaly_batch:
+            prompt += f"\n\n[{item_id}] (Score: {score:.3f}):\n{line}"
         
         return prompt
     
-    def _parse_batch_response(self, response: str, expected_count: int) -> List[str]:
-        """Parsea la respuesta del LLM para extraer explicaciones individuales"""
+    def _parse_batch_response(self, response: str, ids: List[str]) -> Dict[str, str]:
+        """Valida la respuesta JSON de un lote y devuelve las explicaciones por ID
+        
+        Se ignoran IDs desconocidos o repetidos y explicaciones vacías; las
+        anomalías que no aparecen quedan fuera del resultado.
+        """
         try:
-            explanations = []
-            lines = response.strip().split('\n')
-            
-            logger.info(f"Parseando respuesta del LLM con {len(lines)} líneas")
-            logger.info(f"Respuesta completa: {response}")
-            
-            # Buscar patrones más flexibles
-            for line in lines:
-                line = line.strip()
-                logger.debug(f"Línea a parsear: {line}")
-                
-                # Patrón 1: "ANOMALÍA X: explicación"
-                if line.startswith('ANOMALÍA ') and ':' in line:
-                    explanation = line.split(':', 1)[1].strip()
-                    if explanation and explanation != "Anomalía detectada - análisis detallado no disponible":
-                        explanations.append(explanation)
-                        logger.debug(f"Explicación extraída (patrón 1): {explanation}")
-                
-                # Patrón 2: "ANOMALÍA X explicación" (sin dos puntos)
-                elif line.startswith('ANOMALÍA ') and not ':' in line:
-                    # Extraer todo después de "ANOMALÍA X"
-                    parts = line.split(' ', 2)
-                    if len(parts) >= 3:
-                        explanation = parts[2].strip()
-                        if explanation and explanation != "Anomalía detectada - análisis detallado no disponible":
-                            explanations.append(explanation)
-                            logger.debug(f"Explicación extraída (patrón 2): {explanation}")
-                
-                # Patrón 3: Líneas que contienen explicaciones técnicas (sin prefijo ANOMALÍA)
-                elif (any(keyword in line.lower() for keyword in ['apache', 'mod_jk', 'error', 'servidor', 'problema', 'estado']) 
-                      and not line.startswith('ANOMALÍA') 
-                      and len(line) > 20
-                      and len(explanations) < expected_count):
-                    explanations.append(line)
-                    logger.debug(f"Explicación extraída (patrón 3): {line}")
-            
-            logger.info(f"Explicaciones parseadas: {len(explanations)} de {expected_count}")
-            
-            # Si no se pudieron parsear todas, completar con fallbacks
-            while len(explanations) < expected_count:
-                explanations.append("Anomalía detectada - análisis detallado no disponible")
-            
-            return explanations[:expected_count]  # Limitar al número esperado
-            
-        except Exception as e:
-            logger.error(f"Error parseando respuesta del lote: {e}")
-            return ["Anomalía detectada - análisis detallado no disponible"] * expected_count
+            data = json.loads(response)
+        except (TypeError, ValueError) as e:
+            logger.warning(f"Respuesta del lote no es JSON válido: {e}")
+            return {}
+        
+        if isinstance(data, dict):
+            items = data.get("explanations", data.get("anomalies"))
+            if items is None:
+                # Variante {"A1": "explicación", ...}
+                items = [{"id": key, "explanation": value} for key, value in data.items()]
+        else:
+            items = data
+        if not isinstance(items, list):
+            logger.warning("Respuesta del lote sin lista de explicaciones")
+            return {}
+        
+        expected = set(ids)
+        parsed = {}
+        for item in items:
+            if not isinstance(item, dict):
+                continue
+            item_id = str(item.get("id", "")).strip()
+            explanation = item.get("explanation")
+            if item_id not in expected or item_id in parsed or not isinstance(explanation, str):
+                continue
+            explanation = self._clean_llm_response(explanation.strip())
+            if explanation:
+                parsed[item_id] = explanation
+        
+        logger.info(f"Explicaciones válidas en la respuesta: {len(parsed)} de {len(ids)}")
+        return parsed
     
     async def get_detailed_explanation(self, log_entry: str, score: float) -> str:
         """Obtiene una explicación detallada para una anomalía individual (fallback)"""
@@ -0,0 +1,224 @@
+"""
+Extracción vectorizada de características para lotes de logs
+"""
+import logging
+from typing import List, Sequence, Union, Iterator, Tuple
+
+import numpy as np
+
+from config.settings import load_settings
+
+logger = logging.getLogger(__name__)
+
+# Palabras clave sospechosas (patterns.feature_keywords de config.yml, mismas que main.extract_features)
+SUSPICIOUS_KEYWORDS = list(load_settings()["patterns"]["feature_keywords"])
+
+# Caracteres especiales contados por main.extract_features
+SPECIAL_CHARS = '!@#$%^&*(),.?":{}|<>'
+
+# Número de características por línea
+N_FEATURES = 7
+
+# Tablas de búsqueda por byte
+_WHITESPACE_TABLE = np.zeros(256, dtype=bool)
+_WHITESPACE_TABLE[[9, 10, 11, 12, 13, 28, 29, 30, 31, 32]] = True  # Igual que str.split() en ASCII
+
+_SPECIAL_TABLE = np.zeros(256, dtype=bool)
+_SPECIAL_TABLE[list(SPECIAL_CHARS.encode('ascii'))] = True
+
+_DIGIT_TABLE = np.zeros(256, dtype=bool)
+_DIGIT_TABLE[ord('0'):ord('9') + 1] = True
+
+
+def extract_features_batch(
+    data: Union[Sequence[str], bytes],
+    keywords: Sequence[str] = None,
+    block_lines: int = 2048
+) -> np.ndarray:
+    """
+    Extrae las 7 características de main.extract_features para un lote completo.
+
+    Args:
+        data: Lista de líneas o buffer de bytes UTF-8 (una línea por '\\n',
+              las líneas vacías se descartan)
+        keywords: Palabras clave sospechosas (por defecto SUSPICIOUS_KEYWORDS)
+        block_lines: Líneas procesadas por bloque para acotar la memoria
+
+    Returns:
+        Matriz float32 de forma (n_lineas, 7)
+
+    La entropía se calcula sobre el histograma de bytes de cada línea, por lo que
+    coincide con la versión por línea para texto ASCII.
+    """
+    keyword_bytes = [k.lower().encode('utf-8') for k in (keywords or SUSPICIOUS_KEYWORDS)]
+
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        blocks = _iter_buffer_blocks(bytes(data), block_lines)
+    else:
+        blocks = _iter_line_blocks(data, block_lines)
+
+    results = [_features_from_buffer(buf, offsets, keyword_bytes) for buf, offsets in blocks]
+    if not results:
+        return np.zeros((0, N_FEATURES), dtype=np.float32)
+    return np.concatenate(results) if len(results) > 1 else results[0]
+
+
+def _iter_line_blocks(lines: Sequence[str], block_lines: int) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """Convierte bloques de líneas en (buffer uint8, offsets)"""
+    for start in range(0, len(lines), block_lines):
+        block = lines[start:start + block_lines]
+        joined = np.frombuffer('\n'.join(block).encode('utf-8'), dtype=np.uint8)
+        newlines = np.flatnonzero(joined == 10)
+
+        if len(newlines) == len(block) - 1:
+            # Camino rápido: una sola codificación y offsets a partir de los separadores
+            offsets = np.empty(len(block) + 1, dtype=np.int64)
+            offsets[0] = 0
+            offsets[1:-1] = newlines - np.arange(len(newlines))
+            offsets[-1] = len(joined) - len(newlines)
+            yield np.delete(joined, newlines), offsets
+        else:
+            # Alguna línea contiene '\n': codificar línea a línea
+            encoded = [line.encode('utf-8') for line in block]
+            offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+            np.cumsum([len(e) for e in encoded], out=offsets[1:])
+            yield np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def _iter_buffer_blocks(data: bytes, block_lines: int) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """Divide un buffer de bytes en bloques de líneas sin decodificarlo"""
+    raw = np.frombuffer(data, dtype=np.uint8)
+    newlines = np.flatnonzero(raw == 10)
+    starts = np.concatenate(([0], newlines + 1))
+    ends = np.concatenate((newlines, [len(raw)]))
+
+    # Descartar líneas vacías
+    keep = ends > starts
+    starts, ends = starts[keep], ends[keep]
+
+    for i in range(0, len(starts), block_lines):
+        block_starts = starts[i:i + block_lines]
+        block_ends = ends[i:i + block_lines]
+        lengths = block_ends - block_starts
+
+        # Copiar solo los bytes de las líneas (sin separadores)
+        line_ids = np.repeat(np.arange(len(block_starts)), lengths)
+        offsets = np.zeros(len(block_starts) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        positions = np.arange(offsets[-1]) - offsets[line_ids] + block_starts[line_ids]
+        yield raw[positions], offsets
+
+
+def _features_from_buffer(buf: np.ndarray, offsets: np.ndarray, keyword_bytes: List[bytes]) -> np.ndarray:
+    """Calcula las características de un bloque a partir de su buffer concatenado"""
+    n_lines = len(offsets) - 1
+    features = np.zeros((n_lines, N_FEATURES), dtype=np.float32)
+    if n_lines == 0:
+        return features
+
+    byte_lengths = np.diff(offsets)
+    line_ids = np.repeat(np.arange(n_lines, dtype=np.int32), byte_lengths)
+
+    # Inicio de cada línea (para reiniciar palabras y números)
+    line_start = np.zeros(len(buf), dtype=bool)
+    line_start[offsets[:-1][byte_lengths > 0]] = True
+
+    # Bytes de continuación UTF-8 (no cuentan como caracteres)
+    continuation = (buf & 0xC0) == 0x80
+    is_char = ~continuation
+
+    # 1. Longitud en caracteres
+    features[:, 0] = _per_line_sum(is_char, offsets)
+
+    # 2. Número de palabras
+    is_ws = _WHITESPACE_TABLE[buf]
+    prev_ws = np.empty_like(is_ws)
+    prev_ws[0] = True
+    prev_ws[1:] = is_ws[:-1]
+    prev_ws |= line_start
+    word_starts = ~is_ws & prev_ws
+    n_words = _per_line_sum(word_starts, offsets)
+    features[:, 1] = n_words
+
+    # 3. Entropía por histograma de bytes
+    features[:, 2] = _byte_entropy(buf, line_ids, offsets)
+
+    # 4. Palabras clave sospechosas presentes
+    features[:, 3] = _keyword_presence(buf, line_ids, keyword_bytes, n_lines)
+
+    # 5. Caracteres especiales
+    features[:, 4] = _per_line_sum(_SPECIAL_TABLE[buf], offsets)
+
+    # 6. Grupos de dígitos (equivalente a re.findall(r'\d+'))
+    is_digit = _DIGIT_TABLE[buf]
+    prev_digit = np.empty_like(is_digit)
+    prev_digit[0] = False
+    prev_digit[1:] = is_digit[:-1]
+    prev_digit &= ~line_start
+    features[:, 5] = _per_line_sum(is_digit & ~prev_digit, offsets)
+
+    # 7. Longitud promedio de palabras
+    word_chars = _per_line_sum(~is_ws & is_char, offsets)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        features[:, 6] = np.where(n_words > 0, word_chars / np.maximum(n_words, 1), 0)
+
+    return features
+
+
+def _per_line_sum(mask: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """Suma una máscara booleana por línea con np.add.reduceat sobre los offsets del bloque"""
+    starts = offsets[:-1]
+    non_empty = offsets[1:] > starts
+    sums = np.zeros(len(starts), dtype=np.int32)
+    if non_empty.any():
+        # reduceat no admite segmentos vacíos: se reduce solo sobre líneas con contenido
+        sums[non_empty] = np.add.reduceat(mask.view(np.uint8), starts[non_empty], dtype=np.int32)
+    return sums
+
+
+def _byte_entropy(buf: np.ndarray, line_ids: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """Entropía de Shannon de cada línea usando np.bincount sobre (línea, byte)"""
+    n_lines = len(offsets) - 1
+    keys = line_ids * 256 + buf
+    counts = np.bincount(keys, minlength=n_lines * 256)
+
+    # sum(c * log2(c)) sobre el histograma == suma de log2(c[byte]) sobre cada byte de la línea
+    byte_log = np.log2(counts[keys].astype(np.float32))
+    c_log_c = np.zeros(n_lines, dtype=np.float64)
+    non_empty = offsets[1:] > offsets[:-1]
+    if non_empty.any():
+        c_log_c[non_empty] = np.add.reduceat(byte_log, offsets[:-1][non_empty], dtype=np.float64)
+
+    # H = log2(L) - sum(c * log2(c)) / L
+    lengths = np.diff(offsets).astype(np.float64)
+    safe_lengths = np.maximum(lengths, 1.0)
+    entropy = np.where(lengths > 0, np.log2(safe_lengths) - c_log_c / safe_lengths, 0.0)
+    return np.maximum(entropy, 0.0)
+
+
+def _keyword_presence(buf: np.ndarray, line_ids: np.ndarray, keyword_bytes: List[bytes], n_lines: int) -> np.ndarray:
+    """Cuenta cuántas palabras clave distintas aparecen en cada línea (sin distinguir mayúsculas)"""
+    lowered = np.frombuffer(buf.tobytes().lower(), dtype=np.uint8)
+    counts = np.zeros(n_lines, dtype=np.int32)
+
+    for keyword in keyword_bytes:
+        k = len(keyword)
+        if k == 0 or k > len(lowered):
+            continue
+        pattern = np.frombuffer(keyword, dtype=np.uint8)
+
+        # Candidatos por primer byte, verificados con el resto del patrón
+        candidates = np.flatnonzero(lowered[:len(lowered) - k + 1] == pattern[0])
+        for j in range(1, k):
+            if len(candidates) == 0:
+                break
+            candidates = candidates[lowered[candidates + j] == pattern[j]]
+
+        # Descartar coincidencias que cruzan el límite entre líneas
+        candidates = candidates[line_ids[candidates] == line_ids[candidates + k - 1]]
+
+        present = np.zeros(n_lines, dtype=bool)
+        present[line_ids[candidates]] = True
+        counts += present
+
+    return counts
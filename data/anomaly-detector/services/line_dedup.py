@@ -0,0 +1,78 @@
+"""
+Agrupación de líneas repetidas (tras enmascarar valores variables) para procesar una vez por grupo
+"""
+import logging
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+from services.template_miner import mask_lines
+
+logger = logging.getLogger(__name__)
+
+# Posiciones que se reportan por resultado (el conteo siempre es el total)
+MAX_LINE_NUMBERS = 100
+
+
+class LineGroups:
+    """
+    Grupos de líneas iguales tras normalizar, en orden de primera aparición.
+
+    representatives: índice de la primera línea de cada grupo
+    inverse: grupo de cada línea
+    counts: número de líneas de cada grupo
+    """
+
+    def __init__(self, representatives: np.ndarray, inverse: np.ndarray, counts: np.ndarray):
+        self.representatives = representatives
+        self.inverse = inverse
+        self.counts = counts
+        self._order: Optional[np.ndarray] = None
+        self._offsets: Optional[np.ndarray] = None
+
+    def __len__(self) -> int:
+        return len(self.representatives)
+
+    @property
+    def total(self) -> int:
+        return len(self.inverse)
+
+    def select(self, lines: Sequence):
+        """Elemento de cada representante (líneas, líneas enmascaradas...)"""
+        return [lines[i] for i in self.representatives.tolist()]
+
+    def positions(self, group: int, limit: Optional[int] = None) -> List[int]:
+        """Índices de las líneas del grupo (en orden), como mucho limit"""
+        if self._order is None:
+            # Una sola ordenación estable para todas las consultas
+            self._order = np.argsort(self.inverse, kind="stable")
+            self._offsets = np.r_[0, np.cumsum(self.counts)]
+        start, end = self._offsets[group], self._offsets[group + 1]
+        if limit is not None:
+            end = min(end, start + limit)
+        return self._order[start:end].tolist()
+
+
+def collapse_lines(lines: Sequence[str], masked_lines: Optional[Sequence[str]] = None) -> LineGroups:
+    """
+    Agrupa las líneas cuyo texto enmascarado coincide (timestamps, IPs, IDs y números ignorados).
+
+    Cada línea normalizada se reduce a un hash de 64 bits (hash() de Python,
+    no criptográfico) y los grupos se obtienen con np.unique sobre los hashes.
+    """
+    if masked_lines is None:
+        masked_lines = mask_lines(lines)
+    if not lines:
+        empty = np.array([], dtype=np.int64)
+        return LineGroups(empty, empty, empty)
+
+    hashes = np.fromiter((hash(line) for line in masked_lines), dtype=np.int64, count=len(lines))
+    _, first_index, inverse, counts = np.unique(hashes, return_index=True, return_inverse=True, return_counts=True)
+
+    # np.unique ordena por hash: se reordena por primera aparición
+    order = np.argsort(first_index, kind="stable")
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    groups = LineGroups(first_index[order], rank[inverse.reshape(-1)], counts[order])
+    logger.debug(f"{len(lines)} líneas agrupadas en {len(groups)} líneas únicas")
+    return groups
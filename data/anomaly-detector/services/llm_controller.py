@@ -0,0 +1,211 @@
+"""
+Control adaptativo (AIMD) de la concurrencia y del tamaño de lote de las llamadas al LLM
+"""
+import time
+import logging
+import threading
+from collections import deque
+from typing import Callable, Dict, Optional
+
+import numpy as np
+
+from config.settings import load_settings
+
+logger = logging.getLogger(__name__)
+
+
+class AdaptiveLLMController:
+    """
+    Ajusta cuántas llamadas al LLM hay en curso y cuántas anomalías lleva cada prompt.
+
+    Cada llamada informa su latencia, cuántas anomalías explicó y si terminó
+    bien. Un error, timeout o latencia por encima del SLO reduce los límites
+    de forma multiplicativa (como mucho una vez por SLO, para no castigar
+    varias veces la misma ronda). Cada ronda completa dentro del SLO (tantas
+    llamadas correctas como la concurrencia actual) suma 1 a uno de los dos
+    límites, alternando entre ellos; si las anomalías explicadas por segundo
+    bajaron respecto a la ronda anterior, se deshace el último aumento.
+    El lote solo crece si la llamada más lenta de la ronda, escalada al lote
+    nuevo, sigue dentro del SLO.
+    """
+
+    def __init__(self, latency_slo: Optional[float] = None,
+                 min_concurrency: Optional[int] = None, max_concurrency: Optional[int] = None,
+                 initial_concurrency: Optional[int] = None,
+                 min_batch_size: Optional[int] = None, max_batch_size: Optional[int] = None,
+                 initial_batch_size: Optional[int] = None,
+                 decrease_factor: Optional[float] = None, window_seconds: Optional[float] = None,
+                 enabled: Optional[bool] = None, clock: Callable[[], float] = time.monotonic):
+        llm_config = load_settings().get("llm", {})
+        config = llm_config.get("adaptive", {})
+
+        def option(value, name, default):
+            return value if value is not None else config.get(name, default)
+
+        self.enabled = option(enabled, "enabled", True)
+        self.latency_slo = float(option(latency_slo, "latency_slo", 20.0))
+        self.min_concurrency = option(min_concurrency, "min_concurrency", 1)
+        self.max_concurrency = option(max_concurrency, "max_concurrency", llm_config.get("max_connections", 8))
+        self.min_batch_size = option(min_batch_size, "min_batch_size", 1)
+        self.max_batch_size = option(max_batch_size, "max_batch_size", 20)
+        self.decrease_factor = float(option(decrease_factor, "decrease_factor", 0.5))
+        self.window_seconds = float(option(window_seconds, "window_seconds", 60.0))
+        self.concurrency = self._clamp(
+            option(initial_concurrency, "initial_concurrency", llm_config.get("max_concurrency", 4)),
+            self.min_concurrency, self.max_concurrency
+        )
+        self.batch_size = self._clamp(
+            option(initial_batch_size, "initial_batch_size", 5), self.min_batch_size, self.max_batch_size
+        )
+        self.clock = clock
+
+        self._lock = threading.Lock()
+        self._samples = deque()  # (fin, latencia, anomalías, ok) de las llamadas dentro de la ventana
+        self._round_calls = 0
+        self._round_max_latency = 0.0
+        self._round_started = clock()
+        self._round_items = 0
+        self._last_throughput: Optional[float] = None
+        self._last_increase: Optional[str] = None
+        self._next_increase = "concurrency"
+        self._last_decrease = float("-inf")
+        self._counters = {"calls": 0, "errors": 0, "timeouts": 0, "slo_violations": 0,
+                          "items": 0, "increases": 0, "decreases": 0}
+        self.last_adjustment: Optional[str] = None
+
+    @staticmethod
+    def _clamp(value: int, low: int, high: int) -> int:
+        return max(low, min(high, int(value)))
+
+    def record(self, latency: float, items: int = 1, ok: bool = True, timeout: bool = False):
+        """Registra el resultado de una llamada al LLM y ajusta los límites si corresponde"""
+        now = self.clock()
+        with self._lock:
+            self._samples.append((now, latency, items, ok))
+            self._trim(now)
+            self._counters["calls"] += 1
+            if timeout:
+                self._counters["timeouts"] += 1
+            elif not ok:
+                self._counters["errors"] += 1
+            elif latency > self.latency_slo:
+                self._counters["slo_violations"] += 1
+            else:
+                self._counters["items"] += items
+
+            if not self.enabled:
+                return
+            if timeout or latency > self.latency_slo:
+                # Prompts largos o demasiadas generaciones a la vez: se reducen ambos límites
+                self._decrease(now, "timeout" if timeout else "latencia", shrink_batch=True)
+            elif not ok:
+                # Errores de Ollama (sobrecarga, conexión): se reduce la concurrencia
+                self._decrease(now, "error", shrink_batch=False)
+            else:
+                if self._round_calls == 0:
+                    # La ronda empieza con su primera llamada (no cuenta el tiempo ocioso previo)
+                    self._round_started = now - latency
+                self._round_calls += 1
+                self._round_items += items
+                self._round_max_latency = max(self._round_max_latency, latency)
+                if self._round_calls >= self.concurrency:
+                    self._end_round(now)
+
+    def _trim(self, now: float):
+        while self._samples and now - self._samples[0][0] > self.window_seconds:
+            self._samples.popleft()
+
+    def _reset_round(self, now: float):
+        self._round_calls = 0
+        self._round_items = 0
+        self._round_max_latency = 0.0
+        self._round_started = now
+
+    def _decrease(self, now: float, reason: str, shrink_batch: bool):
+        if now - self._last_decrease < self.latency_slo:
+            return
+        self._last_decrease = now
+        concurrency = self._clamp(self.concurrency * self.decrease_factor, self.min_concurrency, self.max_concurrency)
+        batch_size = self.batch_size
+        if shrink_batch:
+            batch_size = self._clamp(self.batch_size * self.decrease_factor, self.min_batch_size, self.max_batch_size)
+        if (concurrency, batch_size) != (self.concurrency, self.batch_size):
+            self._counters["decreases"] += 1
+            self.last_adjustment = (f"{reason}: concurrencia {self.concurrency}->{concurrency}, "
+                                    f"lote {self.batch_size}->{batch_size}")
+            logger.info(f"Control LLM, reducción por {self.last_adjustment}")
+        self.concurrency, self.batch_size = concurrency, batch_size
+        self._last_throughput = None
+        self._last_increase = None
+        self._reset_round(now)
+
+    def _end_round(self, now: float):
+        elapsed = max(now - self._round_started, 1e-6)
+        throughput = self._round_items / elapsed
+        max_latency = self._round_max_latency
+        self._reset_round(now)
+
+        if self._last_increase and self._last_throughput is not None and throughput < self._last_throughput:
+            # El último aumento no mejoró el rendimiento: se deshace y se prueba el otro límite
+            undone = self._last_increase
+            if undone == "concurrency":
+                self.concurrency = self._clamp(self.concurrency - 1, self.min_concurrency, self.max_concurrency)
+            else:
+                self.batch_size = self._clamp(self.batch_size - 1, self.min_batch_size, self.max_batch_size)
+            self.last_adjustment = f"rendimiento: se deshace el aumento de {undone}"
+            self._next_increase = "batch_size" if undone == "concurrency" else "concurrency"
+            self._last_increase = None
+            self._last_throughput = throughput
+            return
+
+        for dimension in (self._next_increase, "batch_size" if self._next_increase == "concurrency" else "concurrency"):
+            if dimension == "concurrency" and self.concurrency < self.max_concurrency:
+                self.concurrency += 1
+            elif (dimension == "batch_size" and self.batch_size < self.max_batch_size
+                  and max_latency * (self.batch_size + 1) / self.batch_size <= self.latency_slo):
+                self.batch_size += 1
+            else:
+                continue
+            self._counters["increases"] += 1
+            self._last_increase = dimension
+            self._next_increase = "batch_size" if dimension == "concurrency" else "concurrency"
+            self.last_adjustment = f"ronda dentro del SLO: +1 {dimension}"
+            break
+        else:
+            self._last_increase = None
+        self._last_throughput = throughput
+
+    def stats(self) -> Dict:
+        """Límites actuales y rendimiento observado en la ventana, para el dashboard de monitoreo"""
+        with self._lock:
+            now = self.clock()
+            self._trim(now)
+            samples = list(self._samples)
+            counters = dict(self._counters)
+        latencies = np.array([latency for _, latency, _, _ in samples]) if samples else np.zeros(0)
+        explained = sum(items for _, latency, items, ok in samples if ok and latency <= self.latency_slo)
+        span = min(self.window_seconds, max(now - samples[0][0] + samples[0][1], 1e-6)) if samples else 0.0
+        failures = sum(not ok for _, _, _, ok in samples)
+        return {
+            "enabled": self.enabled,
+            "concurrency": self.concurrency,
+            "batch_size": self.batch_size,
+            "latency_slo": self.latency_slo,
+            "limits": {
+                "concurrency": [self.min_concurrency, self.max_concurrency],
+                "batch_size": [self.min_batch_size, self.max_batch_size]
+            },
+            "window": {
+                "seconds": self.window_seconds,
+                "calls": len(samples),
+                "explained_per_second": round(explained / span, 3) if span else 0.0,
+                "latency_p50": round(float(np.percentile(latencies, 50)), 3) if latencies.size else None,
+                "latency_p95": round(float(np.percentile(latencies, 95)), 3) if latencies.size else None,
+                "error_rate": round(failures / len(samples), 4) if samples else 0.0
+            },
+            "totals": counters,
+            "last_adjustment": self.last_adjustment
+        }
+
+# Instancia global del controlador
+llm_controller = AdaptiveLLMController()
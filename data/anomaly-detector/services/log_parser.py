@@ -0,0 +1,330 @@
+"""
+Parsers estructurados de logs con detección del formato una vez por archivo
+"""
+import re
+import json
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+
+from services.pattern_matcher import pattern_matcher
+
+logger = logging.getLogger(__name__)
+
+# Columnas que produce cualquier parser
+FIELDS = ("timestamp", "level", "ip", "user", "method", "path", "status", "bytes")
+
+_IP_RE = re.compile(r'\b(\d{1,3}(?:\.\d{1,3}){3})\b')
+_USER_RE = re.compile(r'\buser[=: ]\s*([\w.@-]+)', re.IGNORECASE)
+
+
+def _level_from_text(text: str) -> Optional[str]:
+    """Nivel de log por palabra clave (patterns.log_levels de config.yml), en una sola búsqueda"""
+    level = pattern_matcher.first_pattern(pattern_matcher.match(text, groups=('log_levels',)), 'log_levels')
+    return level.upper() if level else None
+
+
+def _to_int(value) -> Optional[int]:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _user_from_text(text: str) -> Optional[str]:
+    match = _USER_RE.search(text)
+    return match.group(1) if match else None
+
+
+@lru_cache(maxsize=4096)
+def timestamp_to_epoch(timestamp: Optional[str]) -> Optional[float]:
+    """Segundos Unix de un timestamp en cualquiera de los formatos reconocidos (None si no se puede)
+
+    Los timestamps sin zona horaria se interpretan en UTC; los de syslog, que no
+    tienen año, se ubican en el año actual.
+    """
+    if timestamp is None:
+        return None
+    value = str(timestamp).strip()
+    if value.isdigit() and len(value) >= 10:
+        # Unix en segundos o en milisegundos
+        return int(value) / 1000.0 if len(value) >= 13 else float(value)
+    try:
+        parsed = datetime.fromisoformat(value.replace(",", ".").replace("Z", "+00:00"))
+    except ValueError:
+        parsed = None
+        for fmt, text in (("%d/%b/%Y:%H:%M:%S %z", value), ("%d/%b/%Y:%H:%M:%S", value),
+                          ("%Y %b %d %H:%M:%S", f"{datetime.utcnow().year} {' '.join(value.split())}"),
+                          ("%Y.%m.%d", value)):
+            try:
+                parsed = datetime.strptime(text, fmt)
+                break
+            except ValueError:
+                continue
+        if parsed is None:
+            return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+class LogFormat:
+    """Formato de log: convierte una línea en un diccionario con FIELDS (None si no coincide)"""
+
+    name = "base"
+
+    def parse(self, line: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+
+class CombinedAccessFormat(LogFormat):
+    """Apache/nginx: formatos common y combined"""
+
+    name = "access_combined"
+    pattern = re.compile(
+        r'^(?P<ip>\S+) \S+ (?P<user>\S+) \[(?P<timestamp>[^\]]+)\] '
+        r'"(?P<method>[A-Z]+) (?P<path>\S+)[^"]*" (?P<status>\d{3}) (?P<bytes>\d+|-)'
+    )
+
+    def parse(self, line: str) -> Optional[Dict[str, Any]]:
+        match = self.pattern.match(line)
+        if not match:
+            return None
+        status = int(match.group("status"))
+        return {
+            "timestamp": match.group("timestamp"),
+            # El nivel se deriva del código HTTP
+            "level": "ERROR" if status >= 500 else "WARN" if status >= 400 else "INFO",
+            "ip": match.group("ip"),
+            "user": None if match.group("user") == "-" else match.group("user"),
+            "method": match.group("method"),
+            "path": match.group("path"),
+            "status": status,
+            "bytes": _to_int(match.group("bytes"))
+        }
+
+
+class SyslogFormat(LogFormat):
+    """Syslog BSD: 'Mmm dd hh:mm:ss host servicio[pid]: mensaje'"""
+
+    name = "syslog"
+    pattern = re.compile(
+        r'^(?P<timestamp>[A-Z][a-z]{2} [ \d]\d \d{2}:\d{2}:\d{2}) (?P<host>\S+) '
+        r'(?P<service>[^\s:\[]+)(?:\[\d+\])?: (?P<message>.*)$'
+    )
+
+    def parse(self, line: str) -> Optional[Dict[str, Any]]:
+        match = self.pattern.match(line)
+        if not match:
+            return None
+        message = match.group("message")
+        ip = _IP_RE.search(message)
+        return {
+            "timestamp": match.group("timestamp"),
+            "level": _level_from_text(message),
+            "ip": ip.group(1) if ip else None,
+            "user": _user_from_text(message),
+            "method": None, "path": None, "status": None, "bytes": None
+        }
+
+
+class AppLogFormat(LogFormat):
+    """Logs de aplicación con timestamp ISO: 'LEVEL [ts] msg' o 'ts LEVEL msg'"""
+
+    name = "app_iso"
+    _timestamp = r'\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(?:[.,]\d+)?(?:Z|[+-]\d{2}:?\d{2})?'
+    level_first = re.compile(r'^\[?(?P<level>[A-Za-z]+)\]? \[?(?P<timestamp>' + _timestamp + r')\]? ?(?P<message>.*)$')
+    timestamp_first = re.compile(r'^\[?(?P<timestamp>' + _timestamp + r')\]? \[?(?P<level>[A-Za-z]+)\]?:? ?(?P<message>.*)$')
+
+    def parse(self, line: str) -> Optional[Dict[str, Any]]:
+        match = self.level_first.match(line) or self.timestamp_first.match(line)
+        if not match:
+            return None
+        ip = _IP_RE.search(match.group("message"))
+        return {
+            "timestamp": match.group("timestamp"),
+            "level": match.group("level").upper(),
+            "ip": ip.group(1) if ip else None,
+            "user": _user_from_text(match.group("message")),
+            "method": None, "path": None, "status": None, "bytes": None
+        }
+
+
+class JsonLinesFormat(LogFormat):
+    """Una línea JSON por evento, con nombres de campo habituales"""
+
+    name = "json_lines"
+    aliases = {
+        "timestamp": ("timestamp", "@timestamp", "time", "ts", "datetime"),
+        "level": ("level", "severity", "lvl", "log_level"),
+        "ip": ("ip", "remote_addr", "client_ip", "clientip", "src_ip"),
+        "user": ("user", "username", "remote_user", "user_id"),
+        "method": ("method", "http_method", "request_method"),
+        "path": ("path", "url", "uri", "request_uri"),
+        "status": ("status", "status_code", "http_status"),
+        "bytes": ("bytes", "size", "body_bytes_sent", "response_size")
+    }
+
+    def parse(self, line: str) -> Optional[Dict[str, Any]]:
+        if not line.startswith("{"):
+            return None
+        try:
+            data = json.loads(line)
+        except ValueError:
+            return None
+        if not isinstance(data, dict):
+            return None
+
+        fields = {}
+        for field, keys in self.aliases.items():
+            fields[field] = next((data[key] for key in keys if data.get(key) is not None), None)
+        fields["status"] = _to_int(fields["status"])
+        fields["bytes"] = _to_int(fields["bytes"])
+        if fields["level"] is not None:
+            fields["level"] = str(fields["level"]).upper()
+        return fields
+
+
+class GenericFormat(LogFormat):
+    """Respaldo para formatos desconocidos: busca timestamp, nivel e IP en cualquier posición"""
+
+    name = "generic"
+    timestamp_pattern = re.compile(
+        r'(\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}'
+        r'|\d{2}/\w+/\d{4}:\d{2}:\d{2}:\d{2}'
+        r'|[A-Z][a-z]{2} +\d+ \d+:\d+:\d+'
+        r'|\d{4}\.\d{2}\.\d{2}'
+        r'|\b\d{10,}\b)'
+    )
+    request_pattern = re.compile(r'"(?P<method>[A-Z]{3,7}) (?P<path>/\S*)[^"]*"(?: (?P<status>\d{3})\b)?')
+
+    def parse(self, line: str) -> Optional[Dict[str, Any]]:
+        timestamp = self.timestamp_pattern.search(line)
+        ip = _IP_RE.search(line)
+        request = self.request_pattern.search(line)
+        return {
+            "timestamp": timestamp.group(1) if timestamp else None,
+            "level": _level_from_text(line),
+            "ip": ip.group(1) if ip else None,
+            "user": _user_from_text(line),
+            "method": request.group("method") if request else None,
+            "path": request.group("path") if request else None,
+            "status": _to_int(request.group("status")) if request else None,
+            "bytes": None
+        }
+
+
+class ParsedLogs:
+    """Resultado columnar: una lista por campo, alineada con las líneas de entrada"""
+
+    def __init__(self, format_name: str, columns: Dict[str, List[Any]]):
+        self.format = format_name
+        self.columns = columns
+
+    def __len__(self) -> int:
+        return len(self.columns["timestamp"])
+
+    def __getitem__(self, field: str) -> List[Any]:
+        return self.columns[field]
+
+    def row(self, index: int) -> Dict[str, Any]:
+        return {field: self.columns[field][index] for field in FIELDS}
+
+    def numeric(self, field: str) -> np.ndarray:
+        """Columna numérica (status, bytes) como array int64, con -1 para valores ausentes"""
+        return np.array([-1 if v is None else v for v in self.columns[field]], dtype=np.int64)
+
+
+class LogParser:
+    """
+    Detecta el formato de un archivo con una muestra y reutiliza la elección.
+
+    El formato detectado se guarda por fuente (nombre de archivo o job) en un
+    LRU, así cada línea pasa por un único parser. Las líneas que el parser
+    del archivo no reconoce se procesan con el de respaldo.
+    """
+
+    def __init__(self, formats: Optional[Sequence[LogFormat]] = None, sample_size: int = 200,
+                 min_match_ratio: float = 0.6, max_sources: int = 256):
+        self.formats = list(formats) if formats is not None else [
+            JsonLinesFormat(), CombinedAccessFormat(), SyslogFormat(), AppLogFormat()
+        ]
+        self.fallback = GenericFormat()
+        self.sample_size = sample_size
+        self.min_match_ratio = min_match_ratio
+        self.max_sources = max_sources
+        self._source_formats: "OrderedDict[str, LogFormat]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def register_format(self, log_format: LogFormat, first: bool = True):
+        """Agrega un parser propio (por defecto con prioridad sobre los incluidos)"""
+        self.formats.insert(0 if first else len(self.formats), log_format)
+
+    def detect_format(self, sample: Sequence[str]) -> LogFormat:
+        """Elige el parser que reconoce más líneas de la muestra"""
+        sample = [line for line in sample[:self.sample_size] if line.strip()]
+        if not sample:
+            return self.fallback
+
+        best, best_ratio = self.fallback, 0.0
+        for log_format in self.formats:
+            ratio = sum(1 for line in sample if log_format.parse(line) is not None) / len(sample)
+            if ratio > best_ratio:
+                best, best_ratio = log_format, ratio
+        if best_ratio < self.min_match_ratio:
+            return self.fallback
+        return best
+
+    def format_for(self, lines: Sequence[str], source: Optional[str] = None) -> LogFormat:
+        """Formato de la fuente (detectado con las primeras líneas la primera vez)"""
+        if source is None:
+            return self.detect_format(lines)
+        with self._lock:
+            log_format = self._source_formats.get(source)
+            if log_format is not None:
+                self._source_formats.move_to_end(source)
+                return log_format
+
+        log_format = self.detect_format(lines)
+        logger.info(f"Formato de logs detectado para {source}: {log_format.name}")
+        with self._lock:
+            self._source_formats[source] = log_format
+            while len(self._source_formats) > self.max_sources:
+                self._source_formats.popitem(last=False)
+        return log_format
+
+    def parse(self, lines: Sequence[str], source: Optional[str] = None,
+              log_format: Optional[LogFormat] = None) -> ParsedLogs:
+        """Parsea un lote en columnas (FIELDS), con log_format o con el formato de la fuente"""
+        if log_format is None:
+            log_format = self.format_for(lines, source)
+        parse, fallback = log_format.parse, self.fallback.parse
+        columns: Dict[str, List[Any]] = {field: [] for field in FIELDS}
+        appenders = [(field, columns[field].append) for field in FIELDS]
+
+        for line in lines:
+            fields = parse(line) or fallback(line)
+            for field, append in appenders:
+                append(fields[field])
+        return ParsedLogs(log_format.name, columns)
+
+    def parse_line(self, line: str, source: Optional[str] = None) -> Dict[str, Any]:
+        """Campos de una sola línea (con el formato de la fuente si ya se conoce)"""
+        if source is not None:
+            with self._lock:
+                log_format = self._source_formats.get(source)
+            if log_format is not None:
+                return log_format.parse(line) or self.fallback.parse(line)
+        for log_format in self.formats:
+            fields = log_format.parse(line)
+            if fields is not None:
+                return fields
+        return self.fallback.parse(line)
+
+# Instancia global del parser
+log_parser = LogParser()
@@ -0,0 +1,169 @@
+"""
+Registro persistente de modelos Isolation Forest por fuente de logs
+"""
+import os
+import re
+import json
+import logging
+import threading
+from pathlib import Path
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+import joblib
+import numpy as np
+from sklearn.ensemble import IsolationForest
+
+from services.tree_scorer import CompiledForest
+from services.parallel_executor import resolve_n_jobs
+
+logger = logging.getLogger(__name__)
+
+class ModelRegistry:
+    """Guarda modelos entrenados en disco y mantiene un LRU de modelos cargados (ya compilados)"""
+
+    def __init__(self, base_dir: str = None, max_loaded: int = None):
+        self.base_dir = base_dir or os.getenv("MODEL_REGISTRY_DIR", "/app/model_registry")
+        self.max_loaded = max_loaded or int(os.getenv("MODEL_REGISTRY_CACHE_SIZE", "8"))
+        self._loaded: "OrderedDict[Tuple[str, int], Tuple[IsolationForest, CompiledForest]]" = OrderedDict()
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def key_for_filename(filename: str) -> str:
+        """Deriva la clave del modelo a partir del nombre del archivo (patrón de la fuente)"""
+        name = os.path.basename(filename or "default")
+        name = name.split('_chunk')[0]
+        # Fechas, números de rotación, etc. no distinguen la fuente
+        name = re.sub(r'\d+', '#', name)
+        name = re.sub(r'[^A-Za-z0-9#._-]', '_', name).strip('._')
+        return name.replace('#', 'N') or "default"
+
+    def _model_dir(self, key: str) -> str:
+        """Directorio del modelo; ValueError si la clave no queda dentro del registro (".", "..")"""
+        safe_key = re.sub(r'[^A-Za-z0-9._-]', '_', key)
+        base = Path(self.base_dir).resolve()
+        model_dir = (base / safe_key).resolve()
+        if not safe_key.strip('.') or model_dir == base or not model_dir.is_relative_to(base):
+            raise ValueError(f"Clave de modelo inválida: {key!r}")
+        return str(model_dir)
+
+    def _read_metadata(self, key: str) -> Dict:
+        path = os.path.join(self._model_dir(key), "metadata.json")
+        if not os.path.exists(path):
+            return {"key": key, "latest": None, "versions": []}
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _write_metadata(self, key: str, metadata: Dict):
+        path = os.path.join(self._model_dir(key), "metadata.json")
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(metadata, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def _remember(self, key: str, version: int, model: IsolationForest):
+        """Agrega un modelo (y su versión compilada) al LRU, expulsando el menos usado si es necesario"""
+        self._loaded[(key, version)] = (model, CompiledForest.from_isolation_forest(model))
+        self._loaded.move_to_end((key, version))
+        while len(self._loaded) > self.max_loaded:
+            evicted, _ = self._loaded.popitem(last=False)
+            logger.info(f"Modelo {evicted[0]} v{evicted[1]} expulsado de memoria")
+
+    def fit(self, key: str, features: np.ndarray, contamination: float = 0.1,
+            n_estimators: int = 100, random_state: int = 42, n_jobs: Optional[int] = None) -> int:
+        """Entrena un modelo nuevo para la clave y lo guarda como nueva versión"""
+        model_dir = self._model_dir(key)  # Valida la clave antes de entrenar
+        model = IsolationForest(
+            contamination=contamination,
+            random_state=random_state,
+            n_estimators=n_estimators,
+            n_jobs=resolve_n_jobs(n_jobs)
+        )
+        model.fit(features)
+
+        with self._lock:
+            os.makedirs(model_dir, exist_ok=True)
+            metadata = self._read_metadata(key)
+            version = (metadata["latest"] or 0) + 1
+
+            # Sin compresión para poder cargar los arrays con mmap
+            joblib.dump(model, os.path.join(model_dir, f"v{version}.joblib"))
+
+            metadata["latest"] = version
+            metadata["versions"].append({
+                "version": version,
+                "created_at": datetime.utcnow().isoformat(),
+                "n_samples": int(features.shape[0]),
+                "n_features": int(features.shape[1]),
+                "contamination": contamination,
+                "n_estimators": n_estimators
+            })
+            self._write_metadata(key, metadata)
+            self._remember(key, version, model)
+
+        logger.info(f"Modelo {key} v{version} entrenado con {features.shape[0]} muestras")
+        return version
+
+    def load(self, key: str, version: Optional[int] = None) -> Tuple[IsolationForest, int]:
+        """Carga un modelo (última versión por defecto), usando el LRU si ya está en memoria"""
+        (model, _), version = self._load_entry(key, version)
+        return model, version
+
+    def load_compiled(self, key: str, version: Optional[int] = None) -> Tuple[CompiledForest, int]:
+        """Igual que load, pero devuelve el scorer compilado"""
+        (_, compiled), version = self._load_entry(key, version)
+        return compiled, version
+
+    def _load_entry(self, key: str, version: Optional[int]) -> Tuple[Tuple[IsolationForest, CompiledForest], int]:
+        with self._lock:
+            if version is None:
+                version = self._read_metadata(key)["latest"]
+                if version is None:
+                    raise KeyError(f"No hay modelos registrados para {key}")
+
+            cached = self._loaded.get((key, version))
+            if cached is not None:
+                self._loaded.move_to_end((key, version))
+                return cached, version
+
+            path = os.path.join(self._model_dir(key), f"v{version}.joblib")
+            if not os.path.exists(path):
+                raise KeyError(f"No existe la versión {version} del modelo {key}")
+
+            model = joblib.load(path, mmap_mode='r')
+            self._remember(key, version, model)
+            logger.info(f"Modelo {key} v{version} cargado desde disco")
+            return self._loaded[(key, version)], version
+
+    def has_model(self, key: str, n_features: Optional[int] = None) -> bool:
+        """Indica si existe un modelo para la clave (opcionalmente con el número de características dado)"""
+        metadata = self._read_metadata(key)
+        if metadata["latest"] is None:
+            return False
+        if n_features is None:
+            return True
+        latest = next(v for v in metadata["versions"] if v["version"] == metadata["latest"])
+        return latest["n_features"] == n_features
+
+    def score(self, key: str, features: np.ndarray, version: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray, int]:
+        """Puntúa características con un modelo ya entrenado (sin reentrenar)"""
+        compiled, version = self.load_compiled(key, version)
+        anomaly_scores = compiled.decision_function(features)
+        # Mismo criterio que IsolationForest.predict, sin volver a puntuar
+        anomaly_labels = np.where(anomaly_scores < 0, -1, 1)
+        return anomaly_labels, anomaly_scores, version
+
+    def versions(self, key: str) -> Dict:
+        """Lista las versiones registradas de un modelo"""
+        metadata = self._read_metadata(key)
+        loaded = [v for (k, v) in self._loaded.keys() if k == key]
+        return {
+            "model_key": key,
+            "latest": metadata["latest"],
+            "versions": metadata["versions"],
+            "loaded_versions": loaded
+        }
+
+# Instancia global del registro
+model_registry = ModelRegistry()
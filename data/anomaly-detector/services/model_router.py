@@ -0,0 +1,93 @@
+"""
+Ruteo de explicaciones a modelos según la severidad de cada anomalía
+"""
+import logging
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence
+
+from config.settings import load_settings
+from services.pattern_matcher import pattern_matcher
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ModelTier:
+    """Un nivel de ruteo: severidades que atiende, modelo y anomalías por prompt
+
+    Sin modelo el nivel usa la explicación por reglas (sin llamar al LLM).
+    """
+    name: str
+    severities: List[str] = field(default_factory=list)
+    model: Optional[str] = None
+    batch_size: Optional[int] = None
+
+
+class ModelRouter:
+    """
+    Elige el nivel (modelo) de cada anomalía.
+
+    El nivel base sale de la severidad del score ("crítico", "alto", "medio",
+    "bajo"); las palabras clave de escalado (grupos de pattern_matcher, p. ej.
+    severity.CRÍTICO con "injection" o "unauthorized") suben la anomalía al
+    nivel indicado aunque su score sea bajo. Los niveles van del más al menos
+    importante y una anomalía nunca baja de nivel por una palabra clave.
+    """
+
+    def __init__(self, default_model: str, enabled: Optional[bool] = None,
+                 tiers: Optional[List[Dict]] = None, escalation: Optional[Dict[str, str]] = None):
+        config = load_settings().get("llm", {}).get("routing", {})
+        self.default_model = default_model
+        self.enabled = config.get("enabled", False) if enabled is None else enabled
+        self.tiers = [ModelTier(**tier) for tier in (tiers if tiers is not None else config.get("tiers", []))]
+        if not self.enabled or not self.tiers:
+            self.enabled = False
+            self.tiers = [ModelTier("default", model=default_model)]
+        self._positions = {tier.name: position for position, tier in enumerate(self.tiers)}
+        escalation = (escalation if escalation is not None else config.get("escalation", {})) if self.enabled else {}
+        self.escalation = {group: name for group, name in escalation.items() if name in self._positions}
+        for group, name in escalation.items():
+            if name not in self._positions:
+                logger.warning(f"Nivel de ruteo desconocido para el escalado de {group}: {name}")
+        self._counters = {tier.name: {"routed": 0, "escalated": 0, "batches": 0, "llm_seconds": 0.0}
+                          for tier in self.tiers}
+
+    def _tier_for_severity(self, severity: str) -> int:
+        for position, tier in enumerate(self.tiers):
+            if severity in tier.severities:
+                return position
+        return len(self.tiers) - 1  # Sin nivel declarado: el menos importante
+
+    def route(self, lines: Sequence[str], severities: Sequence[str]) -> List[ModelTier]:
+        """Nivel de cada anomalía a partir de su severidad y sus palabras clave"""
+        if not self.enabled:
+            self._counters[self.tiers[0].name]["routed"] += len(lines)
+            return [self.tiers[0]] * len(lines)
+        hits = pattern_matcher.match_batch(lines, list(self.escalation)) if self.escalation else [{}] * len(lines)
+        routed = []
+        for line_hits, severity in zip(hits, severities):
+            base = self._tier_for_severity(severity)
+            position = min([base] + [self._positions[self.escalation[group]] for group in line_hits])
+            tier = self.tiers[position]
+            self._counters[tier.name]["routed"] += 1
+            if position < base:
+                self._counters[tier.name]["escalated"] += 1
+            routed.append(tier)
+        return routed
+
+    def record(self, tier: ModelTier, seconds: float):
+        """Registra un lote explicado con el modelo del nivel (todas sus llamadas)"""
+        self._counters[tier.name]["batches"] += 1
+        self._counters[tier.name]["llm_seconds"] += seconds
+
+    def stats(self) -> Dict:
+        """Anomalías ruteadas por nivel y latencia media de sus lotes"""
+        tiers = []
+        for tier in self.tiers:
+            counters = dict(self._counters[tier.name])
+            counters["llm_seconds"] = round(counters["llm_seconds"], 3)
+            counters["avg_latency"] = (round(counters["llm_seconds"] / counters["batches"], 3)
+                                       if counters["batches"] else 0.0)
+            tiers.append({"name": tier.name, "model": tier.model or "reglas", "batch_size": tier.batch_size,
+                          **counters})
+        return {"enabled": self.enabled, "tiers": tiers}
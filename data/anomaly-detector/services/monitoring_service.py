@@ -9,6 +9,10 @@ from typing import Dict, List, Optional
 from dataclasses import dataclass
 import json
 
+from services.explanation_cache import explanation_cache
+from services.circuit_breaker import HALF_OPEN, OPEN, llm_breaker
+from services.ollama_client import ollama_client
+
 logger = logging.getLogger(__name__)
 
 @dataclass
@@ -29,7 +33,7 @@ class MemoryStats:
 class SystemAlert:
     """Alerta del sistema"""
     timestamp: datetime
-    level: str  # 'warning', 'critical'
+    level: str  # 'info', 'warning', 'critical'
     message: str
     metric: str
     value: float
@@ -54,6 +58,9 @@ class MonitoringService:
         self.db_manager = None
         self.worker_service = None
         
+        # Cada cambio de estado del circuito del LLM queda como alerta
+        llm_breaker.add_listener(self._on_llm_breaker_transition)
+        
     def set_services(self, db_manager, worker_service):
         """Configurar referencias a otros servicios"""
         self.db_manager = db_manager
@@ -176,6 +183,25 @@ class MonitoringService:
         
         return alerts
     
+    def _on_llm_breaker_transition(self, previous: str, state: str, reason: str, window: Dict):
+        """Alerta por cambio de estado del circuito del LLM"""
+        if state == OPEN:
+            level, message = 'critical', f'Circuito del LLM abierto ({reason}): se usan explicaciones de respaldo'
+        elif state == HALF_OPEN:
+            level, message = 'warning', f'Circuito del LLM semiabierto: {reason}'
+        else:
+            level, message = 'info', f'Circuito del LLM cerrado: {reason}'
+        alert = SystemAlert(
+            timestamp=datetime.utcnow(),
+            level=level,
+            message=message,
+            metric='llm_circuit',
+            value=window.get('error_rate', 0.0),
+            threshold=llm_breaker.error_rate
+        )
+        self.alerts.append(alert)
+        logger.warning(f"ALERTA [{alert.level.upper()}]: {alert.message}")
+    
     async def start_monitoring(self, interval: int = 30):
         """Iniciar monitoreo continuo"""
         self.monitoring_active = True
@@ -281,7 +307,10 @@ class MonitoringService:
             'alerts': {
                 'total': len(self.alerts),
                 'recent': len([a for a in self.alerts if (datetime.utcnow() - a.timestamp).seconds < 3600])
-            }
+            },
+            'explanation_cache': explanation_cache.stats(),
+            'llm_circuit': llm_breaker.state,
+            'llm_endpoints': ollama_client.endpoint_stats()
         }
 
 # Instancia global del servicio de monitoreo
@@ -0,0 +1,443 @@
+"""
+Cliente HTTP asíncrono compartido para Ollama (pool de conexiones keep-alive, concurrencia acotada y varias réplicas)
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, List, Optional, Sequence
+
+import numpy as np
+
+import httpx
+
+from config.settings import load_settings
+from services.llm_controller import AdaptiveLLMController, llm_controller
+from services.circuit_breaker import CircuitBreaker, OPEN, llm_breaker
+
+logger = logging.getLogger(__name__)
+
+
+class OllamaError(Exception):
+    """Respuesta de Ollama con código distinto de 200"""
+
+    def __init__(self, status_code: int, detail: str = ""):
+        super().__init__(f"Ollama respondió {status_code}: {detail[:200]}")
+        self.status_code = status_code
+        self.detail = detail
+
+
+class CircuitOpenError(OllamaError):
+    """Llamada rechazada sin contactar a Ollama porque el circuito está abierto"""
+
+    def __init__(self, retry_in: float = 0.0):
+        super().__init__(503, f"circuito del LLM abierto, se reintenta en {retry_in:.0f}s")
+        self.retry_in = retry_in
+
+
+class OllamaEndpoint:
+    """Una réplica de Ollama: llamadas en curso, salud y latencias recientes"""
+
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+        self.in_flight = 0
+        self.healthy = True
+        self.requests = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=200)
+        self.last_check: Optional[str] = None
+        self.last_error: Optional[str] = None
+        self.warmed: Dict[str, str] = {}  # modelo -> última precarga correcta
+
+    def record(self, latency: float, ok: bool):
+        self.requests += 1
+        if ok:
+            self.latencies.append(latency)
+        else:
+            self.errors += 1
+
+    def set_health(self, healthy: bool, error: Optional[str] = None):
+        if healthy != self.healthy:
+            logger.warning(f"Ollama {self.url}: {'disponible' if healthy else 'no disponible'}"
+                           f"{f' ({error})' if error else ''}")
+        self.healthy = healthy
+        self.last_error = error if not healthy else self.last_error
+        self.last_check = datetime.utcnow().isoformat()
+
+    def stats(self) -> Dict:
+        latencies = np.array(self.latencies) if self.latencies else np.zeros(0)
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "errors": self.errors,
+            "latency_p50": round(float(np.percentile(latencies, 50)), 3) if latencies.size else None,
+            "latency_p95": round(float(np.percentile(latencies, 95)), 3) if latencies.size else None,
+            "last_check": self.last_check,
+            "last_error": self.last_error,
+            "warmed": dict(self.warmed)
+        }
+
+
+def endpoint_urls(base_url: Optional[str] = None, config: Optional[Dict] = None) -> List[str]:
+    """URLs de las réplicas: base_url, OLLAMA_SERVICE_URLS / OLLAMA_SERVICE_URL o llm.service_urls / service_url
+
+    Cualquiera de ellas admite varias URLs separadas por comas.
+    """
+    config = config or {}
+    source = (base_url or os.getenv("OLLAMA_SERVICE_URLS") or os.getenv("OLLAMA_SERVICE_URL")
+              or config.get("service_urls") or config.get("service_url", "http://ollama-service:11434"))
+    urls = source.split(",") if isinstance(source, str) else list(source)
+    return [url.strip().rstrip("/") for url in urls if url and url.strip()]
+
+
+class OllamaClient:
+    """
+    Un único httpx.AsyncClient para todas las llamadas a Ollama.
+
+    Las conexiones se reutilizan (keep-alive) y un semáforo limita cuántas
+    generaciones hay en curso, así el event loop nunca se bloquea esperando
+    al modelo y Ollama no recibe más peticiones de las que puede atender.
+    Con un controlador adaptativo, el límite de llamadas en curso es el que
+    fija el controlador y cada llamada le informa su latencia y resultado.
+    Con un circuit breaker, mientras el circuito está abierto las llamadas
+    fallan al instante con CircuitOpenError en lugar de esperar su timeout.
+    El cliente se crea en el primer uso dentro de cada event loop.
+
+    Con varias réplicas cada llamada va a la que tiene menos llamadas en
+    curso entre las sanas (en empate, por turnos); si no se puede conectar,
+    la réplica se marca caída y la llamada se reintenta en otra. Cada pedido
+    lleva keep_alive para que el modelo siga cargado, y start_maintenance
+    revisa la salud de las réplicas y precarga los modelos periódicamente.
+    """
+
+    def __init__(self, base_url: Optional[str] = None, max_connections: Optional[int] = None,
+                 max_concurrency: Optional[int] = None, timeout: Optional[float] = None,
+                 connect_timeout: Optional[float] = None,
+                 transport: Optional[httpx.AsyncBaseTransport] = None,
+                 controller: Optional[AdaptiveLLMController] = None,
+                 breaker: Optional[CircuitBreaker] = None,
+                 endpoints: Optional[Sequence[str]] = None, keep_alive: Optional[str] = None,
+                 warm_models: Optional[Sequence[str]] = None):
+        config = load_settings().get("llm", {})
+        urls = list(endpoints) if endpoints else endpoint_urls(base_url, config)
+        self.endpoints = [OllamaEndpoint(url) for url in urls]
+        self.base_url = self.endpoints[0].url
+        self.max_connections = max_connections or config.get("max_connections", 8)  # Por réplica
+        self.max_concurrency = max_concurrency or config.get("max_concurrency", 4)
+        self.timeout = timeout or config.get("timeout", 30)
+        self.connect_timeout = connect_timeout or config.get("connect_timeout", 5)
+        self.transport = transport  # Transporte alternativo (p. ej. httpx.MockTransport en tests)
+        self.controller = controller
+        self.breaker = breaker
+        # Tiempo que Ollama mantiene el modelo en memoria tras cada pedido ("" para no enviarlo)
+        self.keep_alive = keep_alive if keep_alive is not None else config.get("keep_alive", "30m")
+        self.health_interval = config.get("health_interval", 15)
+        self.warm_interval = config.get("warm_interval", 300)
+        self.warm_timeout = config.get("warm_timeout", 120)
+        # Modelo -> ruta con la que se precarga (los usados se suman a los configurados)
+        self._models: Dict[str, str] = {
+            model: "/api/generate" for model in (warm_models if warm_models is not None else config.get("warm_models", []))
+        }
+        self._turn = 0
+        self._waiting = 0
+        self._maintenance: Optional[asyncio.Task] = None
+
+        self._client: Optional[httpx.AsyncClient] = None
+        self._slots: Optional[asyncio.Condition] = None
+        self._in_flight = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _ensure_client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._loop is not loop:
+            # Un cliente y un limitador por event loop (tests y workers crean loops propios)
+            connections = self.max_connections * len(self.endpoints)
+            self._client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=connections,
+                    max_keepalive_connections=connections
+                ),
+                timeout=httpx.Timeout(self.timeout, connect=self.connect_timeout),
+                transport=self.transport
+            )
+            self._slots = asyncio.Condition()
+            self._in_flight = 0
+            self._waiting = 0
+            for endpoint in self.endpoints:
+                endpoint.in_flight = 0
+            self._loop = loop
+        return self._client
+
+    @property
+    def in_flight(self) -> int:
+        """Generaciones en curso"""
+        return self._in_flight
+
+    @property
+    def waiting(self) -> int:
+        """Llamadas esperando turno (cola global, antes de elegir réplica)"""
+        return self._waiting
+
+    @property
+    def concurrency_limit(self) -> int:
+        """Generaciones simultáneas permitidas ahora"""
+        return self.controller.concurrency if self.controller is not None else self.max_concurrency
+
+    def _pick(self, exclude: Sequence[OllamaEndpoint] = ()) -> OllamaEndpoint:
+        """Réplica sana con menos llamadas en curso (en empate, por turnos)"""
+        candidates = [endpoint for endpoint in self.endpoints if endpoint not in exclude] or self.endpoints
+        candidates = [endpoint for endpoint in candidates if endpoint.healthy] or candidates
+        least = min(endpoint.in_flight for endpoint in candidates)
+        tied = [endpoint for endpoint in candidates if endpoint.in_flight == least]
+        self._turn += 1
+        return tied[self._turn % len(tied)]
+
+    def _prepare(self, path: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """Agrega keep_alive y recuerda el modelo para precargarlo"""
+        model = payload.get("model")
+        if not model:
+            return payload
+        self._models.setdefault(model, "/api/embed" if path in ("/api/embed", "/api/embeddings") else "/api/generate")
+        if self.keep_alive and "keep_alive" not in payload:
+            payload = {**payload, "keep_alive": self.keep_alive}
+        return payload
+
+    @asynccontextmanager
+    async def _slot(self, items: int, exclude: Sequence[OllamaEndpoint] = ()):
+        """Turno para una llamada: espera al límite de llamadas en curso, elige réplica y reporta el resultado
+
+        El diccionario entregado trae la réplica elegida ("endpoint") y se marca "ok" al terminar bien.
+        """
+        breaker = self.breaker
+        if breaker is not None and breaker.state == OPEN:
+            # Sin esperar turno: el circuito ya está abierto
+            raise CircuitOpenError(breaker.stats()["retry_in"])
+        slots = self._slots
+        async with slots:
+            self._waiting += 1
+            try:
+                await slots.wait_for(lambda: self._in_flight < self.concurrency_limit)
+            finally:
+                self._waiting -= 1
+            self._in_flight += 1
+        if breaker is not None and not breaker.allow():
+            # Se abrió mientras la llamada esperaba turno (o ya hay una prueba en curso)
+            async with slots:
+                self._in_flight -= 1
+                slots.notify_all()
+            raise CircuitOpenError(breaker.stats()["retry_in"])
+        endpoint = self._pick(exclude)
+        endpoint.in_flight += 1
+        start = time.perf_counter()
+        outcome = {"ok": False, "endpoint": endpoint}
+        timed_out = False
+        abandoned = False
+        try:
+            yield outcome
+        except httpx.TimeoutException:
+            timed_out = True
+            raise
+        except httpx.ConnectError as e:
+            endpoint.set_health(False, f"conexión: {e}")
+            raise
+        except (asyncio.CancelledError, GeneratorExit):
+            abandoned = True
+            raise
+        finally:
+            latency = time.perf_counter() - start
+            endpoint.in_flight -= 1
+            if not abandoned:
+                endpoint.record(latency, outcome["ok"])
+            if self.controller is not None:
+                self.controller.record(latency, items, ok=outcome["ok"], timeout=timed_out)
+            if breaker is not None:
+                # Una llamada cancelada por quien la hizo no dice nada de la salud de Ollama
+                if abandoned and not outcome["ok"]:
+                    breaker.release()
+                else:
+                    breaker.record(latency, ok=outcome["ok"])
+            async with slots:
+                self._in_flight -= 1
+                # El límite pudo cambiar: se despiertan todas las llamadas en espera
+                slots.notify_all()
+
+    def _timeout(self, timeout: Optional[float]):
+        return httpx.Timeout(timeout, connect=self.connect_timeout) if timeout else httpx.USE_CLIENT_DEFAULT
+
+    async def request(self, path: str, payload: Dict[str, Any], timeout: Optional[float] = None,
+                      items: int = 1) -> Dict[str, Any]:
+        """POST JSON a la API de Ollama; espera turno si ya se alcanzó el límite de llamadas en curso
+
+        items es el número de anomalías que explica la llamada (para medir el rendimiento).
+        """
+        client = self._ensure_client()
+        payload = self._prepare(path, payload)
+        tried: List[OllamaEndpoint] = []
+        while True:
+            try:
+                async with self._slot(items, tried) as outcome:
+                    tried.append(outcome["endpoint"])
+                    response = await client.post(outcome["endpoint"].url + path, json=payload,
+                                                 timeout=self._timeout(timeout))
+                    outcome["ok"] = response.status_code == 200
+                break
+            except httpx.ConnectError:
+                # La petición no llegó a la réplica: se reintenta en otra
+                if len(tried) >= len(self.endpoints):
+                    raise
+        if not outcome["ok"]:
+            raise OllamaError(response.status_code, response.text)
+        return response.json()
+
+    async def stream(self, path: str, payload: Dict[str, Any], timeout: Optional[float] = None,
+                     items: int = 1) -> AsyncIterator[Dict[str, Any]]:
+        """POST con "stream": true; produce cada objeto del NDJSON de Ollama a medida que llega
+
+        El turno se ocupa hasta que Ollama termina (o el consumidor deja de iterar).
+        """
+        client = self._ensure_client()
+        payload = self._prepare(path, {**payload, "stream": True})
+        tried: List[OllamaEndpoint] = []
+        while True:
+            try:
+                async with self._slot(items, tried) as outcome:
+                    tried.append(outcome["endpoint"])
+                    async with client.stream("POST", outcome["endpoint"].url + path, json=payload,
+                                             timeout=self._timeout(timeout)) as response:
+                        if response.status_code != 200:
+                            detail = (await response.aread()).decode("utf-8", "replace")
+                            raise OllamaError(response.status_code, detail)
+                        async for line in response.aiter_lines():
+                            if not line.strip():
+                                continue
+                            message = json.loads(line)
+                            if message.get("error"):
+                                raise OllamaError(500, message["error"])
+                            yield message
+                            if message.get("done"):
+                                break
+                    outcome["ok"] = True
+                return
+            except httpx.ConnectError:
+                # Aún no se recibió nada (la conexión falla antes de la respuesta): se reintenta en otra
+                if len(tried) >= len(self.endpoints):
+                    raise
+
+    async def generate(self, prompt: str, model: str, options: Optional[Dict[str, Any]] = None,
+                       timeout: Optional[float] = None, format: Optional[str] = None) -> str:
+        """Texto generado por /api/generate (sin streaming); format="json" fuerza salida JSON"""
+        payload = {"model": model, "prompt": prompt, "stream": False}
+        if options:
+            payload["options"] = options
+        if format:
+            payload["format"] = format
+        result = await self.request("/api/generate", payload, timeout)
+        return result.get("response", "")
+
+    async def stream_generate(self, prompt: str, model: str, options: Optional[Dict[str, Any]] = None,
+                              timeout: Optional[float] = None, items: int = 1,
+                              format: Optional[str] = None) -> AsyncIterator[str]:
+        """Fragmentos de texto de /api/generate a medida que el modelo los genera"""
+        payload = {"model": model, "prompt": prompt}
+        if options:
+            payload["options"] = options
+        if format:
+            payload["format"] = format
+        async for message in self.stream("/api/generate", payload, timeout, items):
+            if message.get("response"):
+                yield message["response"]
+
+    def start_maintenance(self):
+        """Arranca en el event loop actual la revisión de salud y la precarga periódica de modelos (idempotente)"""
+        loop = asyncio.get_running_loop()
+        if self._maintenance is not None and not self._maintenance.done() and self._maintenance.get_loop() is loop:
+            return
+        self._maintenance = asyncio.create_task(self._maintain())
+        logger.info(f"Mantenimiento de Ollama iniciado para {len(self.endpoints)} réplica(s)")
+
+    async def _maintain(self):
+        last_warm = None
+        while True:
+            try:
+                await self.check_health()
+                if last_warm is None or time.monotonic() - last_warm >= self.warm_interval:
+                    await self.warm_up()
+                    last_warm = time.monotonic()
+            except Exception as e:
+                logger.error(f"Error en el mantenimiento de Ollama: {e}")
+            await asyncio.sleep(self.health_interval)
+
+    async def check_health(self):
+        """Consulta /api/tags en cada réplica; una que vuelve a estar disponible se precarga"""
+        client = self._ensure_client()
+
+        async def check(endpoint: OllamaEndpoint):
+            try:
+                response = await client.get(endpoint.url + "/api/tags", timeout=self._timeout(self.connect_timeout))
+                error = None if response.status_code == 200 else f"HTTP {response.status_code}"
+            except httpx.HTTPError as e:
+                error = f"{type(e).__name__}: {e}"
+            recovered = error is None and not endpoint.healthy
+            endpoint.set_health(error is None, error)
+            if recovered:
+                await self._warm_endpoint(endpoint)
+
+        await asyncio.gather(*(check(endpoint) for endpoint in self.endpoints))
+
+    async def warm_up(self):
+        """Precarga los modelos configurados y los ya usados en todas las réplicas sanas"""
+        await asyncio.gather(*(self._warm_endpoint(endpoint) for endpoint in self.endpoints if endpoint.healthy))
+
+    async def _warm_endpoint(self, endpoint: OllamaEndpoint):
+        # Un pedido vacío carga el modelo (o renueva su keep_alive) sin generar texto; no ocupa turno
+        client = self._ensure_client()
+        for model, path in list(self._models.items()):
+            payload = {"model": model, "keep_alive": self.keep_alive or "5m"}
+            payload.update({"input": "warm-up"} if path == "/api/embed" else {"prompt": "", "stream": False})
+            try:
+                response = await client.post(endpoint.url + path, json=payload, timeout=self._timeout(self.warm_timeout))
+                if response.status_code == 200:
+                    endpoint.warmed[model] = datetime.utcnow().isoformat()
+                else:
+                    logger.warning(f"Precarga de {model} en {endpoint.url}: HTTP {response.status_code}")
+            except httpx.HTTPError as e:
+                logger.warning(f"Precarga de {model} en {endpoint.url} falló: {e}")
+
+    def endpoint_stats(self) -> Dict:
+        """Latencia y llamadas en curso por réplica y cola global, para el monitoreo"""
+        return {
+            "waiting": self._waiting,
+            "in_flight": self._in_flight,
+            "concurrency_limit": self.concurrency_limit,
+            "keep_alive": self.keep_alive,
+            "endpoints": [endpoint.stats() for endpoint in self.endpoints]
+        }
+
+    async def close(self):
+        """Cierra las conexiones del pool y detiene el mantenimiento"""
+        if self._maintenance is not None:
+            self._maintenance.cancel()
+            try:
+                await self._maintenance
+            except (asyncio.CancelledError, RuntimeError):
+                pass
+            self._maintenance = None
+        if self._client is not None:
+            try:
+                await self._client.aclose()
+            except RuntimeError as e:
+                # El loop del cliente ya se cerró
+                logger.debug(f"Cliente de Ollama no cerrado: {e}")
+            self._client = None
+            self._slots = None
+            self._in_flight = 0
+            self._loop = None
+
+# Instancia global del cliente
+ollama_client = OllamaClient(controller=llm_controller, breaker=llm_breaker)
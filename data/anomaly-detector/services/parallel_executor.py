@@ -0,0 +1,120 @@
+"""
+Pool de procesos para repartir enmascarado, extracción de características y puntuación entre núcleos
+"""
+import os
+import asyncio
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Callable, List, Optional, Sequence
+
+import numpy as np
+
+from config.settings import load_settings
+from services.feature_extractor import extract_features_batch
+from services.template_miner import mask_lines
+
+logger = logging.getLogger(__name__)
+
+
+def resolve_n_jobs(n_jobs: Optional[int] = None) -> int:
+    """Número de procesos (-1 o None = todos los núcleos)"""
+    if n_jobs is None:
+        n_jobs = load_settings().get("anomaly_detection", {}).get("n_jobs", -1)
+    if n_jobs is None or n_jobs < 1:
+        return os.cpu_count() or 1
+    return n_jobs
+
+
+# Funciones ejecutadas en los procesos del pool (deben ser importables a nivel de módulo)
+
+def _mask_shard(lines: List[str]) -> List[str]:
+    return mask_lines(lines)
+
+def _features_shard(lines: List[str]) -> np.ndarray:
+    return extract_features_batch(lines)
+
+def _score_registered_shard(model_key: str, version: int, features: np.ndarray) -> np.ndarray:
+    from services.model_registry import model_registry
+    # Cada proceso carga el modelo (mmap) una vez y lo conserva en su propio LRU
+    _, scores, _ = model_registry.score(model_key, features, version)
+    return scores
+
+def _score_model_shard(model, features: np.ndarray) -> np.ndarray:
+    return model.decision_function(features)
+
+
+class ParallelExecutor:
+    """
+    Reparte listas grandes en fragmentos entre un ProcessPoolExecutor.
+
+    Las entradas pequeñas (menos de min_lines) se procesan en el propio
+    proceso: el coste de serializar no compensa. Los procesos se crean con
+    'spawn' para no heredar hilos ni conexiones abiertas del servidor.
+    """
+
+    def __init__(self, n_jobs: Optional[int] = None, min_lines: Optional[int] = None):
+        config = load_settings().get("anomaly_detection", {})
+        self.n_jobs = resolve_n_jobs(n_jobs)
+        self.min_lines = min_lines if min_lines is not None else config.get("parallel_min_lines", 20000)
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.n_jobs,
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+                logger.info(f"Pool de procesos iniciado con {self.n_jobs} procesos")
+            return self._executor
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    def _shards(self, n_items: int) -> List[slice]:
+        n_shards = min(self.n_jobs, max(1, n_items // max(self.min_lines // 2, 1)))
+        bounds = np.linspace(0, n_items, n_shards + 1).astype(int)
+        return [slice(a, b) for a, b in zip(bounds[:-1], bounds[1:])]
+
+    def _run(self, func: Callable, items: Sequence, *args):
+        """Ejecuta func sobre fragmentos de items (en el pool si compensa) y devuelve los resultados en orden"""
+        if self.n_jobs <= 1 or len(items) < self.min_lines:
+            return [func(*args, items)]
+        shards = self._shards(len(items))
+        if len(shards) == 1:
+            return [func(*args, items)]
+        executor = self._get_executor()
+        futures = [executor.submit(func, *args, items[shard]) for shard in shards]
+        return [future.result() for future in futures]
+
+    def mask_lines(self, lines: Sequence[str]) -> List[str]:
+        """mask_lines de template_miner repartido entre procesos"""
+        return [masked for shard in self._run(_mask_shard, list(lines)) for masked in shard]
+
+    def extract_features(self, lines: Sequence[str]) -> np.ndarray:
+        """extract_features_batch repartido entre procesos"""
+        return np.concatenate(self._run(_features_shard, list(lines)))
+
+    def score_registered(self, model_key: str, version: int, features: np.ndarray) -> np.ndarray:
+        """Scores (decision_function) de un modelo registrado; cada proceso lo carga desde disco"""
+        return np.concatenate(self._run(_score_registered_shard, features, model_key, version))
+
+    def score_model(self, model, features: np.ndarray) -> np.ndarray:
+        """Scores (decision_function) de un modelo en memoria, enviado a cada proceso"""
+        return np.concatenate(self._run(_score_model_shard, features, model))
+
+
+async def run_blocking(func: Callable, *args, **kwargs):
+    """Ejecuta una función bloqueante en un hilo para no detener el event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, partial(func, *args, **kwargs))
+
+# Instancia global del pool
+parallel_executor = ParallelExecutor()
@@ -0,0 +1,131 @@
+"""
+Búsqueda de múltiples grupos de patrones en una sola pasada por línea
+"""
+import re
+import logging
+from typing import Dict, Iterable, List, Optional, Sequence, Set
+
+import numpy as np
+
+from config.settings import load_settings
+
+logger = logging.getLogger(__name__)
+
+Hits = Dict[str, Set[str]]
+
+
+class PatternMatcher:
+    """
+    Compila todos los grupos de patrones en una única expresión regular.
+
+    Cada patrón es una subcadena literal y la búsqueda no distingue
+    mayúsculas. La expresión es un lookahead con las alternativas de mayor a
+    menor longitud, de modo que en cada posición se obtiene el patrón más
+    largo; los patrones contenidos en él (p. ej. "warn" en "warning") se
+    añaden con un cierre precalculado. Así una línea se recorre una sola vez
+    sin importar cuántos grupos o patrones haya.
+    """
+
+    def __init__(self, groups: Dict[str, Iterable[str]]):
+        self.groups: Dict[str, List[str]] = {}
+        self._pattern_groups: Dict[str, List[str]] = {}
+        for group, patterns in groups.items():
+            self.groups[group] = [p.lower() for p in patterns]
+            for pattern in self.groups[group]:
+                self._pattern_groups.setdefault(pattern, []).append(group)
+
+        patterns = sorted(self._pattern_groups, key=len, reverse=True)
+        # Cada patrón implica la presencia de todos los que contiene
+        self._closure = {
+            pattern: [other for other in patterns if other in pattern]
+            for pattern in patterns
+        }
+        self._regex = re.compile("(?=(" + "|".join(re.escape(p) for p in patterns) + "))") if patterns else None
+        self._subsets: Dict[tuple, "PatternMatcher"] = {}
+
+    @classmethod
+    def from_settings(cls, settings: Optional[Dict] = None) -> "PatternMatcher":
+        """Construye los grupos a partir de config.yml (los grupos anidados se nombran 'padre.hijo')"""
+        settings = settings if settings is not None else load_settings()
+        groups = {"suspicious_keywords": settings.get("suspicious_keywords", [])}
+        for name, value in (settings.get("patterns") or {}).items():
+            if isinstance(value, dict):
+                for child, patterns in value.items():
+                    groups[f"{name}.{child}"] = patterns
+            else:
+                groups[name] = value
+        return cls(groups)
+
+    def subset(self, groups: Sequence[str]) -> "PatternMatcher":
+        """Matcher compilado solo con algunos grupos (se cachea por combinación de grupos)"""
+        key = tuple(groups)
+        if key not in self._subsets:
+            self._subsets[key] = PatternMatcher({group: self.groups[group] for group in key})
+        return self._subsets[key]
+
+    def _hits_from_patterns(self, found: Iterable[str]) -> Hits:
+        hits: Hits = {}
+        for pattern in set(found):
+            for contained in self._closure[pattern]:
+                for group in self._pattern_groups[contained]:
+                    hits.setdefault(group, set()).add(contained)
+        return hits
+
+    def match(self, text: str, groups: Optional[Sequence[str]] = None) -> Hits:
+        """Patrones encontrados en el texto, por grupo (solo grupos con coincidencias)
+
+        Con groups se buscan solo esos grupos (menos alternativas por posición).
+        """
+        if groups is not None:
+            return self.subset(groups).match(text)
+        if self._regex is None or not text:
+            return {}
+        return self._hits_from_patterns(m.group(1) for m in self._regex.finditer(text.lower()))
+
+    def match_batch(self, lines: Sequence[str], groups: Optional[Sequence[str]] = None) -> List[Hits]:
+        """Igual que match para muchas líneas, con una sola búsqueda sobre el lote completo"""
+        if groups is not None:
+            return self.subset(groups).match_batch(lines)
+        if not lines:
+            return []
+        if self._regex is None:
+            return [{} for _ in lines]
+
+        # Se pasa a minúsculas antes de unir: lower() puede cambiar la longitud de una línea
+        lowered = [line.replace("\n", " ").lower() for line in lines]
+        text = "\n".join(lowered)
+        # Posición de inicio de cada línea dentro del texto unido
+        starts = np.cumsum([0] + [len(line) + 1 for line in lowered[:-1]])
+
+        hits: List[Hits] = [{} for _ in lines]
+        matches = [(m.start(), m.group(1)) for m in self._regex.finditer(text)]
+        if matches:
+            positions, found = zip(*matches)
+            line_index = np.searchsorted(starts, positions, side='right') - 1
+            # Agrupar los patrones encontrados por línea (los índices ya vienen ordenados)
+            boundaries = np.flatnonzero(np.diff(line_index)) + 1
+            for begin, end in zip(np.r_[0, boundaries].tolist(), np.r_[boundaries, len(found)].tolist()):
+                hits[int(line_index[begin])] = self._hits_from_patterns(found[begin:end])
+        return hits
+
+    def count(self, hits: Hits, group: str) -> int:
+        """Número de patrones distintos del grupo presentes"""
+        return len(hits.get(group, ()))
+
+    def first_group(self, hits: Hits, prefix: str) -> Optional[str]:
+        """Primer subgrupo (en el orden de la configuración) con coincidencias, p. ej. prefix='services'"""
+        for group in self.groups:
+            if group.startswith(prefix + ".") and group in hits:
+                return group[len(prefix) + 1:]
+        return None
+
+    def first_pattern(self, hits: Hits, group: str) -> Optional[str]:
+        """Primer patrón del grupo (en el orden de la configuración) presente"""
+        present = hits.get(group, ())
+        for pattern in self.groups.get(group, []):
+            if pattern in present:
+                return pattern
+        return None
+
+# Instancia global construida desde config.yml
+pattern_matcher = PatternMatcher.from_settings()
@@ -0,0 +1,116 @@
+"""
+Empaquetado de anomalías en prompts de lote según un presupuesto de tokens del contexto del modelo
+"""
+import math
+import logging
+from typing import Dict, List, Optional, Sequence
+
+from config.settings import load_settings
+from services.template_miner import mask_lines
+
+logger = logging.getLogger(__name__)
+
+# Caracteres por token por familia de modelo (estimación conservadora para logs: números,
+# rutas y puntuación parten en muchos tokens); se usa el primer prefijo que coincida
+DEFAULT_CHARS_PER_TOKEN = {
+    "qwen": 3.0,
+    "gemma": 3.2,
+    "llama": 3.2,
+    "mistral": 3.0,
+}
+FALLBACK_CHARS_PER_TOKEN = 3.0
+
+TRUNCATION_MARKER = " …[{omitted} caracteres omitidos]… "
+
+
+class PromptPacker:
+    """
+    Reparte las anomalías de un lote en prompts que caben en el contexto del modelo.
+
+    Cada anomalía cuesta los tokens de su línea (truncada si es patológica),
+    los de su cabecera en el prompt y los que se reservan para su explicación
+    en la respuesta. Las líneas se ordenan por su forma enmascarada para que
+    las parecidas compartan prompt, y cada prompt se llena hasta el
+    presupuesto (context_tokens menos la parte fija del prompt) o hasta
+    max_items anomalías.
+
+    Los tokens se estiman por caracteres (ratio por familia de modelo,
+    configurable); no se usa el tokenizador real del modelo.
+    """
+
+    def __init__(self, context_tokens: Optional[int] = None, response_tokens_per_item: Optional[int] = None,
+                 max_line_tokens: Optional[int] = None, max_items: Optional[int] = None,
+                 chars_per_token: Optional[Dict[str, float]] = None):
+        llm_config = load_settings().get("llm", {})
+        config = llm_config.get("prompt_packing", {})
+
+        def option(value, name, default):
+            return value if value is not None else config.get(name, default)
+
+        self.context_tokens = int(option(context_tokens, "context_tokens", 4096))
+        self.response_tokens_per_item = int(option(response_tokens_per_item, "response_tokens_per_item", 120))
+        self.max_line_tokens = int(option(max_line_tokens, "max_line_tokens", 400))
+        self.max_items = int(option(max_items, "max_items", llm_config.get("adaptive", {}).get("max_batch_size", 20)))
+        self.chars_per_token = {**DEFAULT_CHARS_PER_TOKEN, **option(chars_per_token, "chars_per_token", {})}
+
+    def ratio(self, model: str) -> float:
+        """Caracteres por token estimados para el modelo"""
+        name = (model or "").lower()
+        for prefix, ratio in self.chars_per_token.items():
+            if name.startswith(prefix):
+                return float(ratio)
+        return FALLBACK_CHARS_PER_TOKEN
+
+    def estimate_tokens(self, text: str, model: str) -> int:
+        """Tokens estimados del texto (al menos uno por palabra)"""
+        if not text:
+            return 0
+        return max(math.ceil(len(text) / self.ratio(model)), len(text.split()))
+
+    def truncate(self, line: str, model: str) -> str:
+        """Recorta una línea que supera max_line_tokens conservando el principio y el final"""
+        if self.estimate_tokens(line, model) <= self.max_line_tokens:
+            return line
+        max_chars = int(self.max_line_tokens * self.ratio(model)) - len(TRUNCATION_MARKER)
+        head = max(max_chars * 2 // 3, 1)
+        tail = max(max_chars - head, 0)
+        omitted = len(line) - head - tail
+        return line[:head] + TRUNCATION_MARKER.format(omitted=omitted) + (line[-tail:] if tail else "")
+
+    def pack(self, lines: Sequence[str], model: str, fixed_tokens: int = 0, item_overhead_tokens: int = 0,
+             keys: Optional[Sequence[str]] = None, max_items: Optional[int] = None) -> List[List[int]]:
+        """Agrupa los índices de lines en prompts que respetan el presupuesto
+
+        Args:
+            fixed_tokens: tokens de la parte común del prompt (instrucciones y formato)
+            item_overhead_tokens: tokens por anomalía además de su línea (id, score)
+            keys: forma de cada línea para agrupar las parecidas (por defecto, la línea enmascarada)
+            max_items: anomalías por prompt como máximo (por defecto, el del empaquetador)
+
+        Returns:
+            Índices de lines por prompt; una línea que sola no cabe va en su propio prompt
+        """
+        if not lines:
+            return []
+        keys = keys if keys is not None else mask_lines(lines)
+        max_items = min(max_items, self.max_items) if max_items else self.max_items
+        budget = self.context_tokens - fixed_tokens
+        packs: List[List[int]] = []
+        current: List[int] = []
+        used = 0
+        for index in sorted(range(len(lines)), key=lambda i: (keys[i], i)):
+            cost = (self.estimate_tokens(self.truncate(lines[index], model), model)
+                    + item_overhead_tokens + self.response_tokens_per_item)
+            if current and (used + cost > budget or len(current) >= max_items):
+                packs.append(current)
+                current, used = [], 0
+            current.append(index)
+            used += cost
+        packs.append(current)
+        if len(packs) > 1:
+            logger.info(f"{len(lines)} anomalías repartidas en {len(packs)} prompts "
+                        f"(presupuesto de {budget} tokens por prompt)")
+        return packs
+
+# Instancia global del empaquetador
+prompt_packer = PromptPacker()
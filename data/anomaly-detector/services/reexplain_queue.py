@@ -0,0 +1,133 @@
+"""
+Cola en Redis de plantillas que quedaron con explicación de respaldo, para explicarlas cuando el LLM vuelva
+"""
+import json
+import asyncio
+import logging
+from dataclasses import asdict
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from config.settings import load_settings
+from services.circuit_breaker import OPEN, llm_breaker
+from services.explanation_scheduler import ExplanationRequest
+
+logger = logging.getLogger(__name__)
+
+# Recibe [(plantilla por explicar, intentos previos)]
+ReexplainHandler = Callable[[List[Tuple[ExplanationRequest, int]]], Awaitable[None]]
+
+
+class ReexplainQueue:
+    """
+    Lista llm:reexplain en Redis (sobrevive a reinicios y se comparte entre workers).
+
+    Mientras el circuito del LLM está abierto los jobs no esperan al modelo:
+    sus plantillas se publican con la explicación de respaldo y se encolan
+    aquí. Un consumidor por proceso saca lotes cuando el circuito deja de
+    estar abierto y se los pasa al worker, que guarda las explicaciones nuevas
+    en los resultados del job; lo que vuelve a fallar se reencola hasta
+    max_attempts veces.
+    """
+
+    KEY = "llm:reexplain"
+
+    def __init__(self, batch_size: Optional[int] = None, poll_seconds: Optional[float] = None,
+                 max_attempts: Optional[int] = None):
+        config = load_settings().get("llm", {}).get("reexplain", {})
+        self.batch_size = batch_size or config.get("batch_size", 10)
+        self.poll_seconds = poll_seconds or config.get("poll_seconds", 5)
+        self.max_attempts = max_attempts or config.get("max_attempts", 5)
+        self._handler: Optional[ReexplainHandler] = None
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._counters = {"queued": 0, "reexplained_batches": 0, "errors": 0}
+
+    @staticmethod
+    def _redis():
+        from config.database import db_manager
+        return db_manager.redis_client
+
+    async def push(self, requests: List[ExplanationRequest], attempts: int = 0) -> bool:
+        """Encola plantillas para explicarlas más tarde; False si Redis no está disponible"""
+        if not requests:
+            return True
+        try:
+            await self._redis().rpush(
+                self.KEY, *(json.dumps({"request": asdict(request), "attempts": attempts}) for request in requests)
+            )
+            self._counters["queued"] += len(requests)
+            return True
+        except Exception as e:
+            logger.error(f"Error encolando plantillas para reexplicar: {e}")
+            self._counters["errors"] += 1
+            return False
+
+    async def pop(self, count: int) -> List[Tuple[ExplanationRequest, int]]:
+        """Saca hasta count plantillas del principio de la cola"""
+        try:
+            redis = self._redis()
+            async with redis.pipeline(transaction=True) as pipe:
+                pipe.lrange(self.KEY, 0, count - 1)
+                pipe.ltrim(self.KEY, count, -1)
+                raw, _ = await pipe.execute()
+        except Exception as e:
+            logger.error(f"Error leyendo la cola de reexplicación: {e}")
+            self._counters["errors"] += 1
+            return []
+        items = []
+        for value in raw:
+            try:
+                data = json.loads(value)
+                items.append((ExplanationRequest(**data["request"]), int(data.get("attempts", 0))))
+            except (TypeError, ValueError, KeyError) as e:
+                logger.warning(f"Entrada inválida en la cola de reexplicación: {e}")
+        return items
+
+    async def size(self) -> int:
+        try:
+            return int(await self._redis().llen(self.KEY))
+        except Exception:
+            return 0
+
+    def start(self, handler: ReexplainHandler):
+        """Arranca el consumidor en el event loop actual (idempotente)"""
+        loop = asyncio.get_running_loop()
+        self._handler = handler
+        if self._loop is loop and self._task is not None and not self._task.done():
+            return
+        self._loop = loop
+        self._task = asyncio.create_task(self._drain())
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        self._loop = None
+
+    async def _drain(self):
+        while True:
+            items = []
+            if llm_breaker.state != OPEN:
+                items = await self.pop(self.batch_size)
+            if not items:
+                await asyncio.sleep(self.poll_seconds)
+                continue
+            try:
+                await self._handler(items)
+                self._counters["reexplained_batches"] += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error reexplicando plantillas: {e}")
+                self._counters["errors"] += 1
+                for request, attempts in items:
+                    if attempts + 1 < self.max_attempts:
+                        await self.push([request], attempts + 1)
+
+    def stats(self) -> Dict:
+        """Totales del proceso, para el dashboard de monitoreo"""
+        return {"running": self._task is not None and not self._task.done(), **self._counters}
+
+# Instancia global de la cola
+reexplain_queue = ReexplainQueue()
@@ -0,0 +1,212 @@
+"""
+Detección en dos fases para entradas muy grandes: ajuste sobre una muestra y puntuación por bloques
+"""
+import math
+import random
+import logging
+from itertools import islice
+from typing import Callable, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+from sklearn.ensemble import IsolationForest
+
+from config.settings import load_settings
+from services.feature_extractor import extract_features_batch
+from services.model_registry import model_registry
+from services.parallel_executor import parallel_executor
+from services.template_miner import TemplateMiner
+from services.tree_scorer import CompiledForest
+
+logger = logging.getLogger(__name__)
+
+LineSource = Callable[[], Iterable[str]]
+
+
+def reservoir_sample(lines: Iterable[str], sample_size: int, random_state: int = 42) -> Tuple[List[str], int]:
+    """
+    Muestra uniforme de tamaño fijo en una sola pasada (algoritmo L de Li, 1994).
+
+    En lugar de sortear cada línea, calcula cuántas líneas saltar hasta el
+    siguiente reemplazo, así el coste aleatorio es O(k log(n/k)).
+
+    Returns:
+        (muestra, número total de líneas leídas)
+    """
+    rng = random.Random(random_state)
+    iterator = iter(lines)
+    sample = list(islice(iterator, sample_size))
+    seen = len(sample)
+    if seen < sample_size or sample_size <= 0:
+        return sample, seen + sum(1 for _ in iterator)
+
+    w = math.exp(math.log(rng.random()) / sample_size)
+    while True:
+        skip = int(math.log(rng.random()) / math.log(1 - w))
+        skipped = sum(1 for _ in islice(iterator, skip))
+        seen += skipped
+        if skipped < skip:
+            return sample, seen
+        line = next(iterator, None)
+        if line is None:
+            return sample, seen
+        seen += 1
+        sample[rng.randrange(sample_size)] = line
+        w *= math.exp(math.log(rng.random()) / sample_size)
+
+
+def iter_blocks(lines: Iterable[str], block_size: int) -> Iterator[List[str]]:
+    """Agrupa un iterable de líneas en bloques de tamaño fijo"""
+    iterator = iter(lines)
+    while True:
+        block = list(islice(iterator, block_size))
+        if not block:
+            return
+        yield block
+
+
+def iter_file_lines(path: str) -> Iterator[str]:
+    """Líneas no vacías de un archivo, leídas de forma perezosa"""
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield line
+
+
+class SampledDetector:
+    """
+    Isolation Forest ajustado sobre una muestra de reservorio y aplicado por bloques.
+
+    Fase 1 (una pasada): muestra de sample_size líneas y conteo de plantillas
+    de toda la entrada (la rareza de la plantilla es una característica).
+    Fase 2 (otra pasada): puntúa bloques de block_size líneas y los entrega
+    según terminan. El coste del ajuste no depende del tamaño de la entrada y
+    la memoria depende del tamaño de bloque (más el número de plantillas).
+    """
+
+    def __init__(self, sample_size: Optional[int] = None, block_size: Optional[int] = None,
+                 contamination: Optional[float] = None, n_estimators: Optional[int] = None,
+                 random_state: Optional[int] = None):
+        config = load_settings().get("anomaly_detection", {})
+        self.sample_size = sample_size or config.get("sample_size", 100000)
+        self.block_size = block_size or config.get("block_size", 50000)
+        self.contamination = contamination or config.get("contamination", 0.1)
+        self.n_estimators = n_estimators or config.get("n_estimators", 100)
+        self.random_state = random_state if random_state is not None else config.get("random_state", 42)
+
+        self.miner = TemplateMiner()
+        self.total_lines = 0
+        self.model_key: Optional[str] = None
+        self.model_version: Optional[int] = None
+        self._scorer: Optional[CompiledForest] = None
+        self.template_counts = {}  # Logs por plantilla en la fase 1
+
+    def _rarity(self, template_ids: List[int]) -> np.ndarray:
+        total = max(self.total_lines, 1)
+        # Plantillas no vistas en la fase 1 se tratan como únicas
+        counts = np.array([self.template_counts.get(t, 1) for t in template_ids], dtype=np.float64)
+        return np.log(total / counts)
+
+    def _features(self, lines: List[str], template_ids: List[int]) -> np.ndarray:
+        features = parallel_executor.extract_features(lines)
+        return np.column_stack([features, self._rarity(template_ids)]).astype(np.float32)
+
+    def fit(self, source: LineSource, model_key: Optional[str] = None,
+            template_ids: Optional[Sequence[int]] = None, weights: Optional[Sequence[int]] = None) -> "SampledDetector":
+        """Fase 1: recorre la entrada una vez, toma la muestra y ajusta (o reutiliza) el modelo
+
+        Con template_ids la entrada ya viene minada (y con weights, agrupada: cada
+        línea aparece weights[i] veces); la muestra y los conteos de plantillas
+        cuentan cada línea tantas veces como aparece.
+        """
+        if template_ids is None:
+            def counted_lines():
+                for block in iter_blocks(source(), self.block_size):
+                    self.miner.add_lines(block, parallel_executor.mask_lines(block))
+                    yield from block
+
+            sample, self.total_lines = reservoir_sample(counted_lines(), self.sample_size, self.random_state)
+            self.template_counts = {t: c.size for t, c in self.miner.clusters.items()}
+            sample_ids = None
+        else:
+            lines = list(source())
+            weights = [1] * len(lines) if weights is None else [int(w) for w in weights]
+            self.template_counts = {}
+            for template_id, weight in zip(template_ids, weights):
+                self.template_counts[template_id] = self.template_counts.get(template_id, 0) + weight
+            repeated = (index for index, weight in enumerate(weights) for _ in range(weight))
+            indices, self.total_lines = reservoir_sample(repeated, self.sample_size, self.random_state)
+            sample = [lines[index] for index in indices]
+            sample_ids = [template_ids[index] for index in indices]
+        logger.info(f"Muestra de {len(sample)} de {self.total_lines} logs, {len(self.template_counts)} plantillas")
+
+        n_features = extract_features_batch([]).shape[1] + 1
+        self.model_key = model_key
+        if model_key and model_registry.has_model(model_key, n_features):
+            self._scorer, self.model_version = model_registry.load_compiled(model_key)
+            logger.info(f"Puntuando con modelo registrado {model_key} v{self.model_version} (sin reentrenar)")
+            return self
+
+        if len(sample) < 2:
+            raise ValueError("Insuficientes logs para análisis (mínimo 2 requeridos)")
+
+        # La muestra ya se contó en la fase 1: solo se buscan sus plantillas
+        features = self._features(sample, sample_ids if sample_ids is not None else self.miner.match_lines(sample))
+        if model_key:
+            self.model_version = model_registry.fit(
+                model_key, features, self.contamination, self.n_estimators, self.random_state
+            )
+            self._scorer, _ = model_registry.load_compiled(model_key, self.model_version)
+        else:
+            model = IsolationForest(
+                contamination=self.contamination,
+                random_state=self.random_state,
+                n_estimators=self.n_estimators,
+                n_jobs=parallel_executor.n_jobs
+            ).fit(features)
+            self._scorer = CompiledForest.from_isolation_forest(model)
+        return self
+
+    def score_blocks(self, source: LineSource, template_ids: Optional[Sequence[int]] = None
+                     ) -> Iterator[Tuple[int, List[str], np.ndarray, np.ndarray, List[int]]]:
+        """Fase 2: puntúa la entrada completa por bloques
+
+        template_ids son los de fit (entrada ya minada), uno por línea de source.
+
+        Yields:
+            (índice de la primera línea, líneas, etiquetas, scores, IDs de plantilla)
+        """
+        if self._scorer is None:
+            raise RuntimeError("Se debe llamar a fit antes de score_blocks")
+
+        start = 0
+        for block in iter_blocks(source(), self.block_size):
+            if template_ids is not None:
+                block_ids = list(template_ids[start:start + len(block)])
+            else:
+                # Mismo minero de la fase 1: se buscan las plantillas sin volver a contar las líneas
+                block_ids = self.miner.match_lines(block, parallel_executor.mask_lines(block))
+            scores = self._scorer.decision_function(self._features(block, block_ids))
+            labels = np.where(scores < 0, -1, 1)
+            yield start, block, labels, scores, block_ids
+            start += len(block)
+
+
+def detect_sampled(source: LineSource, model_key: Optional[str] = None,
+                   sample_size: Optional[int] = None, block_size: Optional[int] = None,
+                   template_ids: Optional[Sequence[int]] = None,
+                   weights: Optional[Sequence[int]] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """Versión no perezosa: etiquetas y scores de todas las líneas (para entradas ya en memoria)
+
+    template_ids y weights son los de analyze_logs (líneas únicas y sus repeticiones).
+    """
+    detector = SampledDetector(sample_size=sample_size, block_size=block_size).fit(
+        source, model_key, template_ids, weights
+    )
+    labels, scores = [], []
+    for _, _, block_labels, block_scores, _ in detector.score_blocks(source, template_ids):
+        labels.append(block_labels)
+        scores.append(block_scores)
+    if not labels:
+        return np.array([], dtype=int), np.array([])
+    return np.concatenate(labels), np.concatenate(scores)
@@ -0,0 +1,270 @@
+"""
+Detector de anomalías incremental (Half-Space Trees) para el pipeline V2
+"""
+import io
+import json
+import logging
+from typing import Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+class HalfSpaceTrees:
+    """
+    Half-Space Trees (Tan, Ting y Liu, 2011) con estado de tamaño fijo.
+
+    Cada árbol divide el espacio de trabajo por la mitad en una dimensión
+    aleatoria por nivel. Los nodos guardan la masa (número de líneas) de la
+    ventana de referencia y de la ventana actual; al completar una ventana la
+    actual pasa a ser la referencia. La memoria no crece con las líneas vistas.
+
+    Cada línea se puntúa contra la masa acumulada (referencia + ventana
+    actual). El score sigue la convención de IsolationForest.decision_function:
+    negativo = anomalía, con mínimo -threshold para regiones vacías.
+    """
+
+    def __init__(self, n_trees: int = 25, depth: int = 10, window_size: int = 1024,
+                 size_limit: Optional[float] = None, threshold: float = 0.25, random_state: int = 42):
+        self.n_trees = n_trees
+        self.depth = depth
+        self.window_size = window_size
+        self.size_limit = size_limit if size_limit is not None else 0.1 * window_size
+        self.threshold = threshold
+        self.random_state = random_state
+
+        self.n_features: Optional[int] = None
+        self.n_seen = 0
+        self.window_count = 0
+        self.split_feature: Optional[np.ndarray] = None  # (n_trees, n_internal)
+        self.split_value: Optional[np.ndarray] = None    # (n_trees, n_internal)
+        self.reference_mass: Optional[np.ndarray] = None  # (n_trees, n_nodes)
+        self.latest_mass: Optional[np.ndarray] = None     # (n_trees, n_nodes)
+
+    @property
+    def is_initialized(self) -> bool:
+        return self.split_feature is not None
+
+    @staticmethod
+    def _transform(X: np.ndarray) -> np.ndarray:
+        """Escala logarítmica: las características de logs son conteos de cola larga"""
+        return np.log1p(np.maximum(np.asarray(X, dtype=np.float64), 0.0))
+
+    def _build_trees(self, Xt: np.ndarray):
+        """Construye los árboles sobre un espacio de trabajo derivado del primer lote"""
+        rng = np.random.default_rng(self.random_state)
+        self.n_features = Xt.shape[1]
+        n_internal = 2 ** self.depth - 1
+        n_nodes = 2 ** (self.depth + 1) - 1
+
+        data_min = Xt.min(axis=0)
+        data_max = Xt.max(axis=0)
+        # Ancho mínimo para dimensiones constantes en el primer lote
+        data_max = np.maximum(data_max, data_min + 1.0)
+
+        self.split_feature = np.zeros((self.n_trees, n_internal), dtype=np.int16)
+        self.split_value = np.zeros((self.n_trees, n_internal), dtype=np.float64)
+
+        for t in range(self.n_trees):
+            # Espacio de trabajo aleatorio que contiene los datos (como en el artículo original)
+            center = rng.uniform(data_min, data_max)
+            half_range = 2.0 * np.maximum(center - data_min, data_max - center)
+            lower = np.empty((n_nodes, self.n_features))
+            upper = np.empty((n_nodes, self.n_features))
+            lower[0] = center - half_range
+            upper[0] = center + half_range
+
+            for node in range(n_internal):
+                feature = rng.integers(self.n_features)
+                split = (lower[node, feature] + upper[node, feature]) / 2.0
+                self.split_feature[t, node] = feature
+                self.split_value[t, node] = split
+
+                left, right = 2 * node + 1, 2 * node + 2
+                lower[left], upper[left] = lower[node], upper[node]
+                lower[right], upper[right] = lower[node], upper[node]
+                upper[left, feature] = split
+                lower[right, feature] = split
+
+        self.reference_mass = np.zeros((self.n_trees, n_nodes), dtype=np.float32)
+        self.latest_mass = np.zeros((self.n_trees, n_nodes), dtype=np.float32)
+
+    def _paths(self, Xt: np.ndarray) -> np.ndarray:
+        """Nodos visitados por cada fila en cada árbol: (n, n_trees, depth + 1)"""
+        n_rows = Xt.shape[0]
+        paths = np.zeros((n_rows, self.n_trees, self.depth + 1), dtype=np.int32)
+        trees = np.arange(self.n_trees)[np.newaxis, :]
+        rows = np.arange(n_rows)[:, np.newaxis]
+        node = np.zeros((n_rows, self.n_trees), dtype=np.int32)
+
+        for level in range(1, self.depth + 1):
+            feature = self.split_feature[trees, node]
+            go_right = Xt[rows, feature] > self.split_value[trees, node]
+            node = 2 * node + 1 + go_right
+            paths[:, :, level] = node
+        return paths
+
+    def partial_fit(self, X: np.ndarray, sample_weight: Optional[np.ndarray] = None) -> "HalfSpaceTrees":
+        """
+        Actualiza la masa con un lote de filas, rotando ventanas cuando se completan.
+
+        sample_weight indica cuántas líneas representa cada fila (p. ej. una
+        fila por plantilla con su número de repeticiones en el lote).
+        """
+        Xt = self._transform(X)
+        if Xt.shape[0] == 0:
+            return self
+        if not self.is_initialized:
+            self._build_trees(Xt)
+        if sample_weight is None:
+            weights = np.ones(Xt.shape[0], dtype=np.int64)
+        else:
+            weights = np.asarray(sample_weight, dtype=np.int64).copy()
+
+        row = 0
+        while row < Xt.shape[0]:
+            # No cruzar el límite de la ventana actual dentro de un mismo bloque
+            room = self.window_size - self.window_count
+            cumulative = np.cumsum(weights[row:])
+            end = row + int(np.searchsorted(cumulative, room, side='right'))
+            if end == row:
+                # La fila completa la ventana: se reparte su peso entre ambas ventanas
+                take_rows, take_weights = Xt[row:row + 1], np.array([room])
+                weights[row] -= room
+            else:
+                take_rows, take_weights = Xt[row:end], weights[row:end]
+                row = end
+
+            paths = self._paths(take_rows)
+            tree_index = np.broadcast_to(np.arange(self.n_trees)[np.newaxis, :, np.newaxis], paths.shape)
+            path_weights = np.broadcast_to(take_weights[:, np.newaxis, np.newaxis], paths.shape)
+            np.add.at(self.latest_mass, (tree_index.ravel(), paths.ravel()), path_weights.ravel())
+
+            added = int(take_weights.sum())
+            self.window_count += added
+            self.n_seen += added
+
+            if self.window_count >= self.window_size:
+                self.reference_mass = self.latest_mass
+                self.latest_mass = np.zeros_like(self.reference_mass)
+                self.window_count = 0
+        return self
+
+    def score(self, X: np.ndarray) -> np.ndarray:
+        """Puntúa un lote contra todo lo visto hasta ahora (negativo = anomalía)"""
+        Xt = self._transform(X)
+        if not self.is_initialized or Xt.shape[0] == 0:
+            return np.zeros(Xt.shape[0])
+
+        mass = self.reference_mass + self.latest_mass
+        total_mass = mass[0, 0]
+        if total_mass <= 0:
+            return np.zeros(Xt.shape[0])
+
+        paths = self._paths(Xt)
+        trees = np.arange(self.n_trees)[np.newaxis, :, np.newaxis]
+        path_mass = mass[trees, paths]  # (n, n_trees, depth + 1)
+
+        # Se detiene en el primer nodo con masa <= size_limit (o en la hoja)
+        below_limit = path_mass <= self.size_limit
+        below_limit[:, :, -1] = True
+        stop_level = below_limit.argmax(axis=2)
+        stop_mass = np.take_along_axis(path_mass, stop_level[:, :, np.newaxis], axis=2)[:, :, 0]
+
+        # Masa escalada por el volumen del nodo, relativa a una densidad uniforme
+        relative_mass = (stop_mass * 2.0 ** stop_level).mean(axis=1) / total_mass
+        return np.minimum(relative_mass, 1.0) - self.threshold
+
+    def score_one(self, x: np.ndarray) -> float:
+        """Puntúa una sola línea"""
+        return float(self.score(np.asarray(x).reshape(1, -1))[0])
+
+    def score_learn(self, X: np.ndarray, sample_weight: Optional[np.ndarray] = None) -> np.ndarray:
+        """Puntúa un lote y después lo aprende (las primeras ventanas se aprenden antes para calentar)"""
+        if self.n_seen < self.window_size:
+            self.partial_fit(X, sample_weight)
+            return self.score(X)
+        scores = self.score(X)
+        self.partial_fit(X, sample_weight)
+        return scores
+
+    def to_bytes(self) -> bytes:
+        """Serializa el estado completo (tamaño fijo) para guardarlo por job"""
+        meta = {
+            "n_trees": self.n_trees, "depth": self.depth, "window_size": self.window_size,
+            "size_limit": self.size_limit, "threshold": self.threshold,
+            "random_state": self.random_state, "n_features": self.n_features,
+            "n_seen": self.n_seen, "window_count": self.window_count
+        }
+        arrays = {"meta": np.frombuffer(json.dumps(meta).encode("utf-8"), dtype=np.uint8)}
+        if self.is_initialized:
+            arrays.update(
+                split_feature=self.split_feature, split_value=self.split_value,
+                reference_mass=self.reference_mass, latest_mass=self.latest_mass
+            )
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, **arrays)
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "HalfSpaceTrees":
+        """Reconstruye un detector serializado con to_bytes"""
+        arrays = np.load(io.BytesIO(data))
+        meta = json.loads(arrays["meta"].tobytes().decode("utf-8"))
+        detector = cls(
+            n_trees=meta["n_trees"], depth=meta["depth"], window_size=meta["window_size"],
+            size_limit=meta["size_limit"], threshold=meta["threshold"], random_state=meta["random_state"]
+        )
+        detector.n_features = meta["n_features"]
+        detector.n_seen = meta["n_seen"]
+        detector.window_count = meta["window_count"]
+        if "split_feature" in arrays:
+            detector.split_feature = arrays["split_feature"]
+            detector.split_value = arrays["split_value"]
+            detector.reference_mass = arrays["reference_mass"]
+            detector.latest_mass = arrays["latest_mass"]
+        return detector
+
+
+class StreamingDetectorStore:
+    """Persiste el detector de cada job en Redis entre chunks"""
+
+    def __init__(self, ttl: int = 86400):
+        self.ttl = ttl
+
+    @staticmethod
+    def _key(job_id: str) -> str:
+        return f"detector:job:{job_id}"
+
+    async def load(self, job_id: str) -> HalfSpaceTrees:
+        """Obtiene el detector del job o crea uno nuevo"""
+        from config.database import db_manager
+
+        try:
+            data = await db_manager.redis_client.get(self._key(job_id))
+            if data:
+                return HalfSpaceTrees.from_bytes(data)
+        except Exception as e:
+            logger.error(f"Error cargando detector del job {job_id}: {e}")
+        return HalfSpaceTrees()
+
+    async def save(self, job_id: str, detector: HalfSpaceTrees):
+        """Guarda el estado del detector del job"""
+        from config.database import db_manager
+
+        try:
+            await db_manager.redis_client.set(self._key(job_id), detector.to_bytes(), ex=self.ttl)
+        except Exception as e:
+            logger.error(f"Error guardando detector del job {job_id}: {e}")
+
+    async def delete(self, job_id: str):
+        """Elimina el estado del detector del job"""
+        from config.database import db_manager
+
+        try:
+            await db_manager.redis_client.delete(self._key(job_id))
+        except Exception as e:
+            logger.error(f"Error eliminando detector del job {job_id}: {e}")
+
+# Instancia global del almacén
+streaming_detector_store = StreamingDetectorStore()
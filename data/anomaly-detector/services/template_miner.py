@@ -0,0 +1,339 @@
+"""
+Minado de plantillas de logs (estilo Drain) para puntuar y explicar una vez por plantilla
+"""
+import re
+import json
+import logging
+from datetime import datetime
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+WILDCARD = "<*>"
+
+# Máscaras aplicadas antes de tokenizar (el orden importa: lo más específico primero)
+MASKS = [
+    (re.compile(r'\b[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}\b'), '<UUID>'),
+    (re.compile(r'\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(?:[.,]\d+)?(?:Z|[+-]\d{2}:?\d{2})?'), '<TS>'),
+    (re.compile(r'\b\d{1,3}(?:\.\d{1,3}){3}(?::\d+)?\b'), '<IP>'),
+    (re.compile(r'\b0[xX][0-9a-fA-F]+\b|\b(?=[0-9a-fA-F]*\d)(?=[0-9a-fA-F]*[a-fA-F])[0-9a-fA-F]{8,}\b'), '<HEX>'),
+    (re.compile(r'(?<![\w.])[-+]?\d+(?:\.\d+)?'), '<NUM>'),
+]
+
+
+def mask_lines(lines: Sequence[str]) -> List[str]:
+    """Enmascara valores variables de todas las líneas con una pasada por máscara sobre el lote completo"""
+    if not lines:
+        return []
+    text = "\n".join(line.replace("\n", " ") for line in lines)
+    for pattern, replacement in MASKS:
+        text = pattern.sub(replacement, text)
+    return text.split("\n")
+
+
+class LogCluster:
+    """Una plantilla: tokens (con comodines) y número de líneas que la usan"""
+
+    def __init__(self, cluster_id: int, template_tokens: List[str], size: int = 0, example: str = ""):
+        self.cluster_id = cluster_id
+        self.template_tokens = template_tokens
+        self.size = size
+        self.example = example
+
+    @property
+    def template(self) -> str:
+        return " ".join(self.template_tokens)
+
+
+class TemplateMiner:
+    """
+    Árbol de parseo de profundidad fija (Drain, He et al. 2017).
+
+    Las líneas se agrupan primero por número de tokens y después por sus
+    primeros tokens (depth - 2 niveles); en cada hoja se elige la plantilla
+    más parecida y, si supera sim_threshold, se generaliza con comodines.
+    Las líneas ya vistas (tras enmascarar) se resuelven con un diccionario.
+    """
+
+    def __init__(self, depth: int = 4, sim_threshold: float = 0.5, max_children: int = 100,
+                 max_cache_size: int = 100000):
+        self.depth = max(depth, 3)
+        self.sim_threshold = sim_threshold
+        self.max_children = max_children
+        self.max_cache_size = max_cache_size
+
+        self.clusters: Dict[int, LogCluster] = {}
+        self.total_lines = 0
+        self._next_id = 1
+        self._root: Dict = {}
+        self._cache: Dict[str, LogCluster] = {}
+
+    def _tree_path(self, tokens: List[str]) -> List[str]:
+        """Claves de los nodos internos para una línea tokenizada"""
+        path = []
+        for token in tokens[:self.depth - 2]:
+            path.append(WILDCARD if any(c.isdigit() for c in token) else token)
+        return path
+
+    def _leaf(self, tokens: List[str], create: bool) -> Optional[List[LogCluster]]:
+        node = self._root.get(len(tokens))
+        if node is None:
+            if not create:
+                return None
+            node = self._root[len(tokens)] = {}
+
+        path = self._tree_path(tokens)
+        for level, key in enumerate(path):
+            is_last = level == len(path) - 1
+            child = node.get(key)
+            if child is None and key != WILDCARD:
+                if create and len(node) < self.max_children:
+                    child = node[key] = [] if is_last else {}
+                else:
+                    child = node.get(WILDCARD)
+            if child is None:
+                if not create:
+                    return None
+                child = node[WILDCARD] = [] if is_last else {}
+            node = child
+
+        if not path:
+            # Líneas con muy pocos tokens: una sola hoja por longitud
+            node = node.setdefault("", [])
+        return node
+
+    @staticmethod
+    def _similarity(template_tokens: List[str], tokens: List[str]):
+        same, wildcards = 0, 0
+        for template_token, token in zip(template_tokens, tokens):
+            if template_token == WILDCARD:
+                wildcards += 1
+            elif template_token == token:
+                same += 1
+        return same / max(len(tokens), 1), wildcards
+
+    def _match(self, leaf: List[LogCluster], tokens: List[str],
+               threshold: Optional[float] = None) -> Optional[LogCluster]:
+        best, best_key = None, (-1.0, -1)
+        for cluster in leaf:
+            key = self._similarity(cluster.template_tokens, tokens)
+            if key > best_key:
+                best, best_key = cluster, key
+        if best is not None and best_key[0] >= (self.sim_threshold if threshold is None else threshold):
+            return best
+        return None
+
+    def _add_masked(self, masked: str, line: str, count: int = 1) -> LogCluster:
+        cluster = self._cache.get(masked)
+        if cluster is None:
+            tokens = masked.split()
+            leaf = self._leaf(tokens, create=True)
+            cluster = self._match(leaf, tokens)
+            if cluster is None:
+                cluster = LogCluster(self._next_id, tokens, example=line)
+                self.clusters[cluster.cluster_id] = cluster
+                self._next_id += 1
+                leaf.append(cluster)
+            else:
+                cluster.template_tokens = [
+                    template_token if template_token == token else WILDCARD
+                    for template_token, token in zip(cluster.template_tokens, tokens)
+                ]
+            if len(self._cache) >= self.max_cache_size:
+                self._cache.clear()
+            self._cache[masked] = cluster
+
+        cluster.size += count
+        self.total_lines += count
+        return cluster
+
+    def add_lines(self, lines: Sequence[str], masked_lines: Optional[Sequence[str]] = None,
+                  counts: Optional[Sequence[int]] = None) -> List[int]:
+        """Asigna (y aprende) la plantilla de cada línea; devuelve los IDs de plantilla
+
+        masked_lines permite pasar las líneas ya enmascaradas (p. ej. en paralelo)
+        y counts las veces que aparece cada línea (líneas repetidas agrupadas).
+        """
+        if masked_lines is None:
+            masked_lines = mask_lines(lines)
+        if counts is None:
+            counts = [1] * len(lines)
+        return [
+            self._add_masked(masked, line, int(count)).cluster_id
+            for masked, line, count in zip(masked_lines, lines, counts)
+        ]
+
+    def match_lines(self, lines: Sequence[str], masked_lines: Optional[Sequence[str]] = None) -> List[int]:
+        """IDs de plantilla de líneas ya aprendidas, sin sumarlas a los conteos
+
+        Al generalizar una plantilla con comodines una línea anterior puede
+        quedar por debajo de sim_threshold: se toma la más parecida de su hoja.
+        Solo una línea sin hoja (nunca vista) se aprende como plantilla nueva.
+        """
+        if masked_lines is None:
+            masked_lines = mask_lines(lines)
+        template_ids = []
+        for masked, line in zip(masked_lines, lines):
+            cluster = self._cache.get(masked)
+            if cluster is None:
+                tokens = masked.split()
+                leaf = self._leaf(tokens, create=False)
+                cluster = self._match(leaf, tokens, threshold=0.0) if leaf else None
+                if cluster is None:
+                    cluster = self._add_masked(masked, line)
+                elif len(self._cache) < self.max_cache_size:
+                    self._cache[masked] = cluster
+            template_ids.append(cluster.cluster_id)
+        return template_ids
+
+    def add_line(self, line: str) -> int:
+        return self.add_lines([line])[0]
+
+    def rarity(self, template_ids: Sequence[int]) -> np.ndarray:
+        """Rareza de cada plantilla: -log(frecuencia) sobre todas las líneas vistas"""
+        counts = np.array([self.clusters[t].size for t in template_ids], dtype=np.float64)
+        return np.log(max(self.total_lines, 1) / np.maximum(counts, 1.0))
+
+    def template(self, template_id: int) -> str:
+        return self.clusters[template_id].template
+
+    def to_dict(self) -> Dict:
+        return {
+            "depth": self.depth,
+            "sim_threshold": self.sim_threshold,
+            "max_children": self.max_children,
+            "total_lines": self.total_lines,
+            "next_id": self._next_id,
+            "clusters": [
+                {"id": c.cluster_id, "tokens": c.template_tokens, "size": c.size, "example": c.example}
+                for c in self.clusters.values()
+            ]
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "TemplateMiner":
+        miner = cls(depth=data["depth"], sim_threshold=data["sim_threshold"], max_children=data["max_children"])
+        miner.total_lines = data["total_lines"]
+        miner._next_id = data["next_id"]
+        for item in data["clusters"]:
+            cluster = LogCluster(item["id"], item["tokens"], item["size"], item["example"])
+            miner.clusters[cluster.cluster_id] = cluster
+            miner._leaf(cluster.template_tokens, create=True).append(cluster)
+        return miner
+
+
+def template_groups(template_ids: Sequence[int]):
+    """Índice de la primera línea, inverso y conteo de cada plantilla (para puntuar una vez por plantilla)"""
+    unique_ids, first_index, inverse, counts = np.unique(
+        np.asarray(template_ids, dtype=np.int64), return_index=True, return_inverse=True, return_counts=True
+    )
+    return unique_ids, first_index, inverse, counts
+
+
+class TemplateStore:
+    """Estado del minero por job (Redis) y conteos por plantilla (MongoDB)"""
+
+    def __init__(self, ttl: int = 86400):
+        self.ttl = ttl
+
+    @staticmethod
+    def _key(job_id: str) -> str:
+        return f"templates:job:{job_id}"
+
+    async def load(self, job_id: str) -> TemplateMiner:
+        """Obtiene el minero del job o crea uno nuevo"""
+        from config.database import db_manager
+
+        try:
+            data = await db_manager.redis_client.get(self._key(job_id))
+            if data:
+                return TemplateMiner.from_dict(json.loads(data))
+        except Exception as e:
+            logger.error(f"Error cargando plantillas del job {job_id}: {e}")
+        return TemplateMiner()
+
+    async def save(self, job_id: str, miner: TemplateMiner):
+        """Guarda el estado del minero del job"""
+        from config.database import db_manager
+
+        try:
+            await db_manager.redis_client.set(self._key(job_id), json.dumps(miner.to_dict()), ex=self.ttl)
+        except Exception as e:
+            logger.error(f"Error guardando plantillas del job {job_id}: {e}")
+
+    async def delete(self, job_id: str):
+        """Elimina el estado del minero (los conteos en MongoDB se conservan)"""
+        from config.database import db_manager
+
+        try:
+            await db_manager.redis_client.delete(self._key(job_id))
+        except Exception as e:
+            logger.error(f"Error eliminando plantillas del job {job_id}: {e}")
+
+    async def get_explanations(self, job_id: str) -> Dict[int, str]:
+        """Explicaciones ya generadas para las plantillas del job"""
+        from config.database import db_manager
+
+        explanations = {}
+        try:
+            cursor = db_manager.mongodb_client.logsanomaly.templates.find(
+                {"job_id": job_id, "explanation": {"$exists": True}},
+                {"template_id": 1, "explanation": 1}
+            )
+            async for doc in cursor:
+                explanations[doc["template_id"]] = doc["explanation"]
+        except Exception as e:
+            logger.error(f"Error obteniendo explicaciones del job {job_id}: {e}")
+        return explanations
+
+    async def update_counts(self, job_id: str, miner: TemplateMiner, counts: Dict[int, int],
+                            explanations: Optional[Dict[int, str]] = None):
+        """Suma los conteos de un chunk a cada plantilla del job (y guarda explicaciones nuevas)"""
+        from pymongo import UpdateOne
+        from config.database import db_manager
+
+        if not counts:
+            return
+        explanations = explanations or {}
+        now = datetime.utcnow()
+        operations = []
+        for template_id, count in counts.items():
+            cluster = miner.clusters[template_id]
+            fields = {"template": cluster.template, "updated_at": now}
+            if template_id in explanations:
+                fields["explanation"] = explanations[template_id]
+            operations.append(UpdateOne(
+                {"job_id": job_id, "template_id": template_id},
+                {"$inc": {"count": count}, "$set": fields,
+                 "$setOnInsert": {"example": cluster.example, "created_at": now}},
+                upsert=True
+            ))
+        try:
+            await db_manager.mongodb_client.logsanomaly.templates.bulk_write(operations, ordered=False)
+        except Exception as e:
+            logger.error(f"Error guardando conteos de plantillas del job {job_id}: {e}")
+
+    async def save_explanations(self, job_id: str, explanations: Dict[int, str]):
+        """Guarda explicaciones generadas fuera del procesamiento de un chunk"""
+        from pymongo import UpdateOne
+        from config.database import db_manager
+
+        if not explanations:
+            return
+        now = datetime.utcnow()
+        operations = [
+            UpdateOne(
+                {"job_id": job_id, "template_id": template_id},
+                {"$set": {"explanation": explanation, "updated_at": now}}
+            )
+            for template_id, explanation in explanations.items()
+        ]
+        try:
+            await db_manager.mongodb_client.logsanomaly.templates.bulk_write(operations, ordered=False)
+        except Exception as e:
+            logger.error(f"Error guardando explicaciones de plantillas del job {job_id}: {e}")
+
+# Instancia global del almacén
+template_store = TemplateStore()
@@ -0,0 +1,179 @@
+"""
+Selección de las K anomalías más fuertes por chunk (heap acotado) y por job (sorted set en Redis)
+"""
+import heapq
+import logging
+from itertools import count
+from typing import Any, Dict, Hashable, Iterable, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class TopK:
+    """
+    Las k entradas con menor score (más anómalas), una por clave.
+
+    Min-heap acotado sobre la intensidad (-score): la raíz es la entrada
+    menos anómala del top y se reemplaza en O(log k) cuando llega una más
+    anómala. Si una clave ya presente mejora su score, la entrada anterior
+    queda obsoleta en el heap y se descarta al llegar a la raíz.
+    """
+
+    def __init__(self, k: int):
+        self.k = k
+        self._heap: List[Tuple[float, int, Hashable, Any]] = []
+        self._best: Dict[Hashable, float] = {}
+        self._seq = count()
+
+    def __len__(self) -> int:
+        return len(self._best)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._best
+
+    def _prune(self):
+        while self._heap and self._best.get(self._heap[0][2]) != -self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    def push(self, key: Hashable, score: float, item: Any = None) -> bool:
+        """Ofrece una entrada; devuelve True si quedó dentro del top"""
+        if self.k <= 0:
+            return False
+        current = self._best.get(key)
+        if current is not None and current <= score:
+            return False
+        if current is None and len(self._best) >= self.k:
+            self._prune()
+            if score >= -self._heap[0][0]:
+                return False
+            _, _, evicted, _ = heapq.heappop(self._heap)
+            del self._best[evicted]
+        self._best[key] = score
+        heapq.heappush(self._heap, (-score, next(self._seq), key, item))
+        return True
+
+    def threshold(self) -> Optional[float]:
+        """Score que hay que mejorar para entrar al top (None si aún hay espacio)"""
+        if len(self._best) < self.k:
+            return None
+        self._prune()
+        return -self._heap[0][0]
+
+    def items(self) -> List[Tuple[float, Hashable, Any]]:
+        """(score, clave, item) de la más anómala a la menos anómala"""
+        valid = [(-neg, key, item) for neg, _, key, item in self._heap if self._best.get(key) == -neg]
+        return sorted(valid, key=lambda entry: entry[0])
+
+
+def top_k_indices(scores: Sequence[float], k: int) -> np.ndarray:
+    """Índices de los k scores más bajos, del más anómalo al menos anómalo (selección parcial O(n))"""
+    scores = np.asarray(scores, dtype=np.float64)
+    if k <= 0 or scores.size == 0:
+        return np.array([], dtype=np.int64)
+    if k < scores.size:
+        candidates = np.argpartition(scores, k - 1)[:k]
+    else:
+        candidates = np.arange(scores.size)
+    return candidates[np.argsort(scores[candidates], kind="stable")]
+
+
+class TopKStore:
+    """Top-K global de cada job: sorted set de Redis con la intensidad (-score) de cada plantilla
+
+    Es el conjunto de admisión del planificador de explicaciones: compartido
+    entre workers y persistente entre reinicios.
+    """
+
+    def __init__(self, ttl: int = 86400):
+        self.ttl = ttl
+
+    @staticmethod
+    def _key(job_id: str) -> str:
+        return f"anomalies:top:job:{job_id}"
+
+    @staticmethod
+    def _budget_key(job_id: str) -> str:
+        return f"anomalies:top:job:{job_id}:explained"
+
+    @staticmethod
+    def _redis():
+        from config.database import db_manager
+        return db_manager.redis_client
+
+    async def add(self, job_id: str, scores: Dict[str, float], k: int) -> Optional[Set[str]]:
+        """Agrega miembros (id -> score), recorta el conjunto a los k más anómalos y dice cuáles quedaron
+
+        Returns:
+            Miembros de scores que están en el top, o None si Redis no respondió
+        """
+        if not scores:
+            return set()
+        key = self._key(job_id)
+        members = list(scores)
+        try:
+            async with self._redis().pipeline(transaction=True) as pipe:
+                # gt: un miembro solo cambia si su intensidad aumenta (se conserva su peor score)
+                pipe.zadd(key, {member: -score for member, score in scores.items()}, gt=True)
+                # Rangos ascendentes: se eliminan los menos anómalos por encima de k
+                pipe.zremrangebyrank(key, 0, -(k + 1))
+                pipe.expire(key, self.ttl)
+                for member in members:
+                    pipe.zscore(key, member)
+                results = await pipe.execute()
+        except Exception as e:
+            logger.error(f"Error actualizando top-K del job {job_id}: {e}")
+            return None
+        return {member for member, score in zip(members, results[3:]) if score is not None}
+
+    async def contains(self, job_id: str, members: Iterable[str]) -> Optional[Set[str]]:
+        """Cuáles de members siguen en el top del job (ZSCORE); None si Redis no respondió"""
+        members = list(members)
+        if not members:
+            return set()
+        key = self._key(job_id)
+        try:
+            async with self._redis().pipeline(transaction=False) as pipe:
+                for member in members:
+                    pipe.zscore(key, member)
+                results = await pipe.execute()
+        except Exception as e:
+            logger.error(f"Error consultando top-K del job {job_id}: {e}")
+            return None
+        return {member for member, score in zip(members, results) if score is not None}
+
+    async def reserve(self, job_id: str, members: Sequence[str], k: int) -> Optional[List[str]]:
+        """Presupuesto de explicaciones del job (k en total, entre peticiones)
+
+        Returns:
+            members que se pueden explicar: los ya contados antes más los nuevos
+            que caben en el presupuesto (se cuentan); None si Redis no respondió
+        """
+        if not members:
+            return []
+        key = self._budget_key(job_id)
+        try:
+            redis = self._redis()
+            known = {m.decode("utf-8") if isinstance(m, bytes) else m for m in await redis.smembers(key)}
+            new = [member for member in members if member not in known][:max(0, k - len(known))]
+            if new:
+                async with redis.pipeline(transaction=True) as pipe:
+                    pipe.sadd(key, *new)
+                    pipe.expire(key, self.ttl)
+                    await pipe.execute()
+        except Exception as e:
+            logger.error(f"Error reservando explicaciones del job {job_id}: {e}")
+            return None
+        allowed = known.union(new)
+        return [member for member in members if member in allowed]
+
+    async def delete(self, job_id: str):
+        """Elimina el top-K del job y su presupuesto"""
+        try:
+            await self._redis().delete(self._key(job_id), self._budget_key(job_id))
+        except Exception as e:
+            logger.error(f"Error eliminando top-K del job {job_id}: {e}")
+
+# Instancia global del almacén
+top_k_store = TopKStore()
@@ -0,0 +1,276 @@
+"""
+Contadores por ventana deslizante (por IP, usuario, ruta y clase de estado) calculados en streaming
+"""
+import io
+import json
+import time
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from config.settings import load_settings
+from services.log_parser import ParsedLogs, timestamp_to_epoch
+
+logger = logging.getLogger(__name__)
+
+# Columnas que se agregan a las características del detector (log1p de cada conteo)
+WINDOW_FEATURES = (
+    "ip_count",          # eventos de la IP en la ventana
+    "ip_error_count",    # eventos con error (estado >= 400 o nivel de error) de la IP
+    "user_count",        # eventos del usuario
+    "path_count",        # eventos con el mismo prefijo de ruta (p. ej. /wp-admin)
+    "status_count"       # eventos con la misma clase de estado (2xx, 4xx, 5xx...)
+)
+
+ERROR_LEVELS = {"ERROR", "ERR", "FATAL", "CRITICAL", "CRIT", "ALERT", "EMERG", "SEVERE"}
+
+
+class WindowCounter:
+    """
+    Conteos por entidad en una ventana deslizante, con memoria acotada.
+
+    Cada entidad ocupa una fila de un arreglo circular de n_buckets
+    intervalos de bucket_seconds. Al avanzar el tiempo se vacía la columna
+    del intervalo que sale de la ventana y se descuenta del total de cada
+    fila, así el conteo de una entidad se lee en O(1). Las filas se asignan
+    con un LRU de max_entities: la entidad menos reciente cede su fila.
+    """
+
+    def __init__(self, window_seconds: int = 300, bucket_seconds: int = 10, max_entities: int = 10000):
+        self.bucket_seconds = bucket_seconds
+        self.n_buckets = max(1, -(-window_seconds // bucket_seconds))
+        self.max_entities = max_entities
+
+        self.counts = np.zeros((max_entities, self.n_buckets), dtype=np.int32)
+        self.totals = np.zeros(max_entities, dtype=np.int64)
+        self.current_bucket: Optional[int] = None
+        self._rows: "OrderedDict[str, int]" = OrderedDict()
+
+    def _advance(self, bucket: int):
+        """Mueve la ventana hasta bucket vaciando los intervalos que expiran"""
+        if self.current_bucket is None:
+            self.current_bucket = bucket
+            return
+        if bucket <= self.current_bucket:
+            return
+        steps = min(bucket - self.current_bucket, self.n_buckets)
+        for b in range(bucket - steps + 1, bucket + 1):
+            column = b % self.n_buckets
+            self.totals -= self.counts[:, column]
+            self.counts[:, column] = 0
+        self.current_bucket = bucket
+
+    def _row(self, key: str) -> int:
+        row = self._rows.get(key)
+        if row is not None:
+            self._rows.move_to_end(key)
+            return row
+        if len(self._rows) < self.max_entities:
+            row = len(self._rows)
+        else:
+            # Entidad menos reciente: su fila se reutiliza
+            _, row = self._rows.popitem(last=False)
+            self.counts[row] = 0
+            self.totals[row] = 0
+        self._rows[key] = row
+        return row
+
+    def add(self, key: Optional[str], timestamp: float, amount: int = 1) -> int:
+        """Cuenta un evento de la entidad y devuelve su conteo en la ventana
+
+        Con amount=0 solo avanza la ventana y lee el conteo.
+        """
+        bucket = int(timestamp // self.bucket_seconds)
+        self._advance(bucket)
+        if key is None:
+            return 0
+        if amount == 0:
+            return self.count(key)
+        row = self._row(key)
+        # Eventos atrasados: solo cuentan si su intervalo sigue dentro de la ventana
+        if self.current_bucket - bucket < self.n_buckets:
+            self.counts[row, bucket % self.n_buckets] += amount
+            self.totals[row] += amount
+        return int(self.totals[row])
+
+    def count(self, key: str) -> int:
+        row = self._rows.get(key)
+        return 0 if row is None else int(self.totals[row])
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def state(self) -> Dict:
+        """Solo las filas en uso (el resto del arreglo está en cero)"""
+        keys = list(self._rows)
+        rows = np.fromiter(self._rows.values(), dtype=np.int64, count=len(keys))
+        return {"keys": keys, "counts": self.counts[rows], "current_bucket": self.current_bucket}
+
+    def load_state(self, keys: List[str], counts: np.ndarray, current_bucket: Optional[int]):
+        keys = keys[-self.max_entities:]
+        counts = counts[-len(keys):] if keys else counts[:0]
+        self.counts[:] = 0
+        self.counts[:len(keys)] = counts
+        self.totals = self.counts.sum(axis=1, dtype=np.int64)
+        self._rows = OrderedDict((key, i) for i, key in enumerate(keys))
+        self.current_bucket = current_bucket
+
+
+def _path_prefix(path: Optional[str]) -> Optional[str]:
+    """Primer segmento de la ruta sin query: '/wp-admin/setup.php?x=1' -> '/wp-admin'"""
+    if not path:
+        return None
+    path = path.split("?", 1)[0]
+    segment = path.lstrip("/").split("/", 1)[0]
+    return "/" + segment
+
+
+class WindowFeatures:
+    """
+    Contadores por ventana de un job, alimentados con los campos parseados de cada línea.
+
+    La hora de cada evento sale de su timestamp; si no se puede leer se usa
+    la del último evento con hora (y, al inicio, la hora actual), así los
+    conteos siguen el orden del archivo y no el momento del procesamiento.
+    """
+
+    def __init__(self, window_seconds: Optional[int] = None, bucket_seconds: Optional[int] = None,
+                 max_entities: Optional[int] = None):
+        config = load_settings().get("window_features", {})
+        self.window_seconds = window_seconds or config.get("window_seconds", 300)
+        self.bucket_seconds = bucket_seconds or config.get("bucket_seconds", 10)
+        self.max_entities = max_entities or config.get("max_entities", 10000)
+
+        self.counters = {
+            name: WindowCounter(self.window_seconds, self.bucket_seconds, self.max_entities)
+            for name in WINDOW_FEATURES
+        }
+        self.last_timestamp: Optional[float] = None
+
+    def _timestamps(self, parsed: ParsedLogs) -> List[float]:
+        timestamps = []
+        last = self.last_timestamp
+        for value in parsed["timestamp"]:
+            epoch = timestamp_to_epoch(str(value)) if value is not None else None
+            if epoch is None:
+                epoch = last if last is not None else time.time()
+            timestamps.append(epoch)
+            last = epoch
+        self.last_timestamp = last
+        return timestamps
+
+    def update(self, parsed: ParsedLogs) -> np.ndarray:
+        """Cuenta cada línea y devuelve sus conteos en la ventana (log1p), una fila por línea"""
+        n = len(parsed)
+        result = np.zeros((n, len(WINDOW_FEATURES)), dtype=np.float64)
+        if n == 0:
+            return result
+
+        ip_counter = self.counters["ip_count"]
+        ip_error_counter = self.counters["ip_error_count"]
+        user_counter = self.counters["user_count"]
+        path_counter = self.counters["path_count"]
+        status_counter = self.counters["status_count"]
+
+        rows = zip(self._timestamps(parsed), parsed["ip"], parsed["user"], parsed["path"],
+                   parsed["status"], parsed["level"])
+        for i, (ts, ip, user, path, status, level) in enumerate(rows):
+            is_error = (status is not None and status >= 400) or (level is not None and level in ERROR_LEVELS)
+            status_class = f"{status // 100}xx" if status is not None else (level or None)
+            row = result[i]
+            row[0] = ip_counter.add(ip, ts)
+            row[1] = ip_error_counter.add(ip, ts, 1 if is_error else 0)
+            row[2] = user_counter.add(user, ts)
+            row[3] = path_counter.add(_path_prefix(path), ts)
+            row[4] = status_counter.add(status_class, ts)
+        return np.log1p(result)
+
+    def to_bytes(self) -> bytes:
+        """Serializa las ventanas (solo entidades activas) para guardarlas por job"""
+        meta = {
+            "window_seconds": self.window_seconds, "bucket_seconds": self.bucket_seconds,
+            "max_entities": self.max_entities, "last_timestamp": self.last_timestamp, "counters": {}
+        }
+        arrays = {}
+        for name, counter in self.counters.items():
+            state = counter.state()
+            meta["counters"][name] = {"keys": state["keys"], "current_bucket": state["current_bucket"]}
+            arrays[name] = state["counts"]
+        arrays["meta"] = np.frombuffer(json.dumps(meta).encode("utf-8"), dtype=np.uint8)
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, **arrays)
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "WindowFeatures":
+        """Reconstruye las ventanas serializadas con to_bytes"""
+        arrays = np.load(io.BytesIO(data))
+        meta = json.loads(arrays["meta"].tobytes().decode("utf-8"))
+        features = cls(meta["window_seconds"], meta["bucket_seconds"], meta["max_entities"])
+        features.last_timestamp = meta["last_timestamp"]
+        for name, state in meta["counters"].items():
+            if name in features.counters:
+                features.counters[name].load_state(state["keys"], arrays[name], state["current_bucket"])
+        return features
+
+
+def window_groups(ids: Sequence[int], window: np.ndarray, step: float = 0.5):
+    """Agrupa líneas por (ID, conteos de ventana cuantizados) para puntuar una vez por grupo
+
+    ids identifica líneas equivalentes (plantilla o línea única). Los conteos
+    (log1p) se redondean a múltiplos de step, así una ráfaga de líneas
+    equivalentes sigue formando pocos grupos.
+
+    Returns:
+        (conteos cuantizados, índice de la primera línea, inverso y tamaño de cada grupo)
+    """
+    quantized = np.round(np.asarray(window, dtype=np.float64) / step) * step
+    keys = np.column_stack([np.asarray(ids, dtype=np.float64), quantized])
+    _, first_index, inverse, counts = np.unique(keys, axis=0, return_index=True, return_inverse=True, return_counts=True)
+    return quantized, first_index, inverse.reshape(-1), counts
+
+
+class WindowFeatureStore:
+    """Persiste las ventanas de cada job en Redis entre chunks"""
+
+    def __init__(self, ttl: int = 86400):
+        self.ttl = ttl
+
+    @staticmethod
+    def _key(job_id: str) -> str:
+        return f"windows:job:{job_id}"
+
+    async def load(self, job_id: str) -> WindowFeatures:
+        """Obtiene las ventanas del job o crea unas nuevas"""
+        from config.database import db_manager
+
+        try:
+            data = await db_manager.redis_client.get(self._key(job_id))
+            if data:
+                return WindowFeatures.from_bytes(data)
+        except Exception as e:
+            logger.error(f"Error cargando ventanas del job {job_id}: {e}")
+        return WindowFeatures()
+
+    async def save(self, job_id: str, features: WindowFeatures):
+        """Guarda el estado de las ventanas del job"""
+        from config.database import db_manager
+
+        try:
+            await db_manager.redis_client.set(self._key(job_id), features.to_bytes(), ex=self.ttl)
+        except Exception as e:
+            logger.error(f"Error guardando ventanas del job {job_id}: {e}")
+
+    async def delete(self, job_id: str):
+        """Elimina el estado de las ventanas del job"""
+        from config.database import db_manager
+
+        try:
+            await db_manager.redis_client.delete(self._key(job_id))
+        except Exception as e:
+            logger.error(f"Error eliminando ventanas del job {job_id}: {e}")
+
+# Instancia global del almacén
+window_feature_store = WindowFeatureStore()
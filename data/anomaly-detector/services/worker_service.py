@@ -2,10 +2,10 @@ import asyncio
 import time
 import os
 import sys
-import re
 import json
+import numpy as np
 from datetime import datetime
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple
 
 # Agregar el directorio padre al path para importaciones
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -17,142 +17,187 @@ from config.database import db_manager
 from models.v2_models import ChunkResult, AnomalyResultV2
 from services.chunk_service import chunk_service
 from services.explanation_service import explanation_service
+from services.feature_extractor import extract_features_batch
+from services.log_parser import log_parser
+from services.pattern_matcher import pattern_matcher
+from services.streaming_detector import HalfSpaceTrees, streaming_detector_store
+from services.template_miner import TemplateMiner, mask_lines, template_groups, template_store
+from services.line_dedup import collapse_lines, MAX_LINE_NUMBERS
+from services.window_features import WindowFeatures, window_feature_store, window_groups
+from services.top_k import TopK
+from services.explanation_scheduler import ExplanationRequest, explanation_scheduler
+from services.llm_controller import llm_controller
+from services.circuit_breaker import CLOSED, llm_breaker
+from services.reexplain_queue import reexplain_queue
+from services.anomaly_clusters import anomaly_clusterer, anomaly_cluster_store
+from config.settings import load_settings
 
 class WorkerService:
     def __init__(self):
         self.max_workers = 1  # Limitar a un solo worker para evitar concurrencia
         self.workers = []
         self.current_processing_job = None  # Track del job actual
+        self._explaining: Dict[str, asyncio.Future] = {}  # Explicaciones a demanda en curso, por anomalía
     
-    async def process_chunk(self, chunk_data: Dict[str, Any], job_id: str = None) -> ChunkResult:
-        """Procesa un chunk individual con streaming de resultados"""
+    async def process_chunk(self, chunk_data: Dict[str, Any], job_id: str = None,
+                            explain: bool = True) -> ChunkResult:
+        """Procesa un chunk individual con streaming de resultados
+        
+        Con job_id las anomalías sin explicación se encolan en el planificador
+        global (salvo con explain=False); sin job_id se explican en el momento.
+        """
         start_time = time.time()
         chunk_id = str(chunk_data["_id"])
         
         print(f"Procesando chunk {chunk_id} con {len(chunk_data['data'])} caracteres")
         
+        # Detector incremental y plantillas: el estado del job se conserva entre chunks
+        if job_id:
+            detector = await streaming_detector_store.load(job_id)
+            miner = await template_store.load(job_id)
+            template_explanations = await template_store.get_explanations(job_id)
+            template_explanations.update(explanation_scheduler.explained(job_id))
+            windows = await window_feature_store.load(job_id)
+            clusters = await anomaly_cluster_store.load(job_id) if anomaly_clusterer.enabled else None
+        else:
+            detector = HalfSpaceTrees()
+            miner = TemplateMiner()
+            template_explanations = {}
+            windows = WindowFeatures()
+            clusters = None
+        chunk_template_counts: Dict[int, int] = {}
+        new_explanations: Dict[int, str] = {}
+        
         # Extraer características y detectar anomalías
         lines = chunk_data["data"].split('\n')
-        anomalies = []
         
-        # Procesar en lotes para eficiencia y evitar colapso del LLM
+        # Procesar en lotes para eficiencia; solo las top_k anomalías más fuertes se conservan
         batch_size = 50  # Procesar de 50 en 50 líneas
-        max_anomalies_per_chunk = 100  # Limitar anomalías para evitar colapso del LLM
+        top_k = load_settings().get("anomaly_detection", {}).get("top_k", 100)
+        chunk_top = TopK(top_k)
         total_lines = len([line for line in lines if line.strip()])
         processed_lines = 0
-        total_anomalies_processed = 0
         
-        for i in range(0, len(lines), batch_size):
-            # Verificar límite de anomalías para evitar colapso del LLM
-            if total_anomalies_processed >= max_anomalies_per_chunk:
-                print(f"Límite de {max_anomalies_per_chunk} anomalías alcanzado para chunk {chunk_id}")
-                break
-                
-            batch = lines[i:i + batch_size]
-            batch_anomalies = []
-            
-            # 1. Detectar anomalías en el batch completo
-            anomaly_lines = []
-            for line in batch:
-                if line.strip():
-                    # Detectar anomalías basadas en contenido
-                    is_anomaly = False
-                    score = 0.0
-                    
-                    # Verificar palabras clave sospechosas
-                    suspicious_keywords = ['error', 'failed', 'unauthorized', 'exception', 'timeout', 'denied', 'critical', 'fatal', 'warning']
-                    keyword_count = sum(1 for keyword in suspicious_keywords if keyword in line.lower())
-                    
-                    if keyword_count > 0:
-                        is_anomaly = True
-                        score = -0.1 * keyword_count  # Más negativo si hay más palabras sospechosas
-                    
-                    # Verificar patrones inusuales
-                    if not is_anomaly:
-                        # Detectar logs con muchas mayúsculas (posible error)
-                        if len(re.findall(r'[A-Z]', line)) > len(line) * 0.3:
-                            is_anomaly = True
-                            score = -0.05
-                        
-                        # Detectar logs muy largos o muy cortos
-                        elif len(line) > 500 or len(line) < 20:
-                            is_anomaly = True
-                            score = -0.03
-                        
-                        # Detectar patrones de acceso sospechoso
-                        elif any(pattern in line.lower() for pattern in ['/admin', '/login', '/wp-admin', '/.env']):
-                            is_anomaly = True
-                            score = -0.08
-                    
-                    if is_anomaly:
-                        anomaly_lines.append((line, score))
-                    
-                    processed_lines += 1
+        # Líneas repetidas (iguales tras enmascarar valores variables): plantilla, reglas y
+        # resultado se calculan una vez por línea única del chunk
+        positions = [k for k, line in enumerate(lines) if line.strip()]
+        chunk_lines = [lines[k] for k in positions]
+        masked_lines = mask_lines(chunk_lines)
+        line_groups = collapse_lines(chunk_lines, masked_lines)
+        unique_lines = line_groups.select(chunk_lines)
+        group_templates = miner.add_lines(unique_lines, line_groups.select(masked_lines), line_groups.counts)
+        line_templates = np.asarray(group_templates, dtype=np.int64)[line_groups.inverse]
+        unique_ids, _, _, counts = template_groups(line_templates)
+        chunk_template_counts.update(zip(unique_ids.tolist(), counts.tolist()))
+        # Reglas explícitas: palabras clave y rutas sospechosas (config.yml) siempre se reportan
+        group_hits = pattern_matcher.match_batch(unique_lines, groups=('suspicious_keywords', 'suspicious_paths'))
+        print(f"Chunk {chunk_id}: {len(chunk_lines)} líneas, {len(unique_lines)} únicas")
+        
+        # Formato del job detectado con el inicio del chunk (se reutiliza en los siguientes chunks)
+        log_format = log_parser.format_for(chunk_lines[:log_parser.sample_size], source=job_id)
+        
+        # 1. Detectar anomalías en todo el chunk (sin LLM): una fila por línea única y nivel de
+        #    actividad (conteos de IP, usuario, ruta y estado en la ventana del job), con la rareza
+        #    de su plantilla. Cada línea única entra al top con su score más bajo.
+        for i in range(0, len(chunk_lines), batch_size):
+            batch_lines = chunk_lines[i:i + batch_size]
+            batch_groups = line_groups.inverse[i:i + batch_size]
             
-            # 2. Procesar anomalías en lotes con LLM (solo si hay anomalías)
-            if anomaly_lines:
-                # Limitar anomalías del batch para evitar colapso
-                remaining_anomalies = max_anomalies_per_chunk - total_anomalies_processed
-                if len(anomaly_lines) > remaining_anomalies:
-                    anomaly_lines = anomaly_lines[:remaining_anomalies]
-                    print(f"Limitando anomalías del batch a {remaining_anomalies} para evitar colapso del LLM")
-                
-                print(f"Procesando {len(anomaly_lines)} anomalías con LLM para chunk {chunk_id}")
-                # Procesar anomalías con LLM en lotes
-                llm_batch_size = 5  # Procesar 5 anomalías por llamada al LLM
-                
-                for j in range(0, len(anomaly_lines), llm_batch_size):
-                    llm_batch = anomaly_lines[j:j + llm_batch_size]
-                    print(f"Procesando lote {j//llm_batch_size + 1} de {len(llm_batch)} anomalías")
-                    
-                    # Obtener explicaciones para todo el lote de una vez
-                    explanations = await explanation_service.get_batch_explanations(llm_batch)
-                    print(f"Explicaciones obtenidas: {len(explanations)}")
-                    
-                    # Crear resultados para cada anomalía
-                    for (line, score), explanation in zip(llm_batch, explanations):
-                        anomaly_result = AnomalyResultV2(
-                            log_entry=line,
-                            score=score,
-                            is_anomaly=True,
-                            explanation=explanation,
-                            chunk_id=chunk_id
-                        )
-                        batch_anomalies.append(anomaly_result)
-                        anomalies.append(anomaly_result)
-                    
-                    print(f"Lote procesado, total anomalías: {len(anomalies)}")
-                
-                total_anomalies_processed += len(anomaly_lines)
-            else:
-                print(f"No hay anomalías para procesar en chunk {chunk_id}")
+            parsed = log_parser.parse(batch_lines, log_format=log_format)
+            window, first_index, _, counts = window_groups(batch_groups, windows.update(parsed))
             
-            # 3. Guardar batch inmediatamente para evitar pérdida de datos
-            if batch_anomalies:
-                print(f"Guardando {len(batch_anomalies)} anomalías del batch en MongoDB")
-                batch_result = ChunkResult(
-                    chunk_id=chunk_id,
-                    anomalies=batch_anomalies,
-                    processing_time=time.time() - start_time
-                )
-                await db_manager.mongodb_client.logsanomaly.results.insert_one(batch_result.dict())
-                print(f"✅ Batch guardado en MongoDB: {len(batch_anomalies)} anomalías")
+            features = extract_features_batch([batch_lines[k] for k in first_index])
+            features = np.column_stack([
+                features, miner.rarity(line_templates[i + first_index]), window[first_index]
+            ])
+            if detector.is_initialized and detector.n_features != features.shape[1]:
+                # Estado guardado con otro conjunto de características: se reinicia el detector
+                detector = HalfSpaceTrees()
+            scores = detector.score_learn(features, sample_weight=counts)
             
-            # 4. Publicar progreso del batch si hay job_id (para streaming en UI)
-            if job_id and batch_anomalies:
-                await self._publish_batch_progress(job_id, chunk_id, batch_anomalies, processed_lines, total_lines)
+            for k, score in zip(first_index.tolist(), scores.tolist()):
+                group = int(batch_groups[k])
+                hits = group_hits[group]
+                keyword_count = pattern_matcher.count(hits, 'suspicious_keywords')
+                if keyword_count > 0:
+                    score = min(score, -0.1 * keyword_count)  # Más negativo si hay más palabras sospechosas
+                elif 'suspicious_paths' in hits:
+                    score = min(score, -0.08)
+                
+                if score < 0:
+                    chunk_top.push(group, score, (batch_lines[k], parsed.row(k)))
             
-            # Pequeña pausa para permitir streaming
-            await asyncio.sleep(0.1)
+            processed_lines += len(batch_lines)
+            await asyncio.sleep(0)  # Ceder el event loop entre lotes
+        
+        # 2. Resultados del top del chunk, de la anomalía más fuerte a la más débil
+        #    (explicación de la plantilla si ya existe; si no, se completa al explicar el top)
+        anomalies = []
+        for score, group, (line, fields) in chunk_top.items():
+            template_id = group_templates[group]
+            anomalies.append(AnomalyResultV2(
+                log_entry=line,
+                score=score,
+                is_anomaly=True,
+                explanation=template_explanations.get(template_id, ""),
+                chunk_id=chunk_id,
+                template_id=template_id,
+                template=miner.template(template_id),
+                fields=fields,
+                count=int(line_groups.counts[group]),
+                positions=[positions[k] for k in line_groups.positions(group, MAX_LINE_NUMBERS)]
+            ))
+        print(f"Chunk {chunk_id}: {len(anomalies)} anomalías en el top (límite: {top_k})")
+        
+        if clusters is not None and anomalies:
+            # Plantillas parecidas (misma traza con otro ID, mismo escáner en otra ruta) forman un
+            # grupo: se explica su representante y el resto copia la explicación
+            templates = {}
+            for anomaly in anomalies:
+                templates.setdefault(anomaly.template_id, anomaly.template or anomaly.log_entry)
+            assignments = await anomaly_clusterer.assign(clusters, templates)
+            for anomaly in anomalies:
+                anomaly.cluster_id, anomaly.cluster_similarity = assignments[anomaly.template_id]
+                copied = template_explanations.get(anomaly.cluster_id)
+                if not anomaly.explanation and copied:
+                    anomaly.explanation = copied
+                    new_explanations[anomaly.template_id] = copied
+        
+        if not job_id:
+            new_explanations.update(await self._explain_anomalies(anomalies, template_explanations))
+        
+        # 3. Guardar resultados del chunk y publicar progreso (para streaming en UI)
+        if anomalies:
+            chunk_result = ChunkResult(
+                chunk_id=chunk_id,
+                job_id=job_id,
+                anomalies=anomalies,
+                processing_time=time.time() - start_time
+            )
+            await db_manager.mongodb_client.logsanomaly.results.insert_one(chunk_result.dict())
+            print(f"✅ Resultados guardados en MongoDB: {len(anomalies)} anomalías")
+            if job_id:
+                await self._publish_batch_progress(job_id, chunk_id, anomalies, processed_lines, total_lines)
+                if explain:
+                    # Los consumidores explican primero las más anómalas del job, sin esperar al resto del archivo
+                    await self._schedule_explanations(job_id, anomalies)
+        
+        if job_id:
+            await streaming_detector_store.save(job_id, detector)
+            await template_store.save(job_id, miner)
+            await window_feature_store.save(job_id, windows)
+            if clusters is not None:
+                await anomaly_cluster_store.save(job_id, clusters)
+            await template_store.update_counts(job_id, miner, chunk_template_counts, new_explanations)
         
         processing_time = time.time() - start_time
         
         print(f"Chunk {chunk_id} procesado: {len(anomalies)} anomalías encontradas en {processing_time:.2f}s")
-        print(f"Total anomalías procesadas: {total_anomalies_processed} (límite: {max_anomalies_per_chunk})")
         
-        # Crear resultado final (ya se guardó por batches)
+        # Crear resultado final (ya se guardó en MongoDB)
         result = ChunkResult(
             chunk_id=chunk_id,
+            job_id=job_id,
             anomalies=anomalies,
             processing_time=processing_time
         )
@@ -162,8 +207,242 @@ class WorkerService:
         
         return result
     
-    async def process_file_async(self, file_id: str):
-        """Procesa todos los chunks de un archivo de forma secuencial (un archivo a la vez)"""
+    async def _explain_anomalies(self, anomalies: List[AnomalyResultV2],
+                                 template_explanations: Dict[int, str]) -> Dict[int, str]:
+        """Explica con el LLM una anomalía por plantilla aún no explicada y asigna las explicaciones
+        
+        Returns:
+            Explicaciones nuevas por plantilla
+        """
+        pending = {}
+        for anomaly in anomalies:
+            if anomaly.template_id not in template_explanations and anomaly.template_id not in pending:
+                pending[anomaly.template_id] = (anomaly.log_entry, anomaly.score)
+        
+        print(f"Explicando {len(anomalies)} anomalías ({len(pending)} plantillas nuevas) con LLM")
+        pending_items = list(pending.items())
+        new_explanations = {}
+        next_item = 0
+        
+        async def explain_batches():
+            # Cada lote toma el tamaño que fija el controlador adaptativo en ese momento
+            nonlocal next_item
+            while next_item < len(pending_items):
+                batch_size = llm_controller.batch_size
+                llm_batch = pending_items[next_item:next_item + batch_size]
+                next_item += len(llm_batch)
+                explanations = await explanation_service.get_batch_explanations([item for _, item in llm_batch])
+                print(f"Explicaciones obtenidas: {len(explanations)} (lote de {batch_size})")
+                for (template_id, _), explanation in zip(llm_batch, explanations):
+                    template_explanations[template_id] = explanation
+                    new_explanations[template_id] = explanation
+        
+        # Lotes en paralelo: el cliente de Ollama limita cuántos están en curso según el controlador
+        await asyncio.gather(*(explain_batches() for _ in range(llm_controller.max_concurrency)))
+        
+        for anomaly in anomalies:
+            anomaly.explanation = template_explanations.get(anomaly.template_id, anomaly.explanation)
+        return new_explanations
+    
+    async def _schedule_explanations(self, job_id: str, anomalies: List[AnomalyResultV2]):
+        """Encola en el planificador global las plantillas del chunk que aún no tienen explicación
+        
+        Debe llamarse después de guardar el chunk: las explicaciones se propagan
+        a las anomalías ya guardadas de cada plantilla.
+        """
+        requests: Dict[int, ExplanationRequest] = {}
+        for anomaly in anomalies:  # De la más a la menos anómala
+            if anomaly.explanation:
+                continue
+            # Un pedido por grupo de anomalías parecidas (o por plantilla, sin agrupamiento)
+            key = anomaly.cluster_id if anomaly.cluster_id is not None else anomaly.template_id
+            request = requests.get(key)
+            if request is None:
+                request = requests[key] = ExplanationRequest(job_id, key, anomaly.log_entry, anomaly.score, [])
+            request.anomaly_ids.append(anomaly.anomaly_id)
+            if anomaly.template_id != key and anomaly.template_id not in request.members:
+                request.members.append(anomaly.template_id)
+        if not requests:
+            return
+        # Los consumidores arrancan con el primer job que explica en este event loop
+        explanation_scheduler.start(self._explain_scheduled)
+        reexplain_queue.start(self._reexplain)
+        already = await explanation_scheduler.submit(job_id, list(requests.values()))
+        if already:
+            # Se explicaron mientras se procesaba el chunk
+            await self._store_template_explanations(job_id, {
+                template_id: already[key] for key, request in requests.items() if key in already
+                for template_id in request.template_ids()
+            })
+    
+    async def _explain_scheduled(self, job_id: str, batch: List[ExplanationRequest]) -> Dict[int, str]:
+        """Consumidor del planificador: explica un lote de plantillas, lo guarda y lo publica
+        
+        Con llm.stream_explanations activo cada explicación se publica por tokens
+        en el canal del job mientras el modelo la genera. Las plantillas que el
+        LLM no explicó (circuito abierto, errores) se publican con la explicación
+        de respaldo y quedan en la cola de reexplicación.
+        """
+        async def publish_partial(index: int, delta: str, text: str):
+            request = batch[index]
+            await self._publish_explanation_delta(job_id, request.template_id, request.anomaly_ids, delta, text)
+        on_partial = publish_partial if load_settings().get("llm", {}).get("stream_explanations", True) else None
+        
+        explanations = await explanation_service.get_batch_explanations(
+            [(request.log_entry, request.score) for request in batch], on_partial=on_partial, with_fallback=False
+        )
+        new_explanations = {template_id: explanation for request, explanation in zip(batch, explanations)
+                            if explanation for template_id in request.template_ids()}
+        print(f"Job {job_id}: {sum(1 for e in explanations if e)} de {len(batch)} grupos explicados, "
+              f"{len(new_explanations)} plantillas (score más bajo: {batch[0].score:.3f})")
+        await self._store_template_explanations(job_id, new_explanations)
+        for request, explanation in zip(batch, explanations):
+            if explanation:
+                await self._publish_explanation_completed(job_id, request.template_id, request.anomaly_ids, explanation)
+        await self._defer_explanations([request for request, explanation in zip(batch, explanations) if not explanation])
+        return new_explanations
+    
+    async def _defer_explanations(self, requests: List[ExplanationRequest], attempts: int = 0):
+        """Publica la explicación de respaldo de plantillas sin explicación del LLM y las encola para más tarde
+        
+        Las anomalías guardadas siguen sin explicación hasta que el LLM responda;
+        si no se pueden encolar (o se agotaron los intentos) se guarda el respaldo.
+        """
+        if not requests:
+            return
+        queued = attempts < reexplain_queue.max_attempts and await reexplain_queue.push(requests, attempts)
+        if queued:
+            reexplain_queue.start(self._reexplain)
+        for request in requests:
+            fallback = explanation_service._generate_fallback_explanation(request.log_entry, request.score)
+            if not queued:
+                # Solo en las anomalías: la plantilla sigue pudiendo explicarse en otro job
+                await self._store_template_explanations(
+                    request.job_id, {template_id: fallback for template_id in request.template_ids()}, remember=False
+                )
+            await self._publish_explanation_completed(request.job_id, request.template_id, request.anomaly_ids,
+                                                      fallback, fallback=True)
+        print(f"{len(requests)} plantillas con explicación de respaldo"
+              f"{' (en cola para reexplicar)' if queued else ''}")
+    
+    async def _reexplain(self, items: List[Tuple[ExplanationRequest, int]]):
+        """Consumidor de la cola de reexplicación: explica con el LLM plantillas que quedaron con respaldo"""
+        by_job: Dict[str, List[Tuple[ExplanationRequest, int]]] = {}
+        for request, attempts in items:
+            by_job.setdefault(request.job_id, []).append((request, attempts))
+        for job_id, group in by_job.items():
+            explanations = await explanation_service.get_batch_explanations(
+                [(request.log_entry, request.score) for request, _ in group], with_fallback=False
+            )
+            new_explanations = {template_id: explanation for (request, _), explanation in zip(group, explanations)
+                                if explanation for template_id in request.template_ids()}
+            await self._store_template_explanations(job_id, new_explanations)
+            for (request, _), explanation in zip(group, explanations):
+                if explanation:
+                    await self._publish_explanation_completed(job_id, request.template_id, request.anomaly_ids,
+                                                              explanation)
+            # Los rechazos del circuito abierto no gastan intentos
+            spent = 1 if llm_breaker.state == CLOSED else 0
+            for (request, attempts), explanation in zip(group, explanations):
+                if not explanation:
+                    await self._defer_explanations([request], attempts + spent)
+            print(f"Job {job_id}: {len(new_explanations)} de {len(group)} plantillas reexplicadas")
+    
+    async def _store_template_explanations(self, job_id: str, new_explanations: Dict[int, str],
+                                           remember: bool = True):
+        """Guarda explicaciones de plantillas y las propaga a las anomalías del job que aún no tienen
+        
+        Con remember=False no se guardan en el almacén de plantillas (explicaciones de respaldo).
+        """
+        from pymongo import UpdateMany
+        
+        if not new_explanations:
+            return
+        results = db_manager.mongodb_client.logsanomaly.results
+        # Las anomalías guardadas sin explicación toman la de su plantilla
+        operations = [
+            UpdateMany(
+                {"job_id": job_id},
+                {"$set": {"anomalies.$[a].explanation": explanation}},
+                array_filters=[{"a.template_id": template_id, "a.explanation": ""}]
+            )
+            for template_id, explanation in new_explanations.items()
+        ]
+        await results.bulk_write(operations, ordered=False)
+        if remember:
+            await template_store.save_explanations(job_id, new_explanations)
+    
+    async def explain_anomaly(self, anomaly_id: str) -> Optional[Dict[str, Any]]:
+        """Explicación de una anomalía guardada; si aún no tiene, se genera con el LLM y se guarda
+        
+        Pensado para jobs en modo solo detección: el LLM se consulta únicamente
+        por las anomalías que alguien abre. Varias peticiones simultáneas por la
+        misma anomalía comparten una sola generación.
+        
+        Returns:
+            None si la anomalía no existe; si no, la explicación con generated
+            (se generó ahora) y fallback (el LLM no respondió y no se guardó)
+        """
+        doc = await db_manager.mongodb_client.logsanomaly.results.find_one(
+            {"anomalies.anomaly_id": anomaly_id}, {"job_id": 1, "anomalies.$": 1}
+        )
+        if not doc:
+            return None
+        anomaly = AnomalyResultV2(**doc["anomalies"][0])
+        result = {
+            "anomaly_id": anomaly_id,
+            "job_id": doc.get("job_id"),
+            "template_id": anomaly.template_id,
+            "explanation": anomaly.explanation,
+            "generated": False,
+            "fallback": False
+        }
+        if anomaly.explanation:
+            return result
+        
+        future = self._explaining.get(anomaly_id)
+        if future is None:
+            future = asyncio.ensure_future(self._generate_explanation(doc["_id"], doc.get("job_id"), anomaly))
+            self._explaining[anomaly_id] = future
+            future.add_done_callback(lambda _: self._explaining.pop(anomaly_id, None))
+        # shield: si el cliente se desconecta, la generación termina y se guarda igual
+        explanation = await asyncio.shield(future)
+        
+        if explanation is None:
+            result["explanation"] = explanation_service._generate_fallback_explanation(anomaly.log_entry, anomaly.score)
+            result["fallback"] = True
+        else:
+            result["explanation"] = explanation
+            result["generated"] = True
+        return result
+    
+    async def _generate_explanation(self, doc_id: Any, job_id: Optional[str],
+                                    anomaly: AnomalyResultV2) -> Optional[str]:
+        """Genera y guarda la explicación de una anomalía (None si el LLM no respondió)"""
+        explanation = None
+        if job_id and anomaly.template_id is not None:
+            # Otra anomalía de la misma plantilla pudo explicarse antes
+            explanation = (await template_store.get_explanations(job_id)).get(anomaly.template_id)
+        if not explanation:
+            explanation = await explanation_service.explain_on_demand(anomaly.log_entry, anomaly.score)
+        if not explanation:
+            return None
+        
+        await db_manager.mongodb_client.logsanomaly.results.update_one(
+            {"_id": doc_id},
+            {"$set": {"anomalies.$[a].explanation": explanation}},
+            array_filters=[{"a.anomaly_id": anomaly.anomaly_id}]
+        )
+        if job_id and anomaly.template_id is not None:
+            await self._store_template_explanations(job_id, {anomaly.template_id: explanation})
+        return explanation
+    
+    async def process_file_async(self, file_id: str, explain: bool = True):
+        """Procesa todos los chunks de un archivo de forma secuencial (un archivo a la vez)
+        
+        Con explain=False (modo solo detección) el job termina sin consultar al
+        LLM; las explicaciones se generan a demanda con explain_anomaly.
+        """
         # Verificar si ya hay un job procesándose
         if self.current_processing_job and self.current_processing_job != file_id:
             print(f"Ya hay un archivo procesándose: {self.current_processing_job}. Esperando...")
@@ -186,15 +465,33 @@ class WorkerService:
             # Procesar chunks secuencialmente para evitar sobrecarga del LLM
             for i, chunk in enumerate(chunks):
                 print(f"Procesando chunk {i+1}/{len(chunks)} del archivo {file_id}")
-                result = await self.process_chunk(chunk, file_id)
+                result = await self.process_chunk(chunk, file_id, explain)
                 results.append(result)
                 
                 # Publicar progreso del chunk
                 await self._publish_chunk_progress(file_id, i+1, len(chunks))
             
+            # Esperar a que el planificador termine las explicaciones del job
+            if explain:
+                try:
+                    explanations = await explanation_scheduler.join(file_id)
+                    # Plantillas creadas después de su explicación y anomalías guardadas mientras se explicaban
+                    await self._store_template_explanations(file_id, explanations)
+                    await self._publish_explanations(file_id, explanations)
+                except Exception as e:
+                    print(f"Error completando las explicaciones del job {file_id}: {e}")
+            else:
+                print(f"Job {file_id} en modo solo detección: explicaciones a demanda")
+            
             # Actualizar estado del job a completado
             await self._update_job_status(file_id, "completed")
             
+            # El estado del detector y del minero ya no se necesita (los conteos quedan en MongoDB)
+            await streaming_detector_store.delete(file_id)
+            await template_store.delete(file_id)
+            await window_feature_store.delete(file_id)
+            await anomaly_cluster_store.delete(file_id)
+            
             # Publicar evento de completado
             await self._publish_job_completed(file_id)
             
@@ -225,6 +522,75 @@ class WorkerService:
         except Exception as e:
             print(f"Error publicando progreso del batch: {e}")
     
+    async def _publish_explanations(self, job_id: str, explanations: Dict[int, str]):
+        """Publica el cierre de las explicaciones del job (todas, por plantilla)"""
+        try:
+            explanation_data = {
+                "type": "explanations_ready",
+                "job_id": job_id,
+                "explanations": {str(template_id): text for template_id, text in explanations.items()},
+                "timestamp": datetime.utcnow().isoformat()
+            }
+            
+            # Publicar a Redis para streaming
+            await db_manager.redis_client.publish(
+                f"stream:job:{job_id}",
+                json.dumps(explanation_data, default=str)
+            )
+            
+        except Exception as e:
+            print(f"Error publicando explicaciones del job: {e}")
+    
+    async def _publish_explanation_delta(self, job_id: str, template_id: int, anomaly_ids: List[str],
+                                         delta: str, text: str):
+        """Publica los tokens nuevos de una explicación en curso"""
+        try:
+            delta_data = {
+                "type": "explanation_delta",
+                "job_id": job_id,
+                "template_id": template_id,
+                "anomaly_ids": anomaly_ids,
+                "delta": delta,
+                "text": text,
+                "timestamp": datetime.utcnow().isoformat()
+            }
+            
+            # Publicar a Redis para streaming
+            await db_manager.redis_client.publish(
+                f"stream:job:{job_id}",
+                json.dumps(delta_data)
+            )
+            
+        except Exception as e:
+            print(f"Error publicando tokens de la explicación: {e}")
+    
+    async def _publish_explanation_completed(self, job_id: str, template_id: int, anomaly_ids: List[str],
+                                             explanation: str, fallback: bool = False):
+        """Publica la explicación final de una plantilla (ya limpia, reemplaza el texto parcial)
+        
+        fallback indica una explicación de respaldo; si la plantilla quedó en la cola de
+        reexplicación, más tarde llega otro evento con la del LLM.
+        """
+        try:
+            completed_data = {
+                "type": "explanation_completed",
+                "job_id": job_id,
+                "template_id": template_id,
+                "anomaly_ids": anomaly_ids,
+                "explanation": explanation,
+                "fallback": fallback,
+                "timestamp": datetime.utcnow().isoformat()
+            }
+            
+            # Publicar a Redis para streaming
+            await db_manager.redis_client.publish(
+                f"stream:job:{job_id}",
+                json.dumps(completed_data)
+            )
+            
+        except Exception as e:
+            print(f"Error publicando explicación completada: {e}")
+    
     async def _publish_chunk_progress(self, job_id: str, current_chunk: int, total_chunks: int):
         """Publica progreso de procesamiento de chunks"""
         try:
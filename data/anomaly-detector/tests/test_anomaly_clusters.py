@@ -0,0 +1,94 @@
+import asyncio
+
+import numpy as np
+from models.v2_models import AnomalyResultV2
+from services import worker_service as worker_module
+from services.anomaly_clusters import AnomalyClusterer, ClusterIndex, hashing_embeddings
+
+def test_hashing_embeddings_follow_shared_words():
+    vectors = hashing_embeddings([
+        "ERROR [<TS>] NullPointerException at OrderService.process id=<NUM>",
+        "ERROR [<TS>] NullPointerException at OrderService.process id=<HEX>",
+        "ERROR [<TS>] NullPointerException at OrderService.process while saving",
+        "INFO [<TS>] User logged in",
+    ], 256)
+
+    similarities = vectors @ vectors[0]
+    assert np.isclose(similarities[1], 1.0)   # solo cambia el valor enmascarado
+    assert similarities[2] > 0.7
+    assert similarities[3] < 0.3
+    assert np.allclose(np.linalg.norm(vectors, axis=1), 1.0)
+
+def test_index_assigns_incrementally_and_round_trips():
+    index = ClusterIndex(threshold=0.8)
+    vectors = hashing_embeddings(["GET /wp-admin/setup.php scanner probe", "GET /wp-admin/install.php scanner probe",
+                                  "disk full on volume"], 64)
+
+    assert index.assign([1, 2], vectors[:2]) == [(1, 1.0), (1, index.assignments[2][1])]
+    assert index.assignments[2][1] >= 0.8
+    restored = ClusterIndex.from_bytes(index.to_bytes())
+    # Un chunk posterior: las plantillas vistas conservan su grupo
+    assert restored.assign([3, 2], vectors[[2, 1]]) == [(3, 1.0), index.assignments[2]]
+    assert restored.representatives == [1, 3]
+
+def test_max_clusters_bounds_index():
+    index = ClusterIndex(threshold=0.99, max_clusters=1)
+    vectors = hashing_embeddings(["alpha beta", "gamma delta"], 64)
+
+    assert index.assign([1, 2], vectors) == [(1, 1.0), (2, 1.0)]
+    assert len(index) == 1
+
+def test_one_request_per_cluster_and_explanation_copied_to_members(monkeypatch):
+    worker = worker_module.WorkerService()
+    anomalies = [
+        AnomalyResultV2(log_entry="ERROR login failed for admin", score=-0.4, is_anomaly=True, explanation="",
+                        chunk_id="c", template_id=1, cluster_id=1, cluster_similarity=1.0),
+        AnomalyResultV2(log_entry="ERROR login failed for system", score=-0.3, is_anomaly=True, explanation="",
+                        chunk_id="c", template_id=2, cluster_id=1, cluster_similarity=0.86),
+        AnomalyResultV2(log_entry="CRITICAL memory usage", score=-0.2, is_anomaly=True, explanation="",
+                        chunk_id="c", template_id=3, cluster_id=3, cluster_similarity=1.0),
+    ]
+    submitted, stored = [], []
+
+    async def submit(job_id, requests):
+        submitted.extend(requests)
+        return {}
+
+    async def get_batch_explanations(batch, on_partial=None, with_fallback=True):
+        return [f"Explicación de {line}" for line, _ in batch]
+
+    async def store(job_id, explanations, remember=True):
+        stored.append(explanations)
+
+    async def publish(*args, **kwargs):
+        pass
+
+    monkeypatch.setattr(worker_module.explanation_scheduler, "start", lambda handler: None)
+    monkeypatch.setattr(worker_module.explanation_scheduler, "submit", submit)
+    monkeypatch.setattr(worker_module.reexplain_queue, "start", lambda handler: None)
+    monkeypatch.setattr(worker_module.explanation_service, "get_batch_explanations", get_batch_explanations)
+    monkeypatch.setattr(worker, "_store_template_explanations", store)
+    monkeypatch.setattr(worker, "_publish_explanation_completed", publish)
+
+    async def run():
+        await worker._schedule_explanations("job", anomalies)
+        return await worker._explain_scheduled("job", submitted)
+
+    explanations = asyncio.run(run())
+    assert [(r.template_id, r.members, len(r.anomaly_ids)) for r in submitted] == [(1, [2], 2), (3, [], 1)]
+    assert explanations == {1: "Explicación de ERROR login failed for admin",
+                            2: "Explicación de ERROR login failed for admin",
+                            3: "Explicación de CRITICAL memory usage"}
+    assert stored == [explanations]
+
+def test_ollama_embedder_failure_leaves_chunk_unclustered(monkeypatch):
+    clusterer = AnomalyClusterer()
+    clusterer.embedder = "ollama"
+
+    async def failing_embed(texts):
+        return None
+
+    monkeypatch.setattr(clusterer, "embed", failing_embed)
+    index = clusterer.new_index()
+    assert asyncio.run(clusterer.assign(index, {5: "a", 6: "b"})) == {5: (5, 1.0), 6: (6, 1.0)}
+    assert len(index) == 0
@@ -0,0 +1,68 @@
+import asyncio
+import json
+
+import httpx
+from services import explanation_service as explanation_module
+from services.model_router import ModelRouter
+from services.ollama_client import OllamaClient
+
+def make_service(monkeypatch, responses, seen):
+    """Servicio con un Ollama falso que devuelve responses en orden"""
+    def handler(request):
+        payload = json.loads(request.content)
+        seen.append(payload)
+        return httpx.Response(200, json={"response": responses[len(seen) - 1], "done": True})
+
+    client = OllamaClient(base_url="http://ollama.test", transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(explanation_module, "ollama_client", client)
+    service = explanation_module.ExplanationService()
+    # Todas las anomalías al mismo modelo (el ruteo por severidad se prueba en test_model_router.py)
+    service.model_router = ModelRouter(service.model_name, enabled=False)
+    return service, client
+
+def run_batch(service, client, batch):
+    async def run():
+        explanations = await service.get_batch_explanations(batch)
+        await client.close()
+        return explanations
+
+    return asyncio.run(run())
+
+def test_parse_matches_by_id_and_validates():
+    service = explanation_module.ExplanationService()
+    response = json.dumps({"explanations": [
+        {"id": "A2", "explanation": "Segunda"},
+        {"id": "A1", "explanation": "  "},          # vacía: no cuenta
+        {"id": "A9", "explanation": "Desconocida"},
+        {"id": "A2", "explanation": "Repetida"},
+        "texto suelto",
+    ]})
+
+    assert service._parse_batch_response(response, ["A1", "A2"]) == {"A2": "Segunda"}
+    assert service._parse_batch_response('{"A1": "Primera"}', ["A1"]) == {"A1": "Primera"}
+    assert service._parse_batch_response("ANOMALÍA 1: texto", ["A1"]) == {}
+
+def test_only_missing_items_are_retried(monkeypatch):
+    seen = []
+    responses = [
+        json.dumps({"explanations": [{"id": "A1", "explanation": "Uno"}, {"id": "A3", "explanation": "Tres"}]}),
+        json.dumps({"explanations": [{"id": "A2", "explanation": "Dos"}]}),
+    ]
+    service, client = make_service(monkeypatch, responses, seen)
+    batch = [("ERROR json batch alpha", -0.3), ("ERROR json batch beta", -0.2), ("ERROR json batch gamma", -0.1)]
+
+    assert run_batch(service, client, batch) == ["Uno", "Dos", "Tres"]
+    assert all(payload["format"] == "json" for payload in seen)
+    # El seguimiento solo lleva la anomalía que faltó, con su mismo ID
+    assert "[A2]" in seen[1]["prompt"] and "[A1]" not in seen[1]["prompt"]
+    stats = service.batch_stats()
+    assert (stats["calls"], stats["requested"], stats["parsed"], stats["retries"]) == (2, 4, 3, 1)
+
+def test_unexplained_items_use_fallback_after_retries(monkeypatch):
+    seen = []
+    service, client = make_service(monkeypatch, ["no es json", "{}"], seen)
+    batch = [("ERROR json batch connection timeout delta", -0.3)]
+
+    explanations = run_batch(service, client, batch)
+    assert len(seen) == service.batch_retries + 1
+    assert explanations == [service._generate_fallback_explanation(*batch[0])]
@@ -0,0 +1,116 @@
+import asyncio
+
+import httpx
+import pytest
+from services import worker_service as worker_module
+from services.circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+from services.explanation_scheduler import ExplanationRequest
+from services.ollama_client import CircuitOpenError, OllamaClient, OllamaError
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+def make_breaker(clock, **kwargs):
+    options = dict(window_seconds=60, min_calls=4, error_rate=0.5, latency_p95=10, open_seconds=30,
+                   half_open_probes=1, enabled=True, clock=clock)
+    options.update(kwargs)
+    return CircuitBreaker("test", **options)
+
+def test_opens_on_error_rate_and_recovers_through_probe():
+    clock = FakeClock()
+    breaker = make_breaker(clock)
+    transitions = []
+    breaker.add_listener(lambda previous, state, reason, window: transitions.append((previous, state)))
+
+    for ok in (True, False, True):
+        breaker.record(1.0, ok)
+    assert breaker.state == CLOSED  # menos de min_calls
+    breaker.record(1.0, False)
+    assert breaker.state == OPEN and not breaker.allow()
+
+    clock.now += 30
+    assert breaker.allow()          # la llamada de prueba
+    assert not breaker.allow()      # solo una a la vez
+    breaker.record(1.0, True)
+    assert breaker.state == CLOSED
+    assert transitions == [(CLOSED, OPEN), (OPEN, HALF_OPEN), (HALF_OPEN, CLOSED)]
+    assert breaker.stats()["totals"]["rejected"] == 2
+
+def test_opens_on_p95_latency_and_failed_probe_reopens():
+    clock = FakeClock()
+    breaker = make_breaker(clock)
+
+    for _ in range(4):
+        breaker.record(11.0, True)
+    assert breaker.state == OPEN
+    assert "latencia p95" in breaker.stats()["transitions"][-1]["reason"]
+
+    clock.now += 30
+    assert breaker.allow()
+    breaker.record(0.5, False)
+    assert breaker.state == OPEN
+    assert breaker.stats()["retry_in"] == 30
+
+def test_client_fails_fast_while_open():
+    clock = FakeClock()
+    breaker = make_breaker(clock, min_calls=2)
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(503, text="loading model")
+
+    client = OllamaClient(base_url="http://ollama.test", transport=httpx.MockTransport(handler), breaker=breaker)
+
+    async def run():
+        for _ in range(2):
+            with pytest.raises(OllamaError):
+                await client.request("/api/generate", {})
+        with pytest.raises(CircuitOpenError):
+            await client.request("/api/generate", {})
+        await client.close()
+
+    asyncio.run(run())
+    assert len(calls) == 2
+    assert client.in_flight == 0
+
+def test_unexplained_templates_are_deferred_then_reexplained(monkeypatch):
+    worker = worker_module.WorkerService()
+    request = ExplanationRequest("job", 7, "ERROR upstream timed out", -0.3, ["a1", "a2"])
+    responses = [[None], ["El upstream no respondió a tiempo"]]
+    queued, stored, published = [], [], []
+
+    async def get_batch_explanations(batch, on_partial=None, with_fallback=True):
+        assert not with_fallback
+        return responses.pop(0)
+
+    async def push(requests, attempts=0):
+        queued.extend((r.template_id, attempts) for r in requests)
+        return True
+
+    async def store(job_id, explanations, remember=True):
+        stored.append(explanations)
+
+    async def publish(job_id, template_id, anomaly_ids, explanation, fallback=False):
+        published.append((template_id, fallback))
+
+    monkeypatch.setattr(worker_module.explanation_service, "get_batch_explanations", get_batch_explanations)
+    monkeypatch.setattr(worker_module.reexplain_queue, "push", push)
+    monkeypatch.setattr(worker_module.reexplain_queue, "start", lambda handler: None)
+    monkeypatch.setattr(worker, "_store_template_explanations", store)
+    monkeypatch.setattr(worker, "_publish_explanation_completed", publish)
+
+    async def run():
+        first = await worker._explain_scheduled("job", [request])
+        await worker._reexplain([(request, 0)])
+        return first
+
+    assert asyncio.run(run()) == {}
+    # Primero el respaldo publicado (sin guardarlo) y la plantilla en cola; luego la del LLM
+    assert queued == [(7, 0)]
+    assert published == [(7, True), (7, False)]
+    assert stored == [{}, {7: "El upstream no respondió a tiempo"}]
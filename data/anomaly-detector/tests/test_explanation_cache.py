@@ -0,0 +1,74 @@
+import asyncio
+from services.explanation_cache import ExplanationCache, normalize_line
+
+class FakeRedis:
+    def __init__(self):
+        self.data = {}
+        self.ttls = {}
+
+    async def mget(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    def pipeline(self):
+        redis = self
+
+        class Pipeline:
+            def __init__(self):
+                self.ops = []
+
+            def set(self, key, value, ex=None):
+                self.ops.append((key, value, ex))
+
+            async def execute(self):
+                for key, value, ex in self.ops:
+                    redis.data[key] = value.encode("utf-8")
+                    redis.ttls[key] = ex
+
+        return Pipeline()
+
+def test_normalize_masks_variables():
+    a = normalize_line("ERROR 2023-10-10T13:55:36Z login failed for 10.0.0.1 id=42")
+    b = normalize_line("ERROR 2024-01-01T00:00:00Z  login failed for 192.168.1.7 id=7")
+    assert a == b
+    assert "10.0.0.1" not in a
+
+def test_key_depends_on_model_and_prompt_version():
+    line = "ERROR disk full on /dev/sda1"
+    assert ExplanationCache.key(line, "m1", "v1") != ExplanationCache.key(line, "m2", "v1")
+    assert ExplanationCache.key(line, "m1", "v1") != ExplanationCache.key(line, "m1", "v2")
+
+def test_memory_tier_lru_and_counters(monkeypatch):
+    monkeypatch.setattr(ExplanationCache, "_redis", staticmethod(lambda: None))
+    cache = ExplanationCache(max_entries=2, ttl=60)
+
+    async def run():
+        await cache.set("ERROR timeout after 3000ms", "m", "v", "Timeout")
+        assert await cache.get("ERROR timeout after 15ms", "m", "v") == "Timeout"
+        await cache.set("WARN disk almost full", "m", "v", "Disco")
+        await cache.set("INFO user logged in", "m", "v", "Login")
+        # La menos usada (Timeout) se descartó al superar max_entries
+        return await cache.get_many(["ERROR timeout after 1ms", "INFO user logged in"], "m", "v")
+
+    assert asyncio.run(run()) == [None, "Login"]
+    stats = cache.stats()
+    assert stats["memory_hits"] == 2 and stats["misses"] == 1
+    assert stats["memory_entries"] == 2
+    assert stats["hit_rate"] == round(2 / 3, 4)
+
+def test_redis_tier_shared_between_processes(monkeypatch):
+    redis = FakeRedis()
+    monkeypatch.setattr(ExplanationCache, "_redis", staticmethod(lambda: redis))
+    writer, reader = ExplanationCache(ttl=120), ExplanationCache(ttl=120)
+
+    async def run():
+        await writer.set_many(["GET /a 500", "GET /b 404"], "m", "v", ["Error", ""])
+        first = await reader.get_many(["GET /a 503", "GET /b 404"], "m", "v")
+        second = await reader.get("GET /a 500", "m", "v")
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first == ["Error", None]   # las explicaciones vacías no se guardan
+    assert second == "Error"
+    assert list(redis.ttls.values()) == [120]
+    stats = reader.stats()
+    assert (stats["redis_hits"], stats["memory_hits"], stats["misses"]) == (1, 1, 1)
@@ -0,0 +1,180 @@
+import asyncio
+
+from services import explanation_scheduler as scheduler_module
+from services.explanation_scheduler import ExplanationRequest, ExplanationScheduler
+from services.top_k import TopKStore
+
+class FakeRedis:
+    """Sorted sets en memoria con el pipeline que usa TopKStore"""
+    def __init__(self):
+        self.zsets = {}
+
+    def pipeline(self, transaction=True):
+        redis = self
+
+        class Pipeline:
+            def __init__(self):
+                self.ops = []
+
+            async def __aenter__(self):
+                return self
+
+            async def __aexit__(self, *exc):
+                return False
+
+            def __getattr__(self, name):
+                return lambda *args, **kwargs: self.ops.append((name, args, kwargs))
+
+            async def execute(self):
+                return [getattr(redis, name)(*args, **kwargs) for name, args, kwargs in self.ops]
+
+        return Pipeline()
+
+    def zadd(self, key, mapping, gt=False):
+        zset = self.zsets.setdefault(key, {})
+        for member, value in mapping.items():
+            if not gt or member not in zset or value > zset[member]:
+                zset[member] = value
+
+    def zremrangebyrank(self, key, start, end):
+        ranked = sorted(self.zsets.get(key, {}).items(), key=lambda item: item[1])
+        for member, _ in ranked[start:len(ranked) + end + 1]:
+            del self.zsets[key][member]
+
+    def expire(self, key, ttl):
+        pass
+
+    def sadd(self, key, *members):
+        self.zsets.setdefault(key, {}).update(dict.fromkeys(members, 0))
+
+    async def smembers(self, key):
+        return set(self.zsets.get(key, {}))
+
+    def zscore(self, key, member):
+        return self.zsets.get(key, {}).get(member)
+
+    async def delete(self, *keys):
+        for key in keys:
+            self.zsets.pop(key, None)
+
+def request(job_id, template_id, score):
+    return ExplanationRequest(job_id=job_id, template_id=template_id, log_entry=f"line {template_id}",
+                              score=score, anomaly_ids=[f"{job_id}-{template_id}"])
+
+class RecordingHandler:
+    """Explica cada lote tras abrir la compuerta, registrando el orden de llegada"""
+    def __init__(self):
+        self.batches = []
+        self.gate = asyncio.Event()
+
+    async def __call__(self, job_id, batch):
+        await self.gate.wait()
+        self.batches.append((job_id, [r.template_id for r in batch]))
+        return {r.template_id: f"explicación {r.template_id}" for r in batch}
+
+def run_scheduler(monkeypatch, body, top_k=10, batch_size=1, redis=None):
+    monkeypatch.setattr(scheduler_module.llm_controller, "batch_size", batch_size)
+    redis = redis if redis is not None else FakeRedis()
+    monkeypatch.setattr(TopKStore, "_redis", staticmethod(lambda: redis))
+    scheduler = ExplanationScheduler(consumers=1, top_k=top_k)
+
+    async def run():
+        handler = RecordingHandler()
+        scheduler.start(handler)
+        try:
+            return await body(scheduler, handler)
+        finally:
+            await scheduler.stop()
+
+    return asyncio.run(run())
+
+def test_worst_first_across_submits(monkeypatch):
+    async def body(scheduler, handler):
+        await scheduler.submit("job", [request("job", 1, -0.1)])
+        await asyncio.sleep(0)  # el consumidor toma la plantilla 1 y espera la compuerta
+        await scheduler.submit("job", [request("job", 2, -0.2), request("job", 3, -0.5)])
+        await scheduler.submit("job", [request("job", 4, -0.3)])
+        handler.gate.set()
+        return handler, await scheduler.join("job")
+
+    handler, explained = run_scheduler(monkeypatch, body)
+    assert [templates for _, templates in handler.batches] == [[1], [3], [4], [2]]
+    assert explained == {t: f"explicación {t}" for t in (1, 2, 3, 4)}
+
+def test_jobs_take_turns(monkeypatch):
+    async def body(scheduler, handler):
+        await scheduler.submit("big", [request("big", t, -0.9 + t / 10) for t in range(4)])
+        await scheduler.submit("small", [request("small", 10, -0.1)])
+        handler.gate.set()
+        await asyncio.gather(scheduler.join("big"), scheduler.join("small"))
+        return handler
+
+    handler = run_scheduler(monkeypatch, body)
+    # Un job grande no deja esperando al pequeño hasta el final
+    assert [job for job, _ in handler.batches][:3] == ["big", "small", "big"]
+
+def test_templates_outside_top_k_are_dropped(monkeypatch):
+    async def body(scheduler, handler):
+        await scheduler.submit("job", [request("job", 1, -0.1), request("job", 2, -0.2)])
+        await scheduler.submit("job", [request("job", 3, -0.9), request("job", 4, -0.05)])
+        handler.gate.set()
+        return handler, scheduler.stats(), await scheduler.join("job")
+
+    handler, stats, explained = run_scheduler(monkeypatch, body, top_k=2, batch_size=5)
+    assert sorted(explained) == [2, 3]
+    assert stats["totals"]["dropped"] >= 1
+
+def test_explained_template_is_not_requeued(monkeypatch):
+    async def body(scheduler, handler):
+        handler.gate.set()
+        await scheduler.submit("job", [request("job", 1, -0.2)])
+        while not scheduler.explained("job"):
+            await asyncio.sleep(0)
+        already = await scheduler.submit("job", [request("job", 1, -0.4)])
+        await scheduler.join("job")
+        return handler, already
+
+    handler, already = run_scheduler(monkeypatch, body)
+    assert already == {1: "explicación 1"}
+    assert len(handler.batches) == 1
+
+def test_cancel_discards_pending(monkeypatch):
+    async def body(scheduler, handler):
+        await scheduler.submit("job", [request("job", t, -t / 10) for t in range(1, 4)])
+        await asyncio.sleep(0)
+        dropped = scheduler.cancel("job")
+        handler.gate.set()
+        return dropped, await scheduler.join("job")
+
+    dropped, explained = run_scheduler(monkeypatch, body)
+    assert dropped == 2
+    assert list(explained) == [3]  # solo termina el lote que ya estaba en curso
+
+def test_budget_caps_total_explanations(monkeypatch):
+    async def body(scheduler, handler):
+        handler.gate.set()
+        # Cada plantilla nueva es más anómala que las anteriores y desplaza a una ya explicada del top
+        for t in range(50):
+            await scheduler.submit("job", [request("job", t, -t / 100)])
+            await asyncio.sleep(0)
+        stats = scheduler.stats()
+        return handler, stats, await scheduler.join("job")
+
+    handler, stats, explained = run_scheduler(monkeypatch, body, top_k=5, batch_size=2)
+    assert len(explained) == 5
+    assert sum(len(templates) for _, templates in handler.batches) == 5
+    assert stats["jobs"]["job"]["budget_used"] == 5
+
+def test_admission_is_shared_through_redis(monkeypatch):
+    redis = FakeRedis()
+    # Otro worker ya admitió dos plantillas más anómalas en el top-K del job
+    redis.zadd("anomalies:top:job:job", {"8": 0.8, "9": 0.9})
+
+    async def body(scheduler, handler):
+        await scheduler.submit("job", [request("job", 1, -0.1), request("job", 2, -0.95)])
+        handler.gate.set()
+        return await scheduler.join("job"), dict(redis.zsets)
+
+    explained, zsets = run_scheduler(monkeypatch, body, top_k=2, redis=redis)
+    assert list(explained) == [2]
+    assert zsets == {}  # join libera el top-K del job
@@ -0,0 +1,67 @@
+import asyncio
+import json
+import time
+
+import httpx
+from services import explanation_service as explanation_module
+from services.ollama_client import OllamaClient
+
+def streaming_handler(fragments, delay=0.0, seen=None):
+    async def body():
+        for fragment in fragments:
+            await asyncio.sleep(delay)
+            yield (json.dumps({"response": fragment, "done": False}) + "\n").encode("utf-8")
+        yield (json.dumps({"response": "", "done": True}) + "\n").encode("utf-8")
+
+    def handler(request):
+        if seen is not None:
+            seen["payload"] = json.loads(request.content)
+        return httpx.Response(200, content=body())
+
+    return handler
+
+def test_stream_generate_yields_fragments_as_they_arrive():
+    seen = {}
+    client = OllamaClient(base_url="http://ollama.test",
+                          transport=httpx.MockTransport(streaming_handler(["Hola", " mundo", "!"], 0.05, seen)))
+
+    async def run():
+        start = time.perf_counter()
+        arrivals = []
+        async for fragment in client.stream_generate("explica", "m"):
+            arrivals.append((fragment, time.perf_counter() - start))
+        await client.close()
+        return arrivals
+
+    arrivals = asyncio.run(run())
+    assert [fragment for fragment, _ in arrivals] == ["Hola", " mundo", "!"]
+    # El primer fragmento llega antes de que termine la generación
+    assert arrivals[0][1] < arrivals[-1][1] - 0.05
+    assert seen["payload"]["stream"] is True
+
+def test_batch_explanations_stream_partials_per_anomaly(monkeypatch):
+    fragments = ['{"explanations": [{"id": "A1", "explanation": "El disco', ' está lleno"}, {"id": "A', '2", "expl',
+                 'anation": "Hay', ' un timeout \\u00', 'e9xito"}]}']
+    client = OllamaClient(base_url="http://ollama.test", transport=httpx.MockTransport(streaming_handler(fragments)))
+    monkeypatch.setattr(explanation_module, "ollama_client", client)
+    service = explanation_module.ExplanationService()
+    batch = [("ERROR streaming test disk full on /dev/sdz", -0.3), ("ERROR streaming test upstream timed out", -0.2)]
+    partials = []
+
+    async def on_partial(index, delta, text):
+        partials.append((index, delta, text))
+
+    async def run():
+        explanations = await service.get_batch_explanations(batch, on_partial=on_partial)
+        await client.close()
+        return explanations
+
+    explanations = asyncio.run(run())
+    assert explanations == ["El disco está lleno", "Hay un timeout éxito"]
+    assert partials == [
+        (0, "El disco", "El disco"),
+        (0, " está lleno", "El disco está lleno"),
+        (1, "Hay", "Hay"),
+        (1, " un timeout", "Hay un timeout"),   # el escape \u00 incompleto espera al siguiente token
+        (1, " éxito", "Hay un timeout éxito"),
+    ]
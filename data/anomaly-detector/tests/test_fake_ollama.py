@@ -0,0 +1,67 @@
+import asyncio
+import os
+import sys
+
+import httpx
+import pytest
+from services import explanation_service as explanation_module
+from services.ollama_client import OllamaClient, OllamaError
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts"))
+from fake_ollama import FakeOllama, FakeOllamaSettings, parse_latency  # noqa: E402
+
+def make_client(fake):
+    return OllamaClient(base_url="http://ollama.test", transport=httpx.ASGITransport(app=fake.app()))
+
+def test_json_batches_parse_with_explanation_service(monkeypatch):
+    fake = FakeOllama(FakeOllamaSettings(seed=1))
+    client = make_client(fake)
+    monkeypatch.setattr(explanation_module, "ollama_client", client)
+    service = explanation_module.ExplanationService()
+    batch = [("ERROR fake ollama disk full", -0.3), ("ERROR fake ollama upstream timed out", -0.2)]
+    partials = []
+
+    async def on_partial(index, delta, text):
+        partials.append(index)
+
+    async def run():
+        explanations = await service.get_batch_explanations(batch, on_partial=on_partial)
+        await client.close()
+        return explanations
+
+    explanations = asyncio.run(run())
+    assert all("comportamiento fuera de lo normal" in explanation for explanation in explanations)
+    assert set(partials) == {0, 1}
+    assert fake.stats["stream"] == 1 and fake.stats["items"] == 2
+
+def test_errors_and_text_responses():
+    fake = FakeOllama(FakeOllamaSettings(error_rate=1.0, error_status=503))
+    client = make_client(fake)
+
+    async def run():
+        with pytest.raises(OllamaError) as error:
+            await client.generate("explica", "m")
+        fake.settings.error_rate = 0.0
+        text = await client.generate("Analiza estas anomalías:\n\nANOMALÍA 1: a\n\nANOMALÍA 2: b", "m")
+        await client.close()
+        return error.value.status_code, text
+
+    status, text = asyncio.run(run())
+    assert status == 503
+    assert text.startswith("ANOMALÍA 1:") and "ANOMALÍA 2:" in text
+
+def test_embeddings_are_deterministic_and_similar():
+    fake = FakeOllama(FakeOllamaSettings(embedding_dim=32))
+
+    a = fake.embed("ERROR database connection refused")
+    b = fake.embed("ERROR database connection refused again")
+    c = fake.embed("INFO user logged in")
+    assert a == fake.embed("ERROR database connection refused")
+    assert len(a) == 32
+    similarity = lambda x, y: sum(p * q for p, q in zip(x, y))
+    assert similarity(a, b) > similarity(a, c)
+
+def test_latency_specs():
+    assert parse_latency("fixed:0.25")(None) == 0.25
+    with pytest.raises(ValueError):
+        parse_latency("pareto:1")
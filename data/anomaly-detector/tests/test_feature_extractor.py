@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+from main import extract_features
+from services.feature_extractor import extract_features_batch
+
+SAMPLE_LOGS = [
+    "2024-01-01 10:00:00 INFO User login successful",
+    "2024-01-01 10:02:00 ERROR Failed to connect to external API",
+    "2024-01-01 10:04:00 CRITICAL System memory usage exceeded 95%",
+    "192.168.1.10 - - [01/Jan/2024:10:00:00] \"GET /admin HTTP/1.1\" 401 512",
+    "ERROR error Timeout\ttimeouT denied {a:1}, (b|c) <d>?",
+    "x",
+]
+
+def test_batch_matches_per_line_features():
+    """La versión por lotes debe producir las mismas 7 características"""
+    expected = np.array([extract_features(line) for line in SAMPLE_LOGS], dtype=np.float32)
+    features = extract_features_batch(SAMPLE_LOGS)
+
+    assert features.dtype == np.float32
+    assert features.shape == (len(SAMPLE_LOGS), 7)
+    np.testing.assert_allclose(features, expected, rtol=1e-5, atol=1e-5)
+
+def test_batch_accepts_bytes_buffer():
+    """Un buffer de bytes produce el mismo resultado que la lista de líneas"""
+    buffer = ("\n".join(SAMPLE_LOGS) + "\n\n").encode("utf-8")
+    np.testing.assert_allclose(
+        extract_features_batch(buffer),
+        extract_features_batch(SAMPLE_LOGS),
+        rtol=1e-6
+    )
+
+def test_batch_handles_small_blocks_and_empty_input():
+    """El resultado no depende del tamaño de bloque"""
+    np.testing.assert_allclose(
+        extract_features_batch(SAMPLE_LOGS, block_lines=2),
+        extract_features_batch(SAMPLE_LOGS),
+        rtol=1e-6
+    )
+    assert extract_features_batch([]).shape == (0, 7)
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,56 @@
+from services.line_dedup import collapse_lines
+from services.template_miner import TemplateMiner
+
+LINES = [
+    "ERROR [2023-10-10T13:55:36Z] Database timeout after 3000ms",
+    "INFO [2023-10-10T13:55:37Z] Request from 10.0.0.1 served",
+    "ERROR [2023-10-10T13:55:38Z] Database timeout after 5000ms",
+    "INFO [2023-10-10T13:55:39Z] Request from 10.0.0.2 served",
+    "WARN disk almost full",
+    "ERROR [2023-10-10T13:55:40Z] Database timeout after 1ms",
+]
+
+def test_collapse_groups_lines_differing_only_by_variables():
+    groups = collapse_lines(LINES)
+
+    assert len(groups) == 3
+    assert groups.total == len(LINES)
+    # Grupos en orden de primera aparición
+    assert groups.representatives.tolist() == [0, 1, 4]
+    assert groups.counts.tolist() == [3, 2, 1]
+    assert groups.inverse.tolist() == [0, 1, 0, 1, 2, 0]
+    assert groups.select(LINES)[2] == "WARN disk almost full"
+
+def test_positions_per_group():
+    groups = collapse_lines(LINES)
+
+    assert groups.positions(0) == [0, 2, 5]
+    assert groups.positions(1) == [1, 3]
+    assert groups.positions(0, limit=2) == [0, 2]
+
+def test_empty_input():
+    groups = collapse_lines([])
+
+    assert len(groups) == 0
+    assert groups.total == 0
+
+def test_miner_counts_collapsed_lines():
+    groups = collapse_lines(LINES)
+    collapsed, full = TemplateMiner(), TemplateMiner()
+    collapsed.add_lines(groups.select(LINES), counts=groups.counts)
+    full.add_lines(LINES)
+
+    assert collapsed.total_lines == full.total_lines == len(LINES)
+    assert sorted(c.size for c in collapsed.clusters.values()) == sorted(c.size for c in full.clusters.values())
+
+def test_analyze_logs_reports_counts():
+    from main import analyze_logs
+
+    lines = [f"INFO user {i % 7} logged in from 10.0.0.{i % 50}" for i in range(300)]
+    lines += ["CRITICAL kernel panic on node 3"] * 4
+    miner, groups, unique_entries, template_ids, labels, scores = analyze_logs(lines)
+
+    # Se detecta sobre las 2 líneas únicas, no sobre los 304 logs
+    assert len(unique_entries) == len(labels) == len(scores) == len(template_ids) == 2
+    assert groups.counts.tolist() == [300, 4]
+    assert miner.total_lines == len(lines)
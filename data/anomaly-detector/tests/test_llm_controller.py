@@ -0,0 +1,98 @@
+import asyncio
+
+import httpx
+from services.llm_controller import AdaptiveLLMController
+from services.ollama_client import OllamaClient
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+def make_controller(clock, **kwargs):
+    options = dict(latency_slo=10, min_concurrency=1, max_concurrency=8, initial_concurrency=2,
+                   min_batch_size=1, max_batch_size=10, initial_batch_size=4, window_seconds=60,
+                   enabled=True, clock=clock)
+    options.update(kwargs)
+    return AdaptiveLLMController(**options)
+
+def run_round(controller, clock, latency, items_per_call=None):
+    """Una ronda: tantas llamadas como la concurrencia, terminando a la vez"""
+    clock.now += latency
+    for _ in range(controller.concurrency):
+        controller.record(latency, items_per_call or controller.batch_size)
+
+def test_additive_increase_alternates_dimensions():
+    clock = FakeClock()
+    controller = make_controller(clock)
+
+    run_round(controller, clock, 2.0)
+    assert (controller.concurrency, controller.batch_size) == (3, 4)
+    run_round(controller, clock, 2.0)
+    assert (controller.concurrency, controller.batch_size) == (3, 5)
+    assert controller.stats()["totals"]["increases"] == 2
+
+def test_batch_grows_only_within_slo():
+    clock = FakeClock()
+    controller = make_controller(clock, max_concurrency=2)
+
+    # 9 s por llamada con lote 4: un lote de 5 tardaría ~11 s, fuera del SLO de 10 s
+    run_round(controller, clock, 9.0)
+    assert (controller.concurrency, controller.batch_size) == (2, 4)
+
+def test_multiplicative_decrease_on_timeout_once_per_slo():
+    clock = FakeClock()
+    controller = make_controller(clock, initial_concurrency=8, initial_batch_size=8)
+
+    controller.record(15.0, 8, ok=False, timeout=True)
+    controller.record(15.0, 8, ok=False, timeout=True)  # misma ronda: no se vuelve a reducir
+    assert (controller.concurrency, controller.batch_size) == (4, 4)
+
+    clock.now += 11
+    controller.record(2.0, 4, ok=False)  # error de Ollama: solo baja la concurrencia
+    assert (controller.concurrency, controller.batch_size) == (2, 4)
+    stats = controller.stats()
+    assert stats["totals"]["timeouts"] == 2 and stats["totals"]["errors"] == 1
+    assert stats["window"]["error_rate"] == 1.0
+
+def test_increase_undone_when_throughput_drops():
+    clock = FakeClock()
+    controller = make_controller(clock)
+
+    run_round(controller, clock, 2.0)          # 2 x 4 anomalías en 2 s -> concurrencia 3
+    assert controller.concurrency == 3
+    run_round(controller, clock, 8.0, 1)       # 3 anomalías en 8 s: el aumento empeoró
+    assert controller.concurrency == 2
+    assert "deshace" in controller.last_adjustment
+
+def test_disabled_controller_only_measures():
+    clock = FakeClock()
+    controller = make_controller(clock, enabled=False)
+
+    run_round(controller, clock, 2.0)
+    controller.record(30.0, 4, ok=False, timeout=True)
+    assert (controller.concurrency, controller.batch_size) == (2, 4)
+    assert controller.stats()["window"]["calls"] == 3
+
+def test_client_follows_controller_limit():
+    controller = make_controller(FakeClock(), initial_concurrency=2, latency_slo=1000)
+    client = OllamaClient(base_url="http://ollama.test", controller=controller)
+    peak = {"value": 0}
+
+    async def slow_handler(request):
+        peak["value"] = max(peak["value"], client.in_flight)
+        await asyncio.sleep(0.01)
+        return httpx.Response(200, json={"response": "ok"})
+
+    client.transport = httpx.MockTransport(slow_handler)
+
+    async def run():
+        await asyncio.gather(*(client.request("/api/generate", {}, items=3) for _ in range(6)))
+        await client.close()
+
+    asyncio.run(run())
+    assert peak["value"] <= 4  # empieza en 2 y crece de a 1 por ronda
+    assert controller.stats()["totals"]["calls"] == 6
+    assert controller.stats()["totals"]["items"] == 18
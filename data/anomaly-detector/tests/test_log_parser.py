@@ -0,0 +1,83 @@
+import pytest
+from services.log_parser import FIELDS, LogFormat, LogParser
+
+ACCESS = [
+    '192.168.1.10 - - [10/Oct/2023:13:55:36 +0000] "GET /index.html HTTP/1.1" 200 2326 "-" "curl/8.0"',
+    '10.0.0.5 - admin [10/Oct/2023:13:55:37 +0000] "POST /wp-admin/login.php HTTP/1.1" 403 512',
+    '10.0.0.6 - - [10/Oct/2023:13:55:38 +0000] "GET /api/users HTTP/1.1" 503 -',
+]
+SYSLOG = [
+    "Oct 10 13:55:36 web01 sshd[1234]: Failed password for root from 203.0.113.7 port 22",
+    "Oct 10 13:55:37 web01 CRON[99]: (root) CMD (run-parts /etc/cron.hourly)",
+]
+APP = [
+    "ERROR [2023-10-10T13:55:36Z] Database connection failed",
+    "2023-10-10 13:55:37,123 WARNING disk almost full on 10.1.1.1",
+]
+JSON = [
+    '{"@timestamp": "2023-10-10T13:55:36Z", "severity": "error", "remote_addr": "1.2.3.4", "status": "500"}',
+    '{"time": "2023-10-10T13:55:37Z", "level": "info", "method": "GET", "url": "/health", "bytes": 12}',
+]
+
+@pytest.mark.parametrize("lines, expected", [
+    (ACCESS, "access_combined"),
+    (SYSLOG, "syslog"),
+    (APP, "app_iso"),
+    (JSON, "json_lines"),
+    (["something odd happened", "another odd thing"], "generic"),
+])
+def test_detect_format(lines, expected):
+    assert LogParser().detect_format(lines).name == expected
+
+def test_access_fields():
+    parsed = LogParser().parse(ACCESS)
+
+    assert parsed.format == "access_combined"
+    assert len(parsed) == 3
+    assert parsed["ip"] == ["192.168.1.10", "10.0.0.5", "10.0.0.6"]
+    assert parsed["method"] == ["GET", "POST", "GET"]
+    assert parsed["level"] == ["INFO", "WARN", "ERROR"]
+    assert parsed.numeric("bytes").tolist() == [2326, 512, -1]
+    assert set(parsed.row(1)) == set(FIELDS)
+
+def test_json_aliases():
+    parsed = LogParser().parse(JSON)
+
+    assert parsed.row(0)["level"] == "ERROR"
+    assert parsed.row(0)["status"] == 500
+    assert parsed.row(1)["path"] == "/health"
+    assert parsed.row(1)["timestamp"] == "2023-10-10T13:55:37Z"
+
+def test_unmatched_lines_use_fallback():
+    parsed = LogParser().parse(ACCESS + ["ERROR at 2023-10-10 13:55:36 from 8.8.8.8"])
+
+    assert parsed.format == "access_combined"
+    assert parsed.row(3)["ip"] == "8.8.8.8"
+    assert parsed.row(3)["level"] == "ERROR"
+    assert parsed.row(3)["timestamp"] == "2023-10-10 13:55:36"
+
+def test_format_cached_per_source():
+    parser = LogParser(max_sources=1)
+
+    assert parser.format_for(SYSLOG, source="a.log").name == "syslog"
+    # La fuente ya conocida no vuelve a detectar aunque cambie el lote
+    assert parser.parse(ACCESS, source="a.log").format == "syslog"
+    parser.format_for(ACCESS, source="b.log")
+    assert parser.parse(ACCESS, source="a.log").format == "access_combined"
+
+def test_register_custom_format():
+    class PipeFormat(LogFormat):
+        name = "pipe"
+
+        def parse(self, line):
+            parts = line.split("|")
+            if len(parts) != 3:
+                return None
+            return dict.fromkeys(FIELDS) | {"timestamp": parts[0], "level": parts[1]}
+
+    parser = LogParser()
+    parser.register_format(PipeFormat())
+    parsed = parser.parse(["t1|warn|x", "t2|info|y"])
+
+    assert parsed.format == "pipe"
+    assert parsed["level"] == ["warn", "info"]
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+from services.feature_extractor import extract_features_batch
+from services.model_registry import ModelRegistry
+
+TRAINING_LOGS = [f"2024-01-01 10:{i:02d}:00 INFO User {i} login successful" for i in range(40)] + [
+    "2024-01-01 11:00:00 CRITICAL System memory usage exceeded 95%",
+    "2024-01-01 11:01:00 FATAL Database corruption detected",
+]
+
+def test_key_for_filename_groups_chunks_and_rotations():
+    """Chunks y rotaciones del mismo archivo comparten clave"""
+    assert ModelRegistry.key_for_filename("access_2024-01-01.log_chunk_3") == \
+        ModelRegistry.key_for_filename("access_2024-02-15.log")
+
+@pytest.mark.parametrize("key", [".", "..", "..."])
+def test_keys_outside_registry_are_rejected(tmp_path, key):
+    """Claves que resuelven al registro o a su padre no llegan al disco"""
+    registry = ModelRegistry(base_dir=str(tmp_path / "registry"))
+
+    with pytest.raises(ValueError):
+        registry.fit(key, extract_features_batch(TRAINING_LOGS))
+    with pytest.raises(ValueError):
+        registry.versions(key)
+    assert not list(tmp_path.glob("**/metadata.json"))
+    # Las barras se reemplazan: "../x" queda como una clave normal dentro del registro
+    assert registry._model_dir("../x") == str((tmp_path / "registry" / ".._x").resolve())
+
+def test_fit_persists_versions_and_scores_without_refit(tmp_path):
+    """El modelo se guarda en disco y se puede puntuar tras recargarlo"""
+    features = extract_features_batch(TRAINING_LOGS)
+    registry = ModelRegistry(base_dir=str(tmp_path))
+
+    assert not registry.has_model("app")
+    version = registry.fit("app", features)
+    labels, scores, used_version = registry.score("app", features)
+
+    assert version == used_version == 1
+    assert -1 in labels
+    assert registry.has_model("app", n_features=7)
+
+    # Un registro nuevo (otro proceso) carga el mismo modelo desde disco
+    reloaded = ModelRegistry(base_dir=str(tmp_path))
+    _, reloaded_scores, _ = reloaded.score("app", features)
+    np.testing.assert_allclose(reloaded_scores, scores)
+
+    registry.fit("app", features)
+    assert [v["version"] for v in registry.versions("app")["versions"]] == [1, 2]
+
+def test_lru_evicts_least_recently_used(tmp_path):
+    """Solo se mantienen max_loaded modelos en memoria"""
+    features = extract_features_batch(TRAINING_LOGS)
+    registry = ModelRegistry(base_dir=str(tmp_path), max_loaded=1)
+    registry.fit("a", features)
+    registry.fit("b", features)
+
+    assert registry.versions("a")["loaded_versions"] == []
+    assert registry.versions("b")["loaded_versions"] == [1]
+
+    with pytest.raises(KeyError):
+        registry.load("missing")
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,67 @@
+import asyncio
+import json
+import re
+
+import httpx
+from services import explanation_service as explanation_module
+from services.model_router import ModelRouter
+from services.ollama_client import OllamaClient
+
+TIERS = [
+    {"name": "high", "severities": ["crítico", "alto"], "model": "big", "batch_size": 2},
+    {"name": "medium", "severities": ["medio"], "model": "small", "batch_size": 10},
+    {"name": "low", "severities": ["bajo"], "model": None},
+]
+
+def make_router(**kwargs):
+    options = dict(enabled=True, tiers=TIERS, escalation={"severity.CRÍTICO": "high"})
+    options.update(kwargs)
+    return ModelRouter("big", **options)
+
+def test_routes_by_severity_and_escalates_on_keywords():
+    router = make_router()
+    lines = ["GET /missing 404", "ERROR slow query", "ERROR db down", "GET /search?q=1 union select injection"]
+
+    tiers = router.route(lines, ["bajo", "medio", "crítico", "bajo"])
+    assert [tier.name for tier in tiers] == ["low", "medium", "high", "high"]
+    stats = {tier["name"]: tier for tier in router.stats()["tiers"]}
+    assert (stats["high"]["routed"], stats["high"]["escalated"]) == (2, 1)
+    assert stats["low"]["model"] == "reglas"
+
+def test_disabled_router_sends_everything_to_default_model():
+    router = make_router(enabled=False)
+
+    tiers = router.route(["a", "b"], ["bajo", "crítico"])
+    assert [(tier.model, tier.batch_size) for tier in tiers] == [("big", None), ("big", None)]
+    assert not router.stats()["enabled"]
+
+def test_batch_explanations_use_tier_models_and_batch_sizes(monkeypatch, caplog):
+    seen = []
+
+    def handler(request):
+        payload = json.loads(request.content)
+        seen.append(payload)
+        ids = sorted(set(re.findall(r'\[(A\d+)\]', payload["prompt"])))
+        return httpx.Response(200, json={"response": json.dumps({"explanations": [
+            {"id": item_id, "explanation": f"{payload['model']} {item_id}"} for item_id in ids
+        ]}), "done": True})
+
+    client = OllamaClient(base_url="http://ollama.test", transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(explanation_module, "ollama_client", client)
+    service = explanation_module.ExplanationService()
+    service.model_router = make_router()
+    batch = [("ERROR disk alpha failed", -0.3), ("ERROR disk beta failed", -0.25), ("ERROR disk gamma failed", -0.4),
+             ("WARN slow request", -0.07), ("INFO page not found", -0.01)]
+
+    async def run():
+        explanations = await service.get_batch_explanations(batch, with_fallback=False)
+        await client.close()
+        return explanations
+
+    with caplog.at_level("INFO", logger=explanation_module.__name__):
+        explanations = asyncio.run(run())
+    assert [explanation.split()[0] for explanation in explanations[:4]] == ["big", "big", "big", "small"]
+    assert explanations[4] == service._generate_fallback_explanation(*batch[4])
+    # Tres anomalías altas con lotes de 2: dos prompts al modelo grande; la baja no llama al LLM
+    assert sorted(payload["model"] for payload in seen) == ["big", "big", "small"]
+    assert "1 anomalías de baja severidad explicadas por reglas" in caplog.text
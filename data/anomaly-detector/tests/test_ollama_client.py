@@ -0,0 +1,128 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+from services.ollama_client import OllamaClient, OllamaError
+
+def make_client(handler, **kwargs):
+    return OllamaClient(base_url="http://ollama.test", transport=httpx.MockTransport(handler), **kwargs)
+
+def test_generate_posts_to_api_generate():
+    seen = {}
+
+    def handler(request):
+        seen["path"] = request.url.path
+        seen["payload"] = json.loads(request.content)
+        return httpx.Response(200, json={"response": "[RUTA_SOSPECHOSA] - acceso a /admin"})
+
+    async def run():
+        client = make_client(handler)
+        text = await client.generate("explica", "qwen2.5:3b", options={"temperature": 0.3})
+        await client.close()
+        return text
+
+    assert asyncio.run(run()) == "[RUTA_SOSPECHOSA] - acceso a /admin"
+    assert seen["path"] == "/api/generate"
+    assert seen["payload"] == {"model": "qwen2.5:3b", "prompt": "explica", "stream": False,
+                               "options": {"temperature": 0.3}, "keep_alive": "30m"}
+
+def test_error_status_raises():
+    async def run():
+        client = make_client(lambda request: httpx.Response(503, text="model loading"))
+        try:
+            await client.generate("x", "m")
+        finally:
+            await client.close()
+
+    with pytest.raises(OllamaError) as error:
+        asyncio.run(run())
+    assert error.value.status_code == 503
+
+def test_concurrency_is_bounded():
+    client = OllamaClient(base_url="http://ollama.test", max_concurrency=3)
+    peak = {"value": 0}
+
+    async def slow_handler(request):
+        peak["value"] = max(peak["value"], client.in_flight)
+        await asyncio.sleep(0.01)
+        return httpx.Response(200, json={"response": "ok"})
+
+    client.transport = httpx.MockTransport(slow_handler)
+
+    async def run():
+        results = await asyncio.gather(*(client.generate(str(i), "m") for i in range(12)))
+        await client.close()
+        return results
+
+    assert asyncio.run(run()) == ["ok"] * 12
+    assert peak["value"] == 3
+
+def test_routes_to_least_outstanding_endpoint():
+    seen = []
+
+    async def handler(request):
+        seen.append(request.url.host)
+        await asyncio.sleep(0.05 if request.url.host == "slow.test" else 0.01)
+        return httpx.Response(200, json={"response": "ok"})
+
+    client = OllamaClient(endpoints=["http://slow.test", "http://fast.test"], max_concurrency=2,
+                          transport=httpx.MockTransport(handler))
+
+    async def run():
+        await asyncio.gather(*(client.generate(str(i), "m") for i in range(8)))
+        stats = client.endpoint_stats()
+        await client.close()
+        return stats
+
+    stats = asyncio.run(run())
+    # La réplica lenta queda ocupada más tiempo: la rápida atiende el resto
+    assert seen.count("fast.test") > seen.count("slow.test") >= 1
+    assert [endpoint["requests"] for endpoint in stats["endpoints"]] == [seen.count("slow.test"), seen.count("fast.test")]
+    assert all(endpoint["in_flight"] == 0 for endpoint in stats["endpoints"])
+
+def test_connection_error_fails_over_and_marks_endpoint_down():
+    def handler(request):
+        if request.url.host == "down.test":
+            raise httpx.ConnectError("connection refused", request=request)
+        return httpx.Response(200, json={"response": "ok"})
+
+    client = OllamaClient(endpoints=["http://down.test", "http://up.test"], transport=httpx.MockTransport(handler))
+
+    async def run():
+        results = [await client.generate(str(i), "m") for i in range(3)]
+        await client.close()
+        return results
+
+    assert asyncio.run(run()) == ["ok"] * 3
+    down, up = client.endpoints
+    assert not down.healthy and "conexión" in down.last_error
+    assert up.requests == 3
+
+def test_health_check_and_warm_up_keep_models_loaded():
+    seen = []
+    state = {"down": True}
+
+    def handler(request):
+        if request.url.path == "/api/tags":
+            return httpx.Response(503 if state["down"] else 200, json={"models": []})
+        seen.append((request.url.path, json.loads(request.content)))
+        return httpx.Response(200, json={"response": "", "embeddings": [[0.1]]})
+
+    client = OllamaClient(base_url="http://ollama.test", keep_alive="1h", warm_models=["qwen2.5:3b"],
+                          transport=httpx.MockTransport(handler))
+
+    async def run():
+        await client.request("/api/embed", {"model": "nomic-embed-text", "input": ["x"]})
+        await client.check_health()
+        healthy_while_down = client.endpoints[0].healthy
+        state["down"] = False
+        await client.check_health()   # vuelve: se precarga
+        await client.close()
+        return healthy_while_down
+
+    assert asyncio.run(run()) is False
+    assert seen[0] == ("/api/embed", {"model": "nomic-embed-text", "input": ["x"], "keep_alive": "1h"})
+    assert ("/api/generate", {"model": "qwen2.5:3b", "keep_alive": "1h", "prompt": "", "stream": False}) in seen
+    assert ("/api/embed", {"model": "nomic-embed-text", "keep_alive": "1h", "input": "warm-up"}) in seen
+    assert set(client.endpoints[0].warmed) == {"qwen2.5:3b", "nomic-embed-text"}
@@ -0,0 +1,104 @@
+import asyncio
+import types
+
+from models.v2_models import AnomalyResultV2
+from services import worker_service as worker_module
+
+class FakeResults:
+    def __init__(self, docs):
+        self.docs = docs
+        self.bulk_ops = []
+
+    async def find_one(self, query, projection=None):
+        anomaly_id = query["anomalies.anomaly_id"]
+        for doc in self.docs:
+            for anomaly in doc["anomalies"]:
+                if anomaly["anomaly_id"] == anomaly_id:
+                    return {"_id": doc["_id"], "job_id": doc["job_id"], "anomalies": [dict(anomaly)]}
+        return None
+
+    async def update_one(self, query, update, array_filters=None):
+        anomaly_id = array_filters[0]["a.anomaly_id"]
+        for doc in self.docs:
+            if doc["_id"] == query["_id"]:
+                for anomaly in doc["anomalies"]:
+                    if anomaly["anomaly_id"] == anomaly_id:
+                        anomaly["explanation"] = update["$set"]["anomalies.$[a].explanation"]
+
+    async def bulk_write(self, operations, ordered=True):
+        self.bulk_ops.extend(operations)
+
+def setup(monkeypatch, explain_result):
+    anomalies = [
+        AnomalyResultV2(log_entry="ERROR disk full", score=-0.3, is_anomaly=True, explanation="",
+                        chunk_id="job_0", template_id=1).dict(),
+        AnomalyResultV2(log_entry="ERROR disk full again", score=-0.2, is_anomaly=True, explanation="",
+                        chunk_id="job_0", template_id=1).dict(),
+    ]
+    results = FakeResults([{"_id": "doc1", "job_id": "job", "anomalies": anomalies}])
+    db = types.SimpleNamespace(mongodb_client=types.SimpleNamespace(logsanomaly=types.SimpleNamespace(results=results)))
+    monkeypatch.setattr(worker_module, "db_manager", db)
+
+    saved = {}
+    calls = []
+
+    async def get_explanations(job_id):
+        return dict(saved)
+
+    async def save_explanations(job_id, explanations):
+        saved.update(explanations)
+
+    async def explain_on_demand(log_entry, score):
+        calls.append(log_entry)
+        await asyncio.sleep(0.01)
+        return explain_result
+
+    monkeypatch.setattr(worker_module.template_store, "get_explanations", get_explanations)
+    monkeypatch.setattr(worker_module.template_store, "save_explanations", save_explanations)
+    monkeypatch.setattr(worker_module.explanation_service, "explain_on_demand", explain_on_demand)
+    return worker_module.WorkerService(), anomalies, results, saved, calls
+
+def test_generates_once_and_stores(monkeypatch):
+    worker, anomalies, results, saved, calls = setup(monkeypatch, "El disco está lleno")
+    anomaly_id = anomalies[0]["anomaly_id"]
+
+    async def run():
+        # Dos peticiones simultáneas comparten una sola generación
+        first, second = await asyncio.gather(worker.explain_anomaly(anomaly_id), worker.explain_anomaly(anomaly_id))
+        third = await worker.explain_anomaly(anomaly_id)
+        return first, second, third
+
+    first, second, third = asyncio.run(run())
+    assert calls == ["ERROR disk full"]
+    assert first["generated"] and first["explanation"] == "El disco está lleno"
+    assert second["explanation"] == "El disco está lleno"
+    assert third == {**first, "generated": False}
+    # Guardada en la anomalía, en su plantilla y propagada al resto de la plantilla
+    assert results.docs[0]["anomalies"][0]["explanation"] == "El disco está lleno"
+    assert saved == {1: "El disco está lleno"}
+    assert len(results.bulk_ops) == 1
+
+def test_same_template_reuses_explanation(monkeypatch):
+    worker, anomalies, results, saved, calls = setup(monkeypatch, "El disco está lleno")
+
+    async def run():
+        await worker.explain_anomaly(anomalies[0]["anomaly_id"])
+        return await worker.explain_anomaly(anomalies[1]["anomaly_id"])
+
+    result = asyncio.run(run())
+    assert calls == ["ERROR disk full"]
+    assert result["explanation"] == "El disco está lleno"
+
+def test_fallback_is_not_stored(monkeypatch):
+    worker, anomalies, results, saved, calls = setup(monkeypatch, None)
+
+    result = asyncio.run(worker.explain_anomaly(anomalies[0]["anomaly_id"]))
+    assert result["fallback"] and not result["generated"]
+    assert result["explanation"]
+    assert results.docs[0]["anomalies"][0]["explanation"] == ""
+    assert saved == {}
+
+def test_unknown_anomaly(monkeypatch):
+    worker, _, _, _, _ = setup(monkeypatch, "x")
+
+    assert asyncio.run(worker.explain_anomaly("missing")) is None
@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+from sklearn.ensemble import IsolationForest
+from services.feature_extractor import extract_features_batch
+from services.parallel_executor import ParallelExecutor
+from services.template_miner import mask_lines
+
+LOGS = [f"ERROR [2024-01-01T10:00:{i % 60:02d}] Request {i} from 10.0.0.{i % 250} failed" for i in range(400)]
+
+@pytest.fixture(scope="module")
+def executor():
+    executor = ParallelExecutor(n_jobs=2, min_lines=100)
+    yield executor
+    executor.shutdown()
+
+def test_sharded_results_match_serial(executor):
+    """Repartir entre procesos no cambia el resultado ni el orden"""
+    assert executor.mask_lines(LOGS) == mask_lines(LOGS)
+    np.testing.assert_array_equal(executor.extract_features(LOGS), extract_features_batch(LOGS))
+
+    features = extract_features_batch(LOGS)
+    model = IsolationForest(n_estimators=20, random_state=0).fit(features)
+    np.testing.assert_allclose(executor.score_model(model, features), model.decision_function(features))
+
+def test_small_inputs_stay_in_process():
+    executor = ParallelExecutor(n_jobs=4, min_lines=1000)
+    np.testing.assert_array_equal(executor.extract_features(LOGS), extract_features_batch(LOGS))
+    assert executor._executor is None
+
+if __name__ == "__main__":
+    pytest.main([__file__])
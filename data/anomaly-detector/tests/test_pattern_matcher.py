@@ -0,0 +1,52 @@
+import pytest
+from services.pattern_matcher import PatternMatcher, pattern_matcher
+
+GROUPS = {
+    "keywords": ["error", "failed", "denied"],
+    "paths": ["/admin", "/wp-admin"],
+    "levels": ["WARN", "WARNING", "ERROR"],
+    "services.Base de Datos": ["database", "mysql"],
+    "services.Red": ["ssh"],
+}
+
+LINES = [
+    "ERROR Database connection FAILED",
+    "GET /wp-admin/setup.php 403 denied",
+    "WARNING disk almost full",
+    "INFO all good",
+]
+
+def test_match_returns_hits_per_group():
+    matcher = PatternMatcher(GROUPS)
+    hits = matcher.match(LINES[0])
+
+    assert hits["keywords"] == {"error", "failed"}
+    assert hits["levels"] == {"error"}
+    assert matcher.first_group(hits, "services") == "Base de Datos"
+    assert matcher.count(hits, "keywords") == 2
+
+def test_overlapping_patterns_are_all_reported():
+    """'warning' contiene 'warn' y 'database' contiene 'base'"""
+    matcher = PatternMatcher({**GROUPS, "words": ["base", "connect"]})
+    assert matcher.match(LINES[0])["words"] == {"base", "connect"}
+    assert matcher.match(LINES[1])["paths"] == {"/wp-admin"}
+    hits = matcher.match(LINES[2])
+    assert hits["levels"] == {"warn", "warning"}
+    assert matcher.first_pattern(hits, "levels") == "warn"
+
+def test_batch_matches_per_line_and_substring_semantics():
+    matcher = PatternMatcher(GROUPS)
+    assert matcher.match_batch(LINES) == [matcher.match(line) for line in LINES]
+    assert matcher.match_batch([]) == []
+
+    for line in LINES:
+        expected = sum(1 for keyword in GROUPS["keywords"] if keyword in line.lower())
+        assert matcher.count(matcher.match(line), "keywords") == expected
+
+def test_global_matcher_is_built_from_config():
+    assert "suspicious_keywords" in pattern_matcher.groups
+    assert "feature_keywords" in pattern_matcher.groups
+    assert pattern_matcher.first_group(pattern_matcher.match("nginx upstream timeout"), "services") == "Nginx Web Server"
+
+if __name__ == "__main__":
+    pytest.main([__file__])
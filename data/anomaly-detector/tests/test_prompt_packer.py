@@ -0,0 +1,81 @@
+import asyncio
+import json
+import re
+
+import httpx
+from services import explanation_service as explanation_module
+from services.ollama_client import OllamaClient
+from services.prompt_packer import PromptPacker
+
+def make_packer(**kwargs):
+    options = dict(context_tokens=1000, response_tokens_per_item=50, max_line_tokens=100, max_items=20,
+                   chars_per_token={"test": 4.0})
+    options.update(kwargs)
+    return PromptPacker(**options)
+
+def test_short_lines_share_one_prompt_up_to_max_items():
+    packer = make_packer(max_items=8)
+    lines = [f"ERROR short line {i}" for i in range(10)]
+
+    packs = packer.pack(lines, "test-model")
+    assert [len(pack) for pack in packs] == [8, 2]
+
+def test_long_lines_are_split_by_budget():
+    packer = make_packer()
+    lines = ["x" * 300] * 6  # 75 tokens de línea + 50 de respuesta por anomalía
+
+    packs = packer.pack(lines, "test-model", fixed_tokens=300)
+    assert [len(pack) for pack in packs] == [5, 1]
+    assert sorted(index for pack in packs for index in pack) == list(range(6))
+
+def test_similar_lines_are_packed_together():
+    packer = make_packer(max_items=2)
+    lines = ["WARN cache miss 1", "ERROR disk full on /dev/sda", "WARN cache miss 2", "ERROR disk full on /dev/sdb"]
+
+    packs = packer.pack(lines, "test-model", keys=["b", "a", "b", "a"])
+    assert packs == [[1, 3], [0, 2]]
+
+def test_truncation_keeps_head_and_tail():
+    packer = make_packer(max_line_tokens=50)
+    line = "START " + "a" * 2000 + " END"
+
+    truncated = packer.truncate(line, "test-model")
+    assert truncated.startswith("START") and truncated.endswith("END")
+    assert "caracteres omitidos" in truncated
+    assert packer.estimate_tokens(truncated, "test-model") <= 50
+    assert packer.truncate("ERROR corta", "test-model") == "ERROR corta"
+
+def test_batch_requests_follow_packing(monkeypatch):
+    seen = []
+
+    def handler(request):
+        payload = json.loads(request.content)
+        seen.append(payload)
+        ids = re.findall(r"\[(A\d+)\] \(Score", payload["prompt"])
+        body = {"explanations": [{"id": item_id, "explanation": f"Explicación {item_id}"} for item_id in ids]}
+        return httpx.Response(200, json={"response": json.dumps(body), "done": True})
+
+    client = OllamaClient(base_url="http://ollama.test", transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(explanation_module, "ollama_client", client)
+    monkeypatch.setattr(explanation_module, "prompt_packer", make_packer(context_tokens=2000, max_line_tokens=200))
+    service = explanation_module.ExplanationService()
+    batch = [
+        ("ERROR packing test request 1001 failed", -0.3),
+        ("ERROR packing test request 2002 failed", -0.2),   # misma forma que la anterior
+        ("ERROR packing test stack " + "frame " * 2000, -0.4),
+        ("WARN packing test slow query", -0.1),
+    ]
+
+    async def run():
+        explanations = await service.get_batch_explanations(batch)
+        await client.close()
+        return explanations
+
+    explanations = asyncio.run(run())
+    assert explanations[0] == explanations[1] == "Explicación A1"
+    assert all(explanation.startswith("Explicación") for explanation in explanations)
+    assert all(payload["options"]["num_ctx"] == 2000 for payload in seen)
+    assert sum(len(re.findall(r"\[A\d+\] \(Score", payload["prompt"])) for payload in seen) == 3
+    assert all(len(payload["prompt"]) < 2000 * 3 for payload in seen)
+    stats = service.batch_stats()
+    assert stats["deduplicated"] == 1 and stats["truncated"] == 1
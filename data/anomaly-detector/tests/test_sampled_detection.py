@@ -0,0 +1,109 @@
+import asyncio
+import io
+import json
+import numpy as np
+import pytest
+from fastapi import UploadFile
+from fastapi.testclient import TestClient
+import main
+from main import app
+from services.sampled_detection import SampledDetector, reservoir_sample
+
+client = TestClient(app)
+
+NORMAL_LOGS = [f"INFO [2024-01-01T10:00:{i % 60:02d}] Request {i} served in {i % 9}ms" for i in range(3000)]
+RARE_LOG = "CRITICAL kernel panic: unable to mount root fs on unknown-block(0,0) {{{{!!!!}}}}"
+
+def test_reservoir_sample_has_fixed_size_and_counts_all_lines():
+    sample, total = reservoir_sample(iter(range(100000)), 500, random_state=1)
+    assert total == 100000
+    assert len(sample) == len(set(sample)) == 500
+    # Muestra uniforme: la media debe estar cerca de la media de la población
+    assert abs(np.mean(sample) - 50000) < 5000
+
+    small, total = reservoir_sample(iter(range(10)), 500)
+    assert small == list(range(10)) and total == 10
+
+def test_sampled_detector_scores_every_line_in_blocks():
+    logs = NORMAL_LOGS[:1500] + [RARE_LOG] + NORMAL_LOGS[1500:]
+    detector = SampledDetector(sample_size=400, block_size=256).fit(lambda: iter(logs))
+
+    blocks = list(detector.score_blocks(lambda: iter(logs)))
+    assert detector.total_lines == len(logs)
+    assert all(len(block) <= 256 for _, block, _, _, _ in blocks)
+    assert sum(len(block) for _, block, _, _, _ in blocks) == len(logs)
+
+    # Cada línea se cuenta una sola vez en las plantillas (fase 1), aunque se puntúe después
+    assert sum(cluster.size for cluster in detector.miner.clusters.values()) == len(logs)
+    assert sum(detector.template_counts.values()) == len(logs)
+
+    labels = np.concatenate([block_labels for _, _, block_labels, _, _ in blocks])
+    assert labels[1500] == -1
+    assert (labels == -1).mean() < 0.3
+
+def test_grouped_input_counts_repetitions_for_rarity():
+    # Líneas únicas ya minadas (como en analyze_logs): la primera plantilla se repite mucho
+    lines = NORMAL_LOGS[:300] + [RARE_LOG]
+    template_ids = [1] * 300 + [2]
+    weights = [20] * 300 + [1]
+    detector = SampledDetector(sample_size=100, block_size=64).fit(lambda: lines, template_ids=template_ids,
+                                                                    weights=weights)
+
+    assert detector.total_lines == 6001
+    assert detector.template_counts == {1: 6000, 2: 1}
+    blocks = list(detector.score_blocks(lambda: lines, template_ids))
+    assert [t for _, _, _, _, block_ids in blocks for t in block_ids] == template_ids
+    assert not detector.miner.clusters  # Sin volver a minar
+
+def test_detect_large_endpoint_streams_blocks(tmp_path, monkeypatch):
+    monkeypatch.setattr("main.CHUNKS_DIR", str(tmp_path))
+    content = "\n".join(NORMAL_LOGS[:500] + [RARE_LOG]).encode()
+    response = client.post(
+        "/detect-large?explain=false&sample_size=200&block_size=128",
+        files={"file": ("big_test.log", content, "text/plain")}
+    )
+    assert response.status_code == 200
+    records = [json.loads(line) for line in response.text.strip().split("\n")]
+
+    assert records[-1]["is_complete"] and records[-1]["total_logs"] == 501
+    assert sum(template["count"] for template in records[-1]["templates"]) == 501
+    anomalies = [a for record in records[:-1] for a in record["anomalies"]]
+    assert RARE_LOG in [a["log_entry"] for a in anomalies]
+    assert not list(tmp_path.glob("large_*"))
+
+def test_detect_large_explains_only_top_k_templates(tmp_path, monkeypatch):
+    monkeypatch.setattr("main.CHUNKS_DIR", str(tmp_path))
+    settings = main.load_settings()
+    settings["anomaly_detection"]["top_k"] = 2
+    monkeypatch.setattr(main, "load_settings", lambda: settings)
+    calls = []
+
+    async def fake_explanation(log_entry, fields=None):
+        calls.append(log_entry)
+        return f"explicación {len(calls)}"
+
+    monkeypatch.setattr(main, "get_llm_explanation", fake_explanation)
+    rare = [f"CRITICAL module{chr(97 + i)} failure code {i} {{{{!!!!}}}} " + "x" * i for i in range(8)]
+    content = "\n".join(NORMAL_LOGS[:400] + rare).encode()
+    response = client.post("/detect-large?sample_size=200&block_size=100",
+                           files={"file": ("explain_test.log", content, "text/plain")})
+    records = [json.loads(line) for line in response.text.strip().split("\n")]
+
+    explained = {a["template_id"] for record in records[:-1] for a in record["anomalies"] if a["explanation"]}
+    assert len(calls) <= 2 and len(explained) == len(calls) > 0
+
+def test_detect_large_removes_upload_when_body_is_never_read(tmp_path, monkeypatch):
+    monkeypatch.setattr("main.CHUNKS_DIR", str(tmp_path))
+    upload = UploadFile(io.BytesIO("\n".join(NORMAL_LOGS[:300]).encode()), filename="gone.log")
+
+    async def run():
+        response = await main.detect_anomalies_large(upload, explain=False, sample_size=100, block_size=64)
+        assert list(tmp_path.glob("large_*"))
+        # El cliente se fue antes del streaming: Starlette solo ejecuta la tarea de fondo
+        await response.background()
+
+    asyncio.run(run())
+    assert not list(tmp_path.glob("large_*"))
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+from services.feature_extractor import extract_features_batch
+from services.streaming_detector import HalfSpaceTrees
+
+NORMAL_LOGS = [
+    f"INFO [2024-01-01T10:{i % 60:02d}:00] Request {i} served in {i % 7 + 3}ms"
+    for i in range(600)
+]
+ODD_LOG = "{{{{[[[[((((<<<<>>>>))))]]]]}}}} ??? ||| " * 12
+
+def test_rare_lines_score_lower_than_normal_traffic():
+    """Tras aprender el tráfico normal, una línea atípica queda con score negativo"""
+    detector = HalfSpaceTrees(window_size=256, random_state=0)
+    features = extract_features_batch(NORMAL_LOGS)
+    for start in range(0, len(features), 50):
+        detector.score_learn(features[start:start + 50])
+
+    normal_scores = detector.score(features[:100])
+    odd_score = detector.score_one(extract_features_batch([ODD_LOG])[0])
+
+    assert odd_score < 0
+    assert odd_score < normal_scores.min()
+
+def test_state_roundtrip_and_fixed_size():
+    """El estado serializado reproduce los scores y no crece con las líneas vistas"""
+    detector = HalfSpaceTrees(window_size=128)
+    features = extract_features_batch(NORMAL_LOGS)
+    detector.partial_fit(features[:200])
+    size_before = len(detector.to_bytes())
+    detector.partial_fit(features[200:])
+
+    restored = HalfSpaceTrees.from_bytes(detector.to_bytes())
+    assert restored.n_seen == len(NORMAL_LOGS)
+    np.testing.assert_allclose(restored.score(features[:50]), detector.score(features[:50]))
+    assert detector.reference_mass.shape == restored.latest_mass.shape
+    assert len(detector.to_bytes()) < size_before * 2
+
+def test_uninitialized_detector_scores_zero():
+    detector = HalfSpaceTrees.from_bytes(HalfSpaceTrees().to_bytes())
+    assert not detector.is_initialized
+    assert detector.score(np.zeros((3, 7))).tolist() == [0.0, 0.0, 0.0]
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,41 @@
+import pytest
+from services.template_miner import TemplateMiner, mask_lines, template_groups
+
+LOGS = [
+    "INFO [2024-01-01T10:00:00.1] User alice logged in from IP 10.0.0.1",
+    "INFO [2024-01-01T10:00:01.2] User bob logged in from IP 10.0.0.2",
+    "ERROR [2024-01-01T10:00:02.3] Request 550e8400-e29b-41d4-a716-446655440000 failed after 35 ms",
+    "ERROR [2024-01-01T10:00:03.4] Request 6ba7b810-9dad-11d1-80b4-00c04fd430c8 failed after 120 ms",
+    "INFO [2024-01-01T10:00:04.5] User carol logged in from IP 10.0.0.3",
+]
+
+def test_masking_replaces_variable_values():
+    masked = mask_lines([LOGS[0], LOGS[2], "addr 0x7ffe12 ok"])
+    assert masked[0] == "INFO [<TS>] User alice logged in from IP <IP>"
+    assert masked[1] == "ERROR [<TS>] Request <UUID> failed after <NUM> ms"
+    assert masked[2] == "addr <HEX> ok"
+
+def test_lines_are_grouped_by_template():
+    miner = TemplateMiner()
+    template_ids = miner.add_lines(LOGS)
+
+    assert template_ids[0] == template_ids[1] == template_ids[4]
+    assert template_ids[2] == template_ids[3] != template_ids[0]
+    assert miner.template(template_ids[0]) == "INFO [<TS>] User <*> logged in from IP <IP>"
+    assert miner.clusters[template_ids[0]].size == 3
+
+    unique_ids, first_index, inverse, counts = template_groups(template_ids)
+    assert first_index.tolist() == [0, 2]
+    assert counts.tolist() == [3, 2]
+    assert miner.rarity(unique_ids)[1] > miner.rarity(unique_ids)[0]
+
+def test_state_roundtrip_keeps_template_ids():
+    miner = TemplateMiner()
+    template_ids = miner.add_lines(LOGS)
+    restored = TemplateMiner.from_dict(miner.to_dict())
+
+    assert restored.add_lines(LOGS) == template_ids
+    assert restored.total_lines == 2 * len(LOGS)
+
+if __name__ == "__main__":
+    pytest.main([__file__])
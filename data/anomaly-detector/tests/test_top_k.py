@@ -0,0 +1,70 @@
+import asyncio
+
+import main
+import numpy as np
+from services.template_miner import TemplateMiner
+from services.top_k import TopK, TopKStore, top_k_indices
+from test_explanation_scheduler import FakeRedis
+
+def test_keeps_k_lowest_scores():
+    rng = np.random.default_rng(0)
+    scores = rng.normal(size=1000)
+    top = TopK(10)
+    for i, score in enumerate(scores):
+        top.push(i, float(score), f"line {i}")
+
+    items = top.items()
+    assert len(top) == 10
+    assert [key for _, key, _ in items] == np.argsort(scores)[:10].tolist()
+    assert items[0][2] == f"line {int(np.argmin(scores))}"
+    assert top.threshold() == items[-1][0]
+
+def test_one_entry_per_key_with_best_score():
+    top = TopK(2)
+    assert top.push("a", -0.1)
+    assert top.push("b", -0.2)
+    assert not top.push("a", -0.05)   # peor que la que ya tiene
+    assert top.push("a", -0.3)        # mejora: reemplaza su entrada
+    assert not top.push("c", -0.15)   # no supera a la menos anómala del top ("b")
+    assert top.push("c", -0.25)
+
+    assert [(score, key) for score, key, _ in top.items()] == [(-0.3, "a"), (-0.25, "c")]
+
+def test_threshold_none_until_full():
+    top = TopK(3)
+    top.push(1, -0.5)
+    assert top.threshold() is None
+    assert TopK(0).push(1, -1.0) is False
+
+def test_top_k_indices():
+    scores = [0.3, -0.2, 0.1, -0.5, -0.1]
+
+    assert top_k_indices(scores, 2).tolist() == [3, 1]
+    assert top_k_indices(scores, 10).tolist() == [3, 1, 4, 2, 0]
+    assert top_k_indices([], 3).tolist() == []
+
+def test_detect_chunks_share_the_job_budget(monkeypatch):
+    redis = FakeRedis()
+    monkeypatch.setattr(TopKStore, "_redis", staticmethod(lambda: redis))
+    settings = main.load_settings()
+    settings["anomaly_detection"]["top_k"] = 3
+    monkeypatch.setattr(main, "load_settings", lambda: settings)
+
+    def chunk(lines, scores):
+        # Cada petición de /detect mina sus plantillas desde cero (los IDs no coinciden entre chunks)
+        miner = TemplateMiner()
+        template_ids = miner.add_lines(lines)
+        return list(range(len(lines))), scores, template_ids, miner
+
+    async def run():
+        first = await main.select_explained_templates(
+            *chunk(["disk full on sda", "login failed for root", "kernel panic now"], [-0.3, -0.2, -0.1]),
+            job_id="file")
+        # Más anómalas que las del primer chunk, pero el presupuesto del archivo ya se gastó
+        second = await main.select_explained_templates(
+            *chunk(["segfault in worker", "disk full on sda"], [-0.9, -0.8]), job_id="file")
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert len(first) == 3
+    assert len(second) == 1  # Solo la plantilla de disco, ya contada en el presupuesto
@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+from sklearn.ensemble import IsolationForest
+from services.tree_scorer import CompiledForest
+
+@pytest.fixture
+def training_data():
+    rng = np.random.default_rng(0)
+    # Características discretas con repeticiones, como las de logs reales
+    return rng.integers(0, 20, size=(2000, 7)).astype(np.float32)
+
+@pytest.mark.parametrize("max_features", [1.0, 0.6])
+def test_compiled_scores_match_sklearn(training_data, max_features):
+    """El recorrido compilado reproduce decision_function de sklearn"""
+    model = IsolationForest(random_state=42, n_estimators=50, max_features=max_features).fit(training_data)
+    compiled = CompiledForest.from_isolation_forest(model)
+
+    batch = training_data[:200] + 0.5  # Valores entre umbrales
+    np.testing.assert_allclose(compiled.decision_function(batch), model.decision_function(batch), atol=1e-12)
+    np.testing.assert_array_equal(compiled.predict(batch), model.predict(batch))
+
+def test_compiled_scores_large_batches_and_without_model(training_data):
+    """Lotes grandes (deduplicados) y scorer sin modelo de respaldo"""
+    model = IsolationForest(random_state=42, n_estimators=50).fit(training_data)
+    compiled = CompiledForest.from_isolation_forest(model, traverse_max_rows=100)
+    expected = model.decision_function(training_data)
+
+    np.testing.assert_allclose(compiled.decision_function(training_data), expected, atol=1e-12)
+
+    compiled.model = None
+    np.testing.assert_allclose(compiled.decision_function(training_data, dedupe=False), expected, atol=1e-12)
+
+if __name__ == "__main__":
+    pytest.main([__file__])
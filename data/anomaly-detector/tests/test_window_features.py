@@ -0,0 +1,63 @@
+import numpy as np
+from services.log_parser import LogParser
+from services.window_features import WINDOW_FEATURES, WindowCounter, WindowFeatures, window_groups
+
+def access_line(ip, second, path="/index.html", status=200, user="-"):
+    minute, sec = divmod(second, 60)
+    return f'{ip} - {user} [10/Oct/2023:13:{minute:02d}:{sec:02d} +0000] "GET {path} HTTP/1.1" {status} 100'
+
+def test_counter_expires_old_buckets():
+    counter = WindowCounter(window_seconds=60, bucket_seconds=10, max_entities=10)
+
+    for t in range(0, 30):
+        counter.add("a", 1000 + t)
+    assert counter.count("a") == 30
+    # Los intervalos 100-102 siguen en la ventana a los 1055 s y salen a los 1085 s (queda el de 1055)
+    assert counter.add("a", 1055) == 31
+    assert counter.add("a", 1085) == 2
+    assert counter.add("b", 2000) == 1
+    assert counter.count("a") == 0
+
+def test_counter_is_bounded_lru():
+    counter = WindowCounter(window_seconds=60, bucket_seconds=10, max_entities=3)
+
+    for key in ["a", "b", "c", "a", "d"]:
+        counter.add(key, 0)
+    assert len(counter) == 3
+    assert counter.count("b") == 0  # la menos reciente cedió su fila
+    assert counter.count("a") == 2
+    assert counter.counts.shape == (3, 6)
+
+def test_burst_from_one_ip_raises_counts():
+    lines = [access_line(f"10.0.0.{i % 50}", i) for i in range(100)]
+    lines += [access_line("6.6.6.6", 100 + i // 10, f"/wp-admin/p{i}.php", 401) for i in range(40)]
+    parsed = LogParser().parse(lines)
+    window = np.rint(np.expm1(WindowFeatures(window_seconds=300, bucket_seconds=10).update(parsed)))
+
+    assert window.shape == (140, len(WINDOW_FEATURES))
+    assert window[-1, WINDOW_FEATURES.index("ip_count")] == 40
+    assert window[-1, WINDOW_FEATURES.index("ip_error_count")] == 40
+    assert window[-1, WINDOW_FEATURES.index("path_count")] == 40  # mismo prefijo /wp-admin
+    assert window[99, WINDOW_FEATURES.index("ip_count")] <= 2
+    assert window[99, WINDOW_FEATURES.index("ip_error_count")] == 0
+
+def test_state_survives_chunk_boundaries():
+    lines = [access_line("6.6.6.6", i, status=500, user="bob") for i in range(20)]
+    parser = LogParser()
+    windows = WindowFeatures(window_seconds=300, bucket_seconds=10)
+    windows.update(parser.parse(lines[:10]))
+
+    restored = WindowFeatures.from_bytes(windows.to_bytes())
+    window = np.rint(np.expm1(restored.update(parser.parse(lines[10:]))))
+
+    assert np.allclose(window[-1, :3], [20, 20, 20])
+    assert restored.counters["user_count"].count("bob") == 20
+
+def test_window_groups_collapse_similar_lines():
+    template_ids = [1, 1, 1, 2]
+    window = np.log1p(np.array([[1.0], [1.0], [50.0], [1.0]]))
+    quantized, first_index, inverse, counts = window_groups(template_ids, window)
+
+    assert len(first_index) == 3
+    assert counts.sum() == 4
+    assert np.array_equal(quantized[first_index][inverse], quantized)